@@ -3,10 +3,21 @@
 # See LICENSE file for details.
 
 from flocker.node import BackendDescription, DeployerType
+from purestorage_flasharray_flocker_driver import multi_array
 from purestorage_flasharray_flocker_driver import purestorage_blockdevice
 
 
 def api_factory(cluster_id, **kwargs):
+    if kwargs.get('pure_arrays'):
+        options = dict((name, kwargs.get(name))
+                       for name in multi_array.ARRAY_OPTIONS +
+                       multi_array.SHARED_OPTIONS)
+        return multi_array.multi_from_configuration(
+            cluster_id=cluster_id,
+            pure_arrays=kwargs.get('pure_arrays'),
+            pure_array_stats_ttl=kwargs.get('pure_array_stats_ttl'),
+            **options
+        )
     return purestorage_blockdevice.pure_from_configuration(
         cluster_id=cluster_id,
         pure_ip=kwargs.get('pure_ip'),
@@ -17,6 +28,18 @@ def api_factory(cluster_id, **kwargs):
         pure_chap_host_password=kwargs.get('pure_chap_host_password'),
         pure_verify_https=kwargs.get('pure_verify_https'),
         pure_ssl_cert=kwargs.get('pure_ssl_cert'),
+        pure_port_cache_ttl=kwargs.get('pure_port_cache_ttl'),
+        pure_state_dir=kwargs.get('pure_state_dir'),
+        pure_api_pool_size=kwargs.get('pure_api_pool_size'),
+        pure_api_max_retries=kwargs.get('pure_api_max_retries'),
+        pure_log_level=kwargs.get('pure_log_level'),
+        pure_metrics_textfile=kwargs.get('pure_metrics_textfile'),
+        pure_metrics_port=kwargs.get('pure_metrics_port'),
+        pure_profiles=kwargs.get('pure_profiles'),
+        pure_eradicate_after=kwargs.get('pure_eradicate_after'),
+        pure_iscsi_session_interval=kwargs.get('pure_iscsi_session_interval'),
+        pure_warm_pool_size=kwargs.get('pure_warm_pool_size'),
+        pure_volume_list_ttl=kwargs.get('pure_volume_list_ttl'),
     )
 
 
@@ -0,0 +1,34 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Variant of the FlashArray backend for running many volume operations at once.
+
+Select it with ``backend: purestorage_flasharray_flocker_driver.async_blockdevice``
+in agent.yml. Flocker's block device deployer already runs the changes of the
+synchronous ``FlashArrayBlockDeviceAPI`` on the reactor's thread pool, so they
+never block the reactor. This backend returns the same API, and only sizes
+that thread pool with ``pure_async_threads`` so that more independent volumes
+are attached, detached and destroyed concurrently.
+"""
+
+from flocker.node import BackendDescription, DeployerType
+
+import purestorage_flasharray_flocker_driver
+
+
+def api_factory(cluster_id, reactor, **kwargs):
+    max_threads = kwargs.get('pure_async_threads')
+    if max_threads:
+        reactor.suggestThreadPoolSize(int(max_threads))
+    return purestorage_flasharray_flocker_driver.api_factory(cluster_id,
+                                                             **kwargs)
+
+
+FLOCKER_BACKEND = BackendDescription(
+    name=u"purestorage_flasharray_flocker_driver.async_blockdevice",
+    needs_reactor=True,
+    needs_cluster_id=True,
+    api_factory=api_factory,
+    deployer_type=DeployerType.block
+)
@@ -0,0 +1,404 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Managed REST client layer for the Purity REST API.
+"""
+
+import contextlib
+import functools
+import importlib
+import random
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+import purestorage
+import requests
+
+from purestorage_flasharray_flocker_driver import metrics as metrics_module
+from purestorage_flasharray_flocker_driver import tracing
+
+# Purity answers with these when it is too busy to handle the request, the
+# request has not been processed so it is always safe to send it again.
+THROTTLED_CODES = (429, 503)
+
+# Other server side and connection errors are only retried for requests
+# which don't change anything on the array.
+READ_ONLY_PREFIXES = ('get', 'list_')
+
+DEFAULT_MAX_RETRIES = 5
+RETRY_BASE_DELAY = 0.5  # seconds
+RETRY_MAX_DELAY = 30  # seconds
+
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30  # seconds
+
+
+class ArrayUnavailableError(purestorage.PureError):
+    """Raised without contacting the array while the circuit is open."""
+    def __init__(self, target):
+        purestorage.PureError.__init__(
+            self, 'FlashArray {0} is unavailable, not sending '
+                  'request.'.format(target))
+
+
+class _SessionRequests(object):
+    """Stand-in for the ``requests`` module used by ``purestorage``.
+
+    The stock client sends every request with ``requests.request``. This
+    sends those made by a ``KeepAliveFlashArray`` over its own session
+    instead, and everything else as before.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            return requests.request(method, url, **kwargs)
+        return session.request(method, url, **kwargs)
+
+    @contextlib.contextmanager
+    def session(self, session):
+        """Send the requests of this thread over ``session`` in the ``with``
+        block."""
+        previous = getattr(self._local, 'session', None)
+        self._local.session = session
+        try:
+            yield
+        finally:
+            self._local.session = previous
+
+
+_session_requests = _SessionRequests()
+_install_lock = threading.Lock()
+
+
+def _install_session_requests():
+    """Have the ``purestorage`` module send its requests through
+    ``_session_requests``.
+
+    This replaces the module's ``requests`` for every ``FlashArray`` in the
+    process, the others still get a new connection per request though. It
+    is done once, by the first ``KeepAliveFlashArray``.
+    """
+    module = importlib.import_module(purestorage.FlashArray.__module__)
+    with _install_lock:
+        if module.requests is not _session_requests:
+            module.requests = _session_requests
+
+
+class KeepAliveFlashArray(purestorage.FlashArray):
+    """``purestorage.FlashArray`` which keeps its HTTPS connection open.
+
+    The stock client goes through ``requests.request`` for every call, which
+    sets up a new connection (and TLS handshake) each time. This one has the
+    stock client send everything over a single persistent
+    ``requests.Session``, so logging in again when the session expires,
+    renegotiating the REST version, ``request_kwargs`` and the response
+    headers all work as they do upstream.
+
+    Instances are not safe for concurrent use, see ``FlashArrayClientPool``.
+
+    :param adapter: Optional ``requests`` transport adapter for the array's
+        URLs, by default HTTPS over one persistent connection.
+    """
+    def __init__(self, target, api_token=None, verify_https=False,
+                 ssl_cert=None, user_agent=None, adapter=None, **kwargs):
+        _install_session_requests()
+        self._http = requests.Session()
+        if adapter is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=1)
+        self._http.mount('https://', adapter)
+        super(KeepAliveFlashArray, self).__init__(
+            target, api_token=api_token, verify_https=verify_https,
+            ssl_cert=ssl_cert, user_agent=user_agent, **kwargs)
+
+    def _request(self, method, path, data=None, reestablish_session=True):
+        with _session_requests.session(self._http):
+            return super(KeepAliveFlashArray, self)._request(
+                method, path, data, reestablish_session)
+
+    def close(self):
+        self._http.close()
+
+
+class AdaptiveLimiter(object):
+    """Limit on the number of concurrent requests to the array.
+
+    The limit adapts to how the array is coping (additive increase,
+    multiplicative decrease): it is halved whenever the array throttles or
+    fails a request, reduced a little whenever a request takes much longer
+    than the fastest one seen for the same method, and otherwise grows back
+    slowly towards ``max_limit``.
+    """
+    def __init__(self, max_limit, min_limit=1, latency_tolerance=3.0):
+        self._max_limit = max_limit
+        self._min_limit = min_limit
+        self._latency_tolerance = latency_tolerance
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._base_latency = {}
+        self.limit = float(max_limit)
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, method, latency=None, overloaded=False):
+        """Release a slot, feeding back how the request went.
+
+        :param latency: Duration of a successful request, in seconds.
+        :param overloaded: Whether the array throttled or failed it.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded:
+                self.limit = max(self._min_limit, self.limit / 2)
+            elif latency is not None:
+                base = self._base_latency.get(method)
+                if base is None or latency < base:
+                    self._base_latency[method] = base = latency
+                if latency > base * self._latency_tolerance:
+                    self.limit = max(self._min_limit, self.limit * 0.9)
+                else:
+                    self.limit = min(self._max_limit,
+                                     self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to an array which keeps failing.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    requests are refused for ``reset_timeout`` seconds. Then a single trial
+    request is let through, which closes the circuit again if it succeeds.
+    """
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT, clock=time.time):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if (not self._trial_running and
+                    self._clock() - self._opened_at >= self._reset_timeout):
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        """Record a failure, returns whether this opened the circuit."""
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (
+                    self._opened_at is None and
+                    self._failures >= self._failure_threshold):
+                self._opened_at = self._clock()
+                self._trial_running = False
+                return True
+            return False
+
+
+class FlashArrayClientPool(object):
+    """Thread safe pool of persistent FlashArray REST clients.
+
+    It can be used just like a single ``purestorage.FlashArray``: every call
+    borrows an idle client for its duration. Clients are created on demand up
+    to ``size``, so at most ``size`` requests are in flight and each client
+    pays for its login and TLS handshake only once.
+
+    All calls go through here, so this is also where the array is protected
+    from overload. Throttled requests (and transient failures of read only
+    requests) are retried with jittered exponential backoff, the number of
+    requests in flight is adapted to the array's latency and error rate by
+    an ``AdaptiveLimiter``, and a ``CircuitBreaker`` fails requests fast
+    while the array is unreachable. ``counters`` shows how often each of
+    these kicks in.
+
+    :param name: name of the array, for error messages.
+    :param factory: callable returning a new, logged in client.
+    :param size: maximum number of clients.
+    :param max_retries: number of times a failed request is retried.
+    :param metrics: optional ``metrics.Registry`` to record the latency and
+        errors of every request in.
+    """
+    def __init__(self, name, factory, size, max_retries=DEFAULT_MAX_RETRIES,
+                 clock=time.time, sleep=time.sleep, metrics=None):
+        self._name = name
+        self._factory = factory
+        self._size = size
+        self._max_retries = max_retries
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._limiter = AdaptiveLimiter(size)
+        self._breaker = CircuitBreaker(clock=clock)
+        self.counters = {
+            'requests': 0,
+            'retries': 0,
+            'throttled': 0,
+            'failures': 0,
+            'rejected': 0,
+            'circuit_opened': 0,
+        }
+        self._request_seconds = None
+        self._request_errors = None
+        if metrics is not None:
+            self._request_seconds = metrics.histogram(
+                metrics_module.REST_SECONDS,
+                'Latency of Purity REST requests, by array and method.')
+            self._request_errors = metrics.counter(
+                metrics_module.REST_ERRORS,
+                'Failed Purity REST requests, by array, method and HTTP code.')
+            metrics.callback(
+                metrics_module.REST_EVENTS,
+                'Requests, retries, throttling and circuit breaker events.',
+                'counter',
+                lambda: [({'array': self._name, 'event': event}, count)
+                         for event, count in sorted(self.counters.items())])
+            metrics.callback(
+                metrics_module.REST_CONCURRENCY,
+                'Current limit on concurrent Purity REST requests.',
+                'gauge',
+                lambda: [({'array': self._name}, self.concurrency_limit)])
+        # Create the first client straight away so bad credentials or an
+        # unreachable array are reported at startup.
+        self._checkin(self._checkout())
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self._size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self._factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _checkin(self, client):
+        self._idle.put(client)
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    @property
+    def concurrency_limit(self):
+        return int(self._limiter.limit)
+
+    def _classify(self, method, err):
+        """Return ``(retryable, overloaded)`` for a failed request."""
+        if isinstance(err, purestorage.PureHTTPError):
+            if err.code in THROTTLED_CODES:
+                return True, True
+            if err.code < 500:
+                # The array handled the request fine, it just said no.
+                return False, False
+        elif not isinstance(err, purestorage.PureError):
+            return False, False
+        return method.startswith(READ_ONLY_PREFIXES), True
+
+    def _backoff(self, attempt):
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def _call_once(self, method, args, kwargs):
+        client = self._checkout()
+        try:
+            return getattr(client, method)(*args, **kwargs)
+        finally:
+            self._checkin(client)
+
+    def _record(self, method, latency, err=None):
+        if self._request_seconds is None:
+            return
+        self._request_seconds.observe(latency, array=self._name, method=method)
+        if err is not None:
+            code = getattr(err, 'code', None) or type(err).__name__
+            self._request_errors.inc(array=self._name, method=method,
+                                     code=code)
+
+    def call(self, method, *args, **kwargs):
+        """Call ``method`` on one of the pooled clients.
+
+        The call, including its retries, is traced as the ``rest:<method>``
+        phase of the current operation.
+        """
+        with tracing.phase('rest:' + method):
+            return self._call_with_retries(method, args, kwargs)
+
+    def _call_with_retries(self, method, args, kwargs):
+        attempt = 0
+        while True:
+            if not self._breaker.allow():
+                self._count('rejected')
+                raise ArrayUnavailableError(self._name)
+            self._count('requests')
+            self._limiter.acquire()
+            start = self._clock()
+            try:
+                result = self._call_once(method, args, kwargs)
+            except Exception as err:
+                self._record(method, self._clock() - start, err)
+                retryable, overloaded = self._classify(method, err)
+                self._limiter.release(method, overloaded=overloaded)
+                if not overloaded:
+                    self._breaker.record_success()
+                    raise
+                if isinstance(err, purestorage.PureHTTPError) and \
+                        err.code in THROTTLED_CODES:
+                    self._count('throttled')
+                self._count('failures')
+                if self._breaker.record_failure():
+                    self._count('circuit_opened')
+                if not retryable or attempt >= self._max_retries:
+                    raise
+            else:
+                latency = self._clock() - start
+                self._record(method, latency)
+                self._limiter.release(method, latency=latency)
+                self._breaker.record_success()
+                return result
+            self._count('retries')
+            self._sleep(self._backoff(attempt))
+            attempt += 1
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
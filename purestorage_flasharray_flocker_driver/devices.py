@@ -0,0 +1,645 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Helpers for finding FlashArray volumes on the local host.
+
+Everything here works by reading sysfs and ``/dev`` directly so that it is
+cheap enough to be used on every lookup, and can be pointed at a fake tree
+in tests.
+"""
+
+import os
+import select
+import socket
+import subprocess
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+import eliot
+
+from purestorage_flasharray_flocker_driver import state
+
+_logger = eliot.Logger()
+
+SYSFS_ROOT = '/sys'
+DEV_ROOT = '/dev'
+
+DEVICE_WAIT_TIMEOUT = 10  # seconds
+DEVICE_WAIT_INTERVAL = 0.1  # seconds
+# Devices are looked for this often while waiting for uevents, in case
+# one was missed.
+DEVICE_RECHECK_INTERVAL = 1.0  # seconds
+
+# Kernel uevents are multicast on this netlink protocol and group.
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+UEVENT_BUFFER_SIZE = 1024 * 1024
+
+# Transport classes of the SCSI hosts for each storage protocol
+ISCSI_HOST_CLASS = 'iscsi_host'
+FC_HOST_CLASS = 'fc_host'
+FC_REMOTE_PORT_CLASS = 'fc_remote_ports'
+FC_PORT_ONLINE = 'Online'
+
+ISCSI_INITIATOR_NAME_FILE = '/etc/iscsi/initiatorname.iscsi'
+
+# Purity volumes are exposed with an NAA identifier made of the Pure Storage
+# IEEE OUI followed by the volume serial, multipath uses it as the WWID.
+PURE_NAA_PREFIX = '3624a9370'
+MPATH_UUID_PREFIX = 'mpath-'
+
+
+def pure_wwid(serial):
+    """Return the SCSI WWID of the Purity volume with ``serial``."""
+    return PURE_NAA_PREFIX + serial.lower()
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as sysfs_file:
+            return sysfs_file.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def read_dm_uuid(dm_name, sysfs_root=SYSFS_ROOT):
+    """Return the device-mapper uuid of ``dm_name`` (e.g. ``dm-3``)."""
+    return _read_sysfs(os.path.join(sysfs_root, 'block', dm_name, 'dm', 'uuid'))
+
+
+def read_dm_name(dm_name, sysfs_root=SYSFS_ROOT):
+    """Return the device-mapper name of ``dm_name`` (e.g. ``dm-3``).
+
+    For a multipath map this is its alias or wwid, the name ``multipath``
+    takes for it.
+    """
+    return _read_sysfs(os.path.join(sysfs_root, 'block', dm_name, 'dm', 'name'))
+
+
+def serial_from_dm_uuid(dm_uuid):
+    """Return the Purity serial of a multipath map uuid, or ``None``."""
+    prefix = MPATH_UUID_PREFIX + PURE_NAA_PREFIX
+    if dm_uuid and dm_uuid.startswith(prefix):
+        return dm_uuid[len(prefix):].lower()
+    return None
+
+
+def serial_from_device(device, sysfs_root=SYSFS_ROOT):
+    """Return the Purity serial of the multipath ``device``, or ``None``.
+
+    :param device: Path to the device, e.g. ``/dev/dm-3`` or a
+        ``/dev/mapper`` link pointing to it.
+    """
+    dm_name = os.path.basename(os.path.realpath(device))
+    return serial_from_dm_uuid(read_dm_uuid(dm_name, sysfs_root))
+
+
+def has_paths(dm_name, sysfs_root=SYSFS_ROOT):
+    """Return whether the multipath map ``dm_name`` has any path devices."""
+    try:
+        return bool(os.listdir(
+            os.path.join(sysfs_root, 'block', dm_name, 'slaves')))
+    except OSError:
+        return False
+
+
+def find_multipath_device(serial, sysfs_root=SYSFS_ROOT, dev_root=DEV_ROOT):
+    """Return the ``/dev/dm-N`` multipath device of the volume ``serial``.
+
+    The udev ``/dev/disk/by-id/dm-uuid-mpath-<wwid>`` link is tried first,
+    which makes this a constant time lookup, and the multipath maps in sysfs
+    are scanned if udev hasn't created the link or it is stale. The map has to
+    carry the volume's WWID and have at least one path device. No external
+    commands are run.
+
+    :return: the device path or ``None`` if the volume is not present.
+    """
+    serial = serial.lower()
+    by_id = os.path.join(dev_root, 'disk', 'by-id',
+                         'dm-uuid-' + MPATH_UUID_PREFIX + pure_wwid(serial))
+    dm_name = os.path.basename(os.path.realpath(by_id))
+    if serial_from_dm_uuid(read_dm_uuid(dm_name, sysfs_root)) != serial:
+        device = list_multipath_devices(sysfs_root).get(serial)
+        if device is None:
+            return None
+        dm_name = os.path.basename(device)
+    if not has_paths(dm_name, sysfs_root):
+        return None
+    return '/dev/' + dm_name
+
+
+def list_multipath_devices(sysfs_root=SYSFS_ROOT):
+    """Return every Purity multipath device on the host.
+
+    :return: dictionary of volume serial to ``/dev/dm-N`` path.
+    """
+    devices = {}
+    try:
+        names = os.listdir(os.path.join(sysfs_root, 'block'))
+    except OSError:
+        return devices
+    for name in names:
+        if not name.startswith('dm-'):
+            continue
+        serial = serial_from_dm_uuid(read_dm_uuid(name, sysfs_root))
+        if serial:
+            devices[serial] = '/dev/' + name
+    return devices
+
+
+def list_scsi_hosts(host_class, sysfs_root=SYSFS_ROOT):
+    """Return the SCSI hosts (``hostN``) of the given transport class."""
+    try:
+        return sorted(os.listdir(os.path.join(sysfs_root, 'class', host_class)))
+    except OSError:
+        return []
+
+
+def read_iscsi_initiator_name(path=ISCSI_INITIATOR_NAME_FILE):
+    """Return the iSCSI initiator name (IQN) of the host, or ``None``."""
+    try:
+        with open(path) as initiator_file:
+            lines = initiator_file.readlines()
+    except (IOError, OSError):
+        return None
+    for line in lines:
+        if line.startswith('InitiatorName='):
+            return line.split('=', 1)[1].strip()
+    return None
+
+
+def normalize_wwn(wwn):
+    """Return ``wwn`` as lower case hex digits, as sysfs has them."""
+    wwn = wwn.lower().replace(':', '')
+    if wwn.startswith('0x'):
+        wwn = wwn[2:]
+    return wwn
+
+
+def list_fc_hosts(sysfs_root=SYSFS_ROOT):
+    """Return a dictionary of the host's FC HBAs (``hostN``) to their port
+    WWN."""
+    hosts = {}
+    for host in list_scsi_hosts(FC_HOST_CLASS, sysfs_root):
+        port_name = _read_sysfs(os.path.join(sysfs_root, 'class', FC_HOST_CLASS,
+                                             host, 'port_name'))
+        if port_name:
+            hosts[host] = normalize_wwn(port_name)
+    return hosts
+
+
+def read_fc_wwpns(sysfs_root=SYSFS_ROOT):
+    """Return the port WWNs of the host's online FC HBAs.
+
+    Like os-brick, HBAs whose port is not ``Online`` are left out.
+    """
+    hosts = list_fc_hosts(sysfs_root)
+    return [hosts[host] for host in sorted(hosts)
+            if _read_sysfs(os.path.join(sysfs_root, 'class', FC_HOST_CLASS,
+                                        host, 'port_state')) == FC_PORT_ONLINE]
+
+
+def list_fc_remote_ports(sysfs_root=SYSFS_ROOT):
+    """Return the FC target ports each of the host's HBAs can see.
+
+    These are the ports zoned to the HBAs which logged in to the fabric.
+    :return: list of dictionaries with the SCSI ``host``, ``channel`` and
+        ``target_id`` a remote port's LUNs appear on, its ``port_name`` (WWN)
+        and its ``port_state``.
+    """
+    class_dir = os.path.join(sysfs_root, 'class', FC_REMOTE_PORT_CLASS)
+    try:
+        names = os.listdir(class_dir)
+    except OSError:
+        return []
+    rports = []
+    for name in sorted(names):
+        # rport-<host>:<channel>-<number>
+        host, channel = name[len('rport-'):].rsplit('-', 1)[0].split(':')
+        rport_dir = os.path.join(class_dir, name)
+        target_id = _read_sysfs(os.path.join(rport_dir, 'scsi_target_id'))
+        port_name = _read_sysfs(os.path.join(rport_dir, 'port_name'))
+        if not port_name or target_id in (None, '-1'):
+            # Not (yet) a SCSI target
+            continue
+        rports.append({
+            'host': 'host' + host,
+            'channel': channel,
+            'target_id': target_id,
+            'port_name': normalize_wwn(port_name),
+            'port_state': _read_sysfs(os.path.join(rport_dir, 'port_state')),
+        })
+    return rports
+
+
+def list_iscsi_sessions(sysfs_root=SYSFS_ROOT):
+    """Return the host's iSCSI sessions.
+
+    :return: list of dictionaries with the ``session`` name, its ``target``
+        IQN, the target ``portal`` (``address:port``), the SCSI ``host`` the
+        session's LUNs appear on and the ``channel`` and ``target_id`` of
+        the session's SCSI target there (``'-'`` until the kernel created
+        the target, scanning then covers all of them).
+    """
+    session_dir = os.path.join(sysfs_root, 'class', 'iscsi_session')
+    connection_dir = os.path.join(sysfs_root, 'class', 'iscsi_connection')
+    try:
+        session_names = os.listdir(session_dir)
+    except OSError:
+        return []
+    sessions = []
+    for name in sorted(session_names):
+        number = name[len('session'):]
+        connection = os.path.join(connection_dir, 'connection{0}:0'.format(number))
+        address = _read_sysfs(os.path.join(connection, 'persistent_address'))
+        port = _read_sysfs(os.path.join(connection, 'persistent_port'))
+        # sessionN is a child of the SCSI host in the device hierarchy, and
+        # the session's SCSI target (targetH:C:T) a child of sessionN
+        device = os.path.realpath(os.path.join(session_dir, name, 'device'))
+        channel, target_id = '-', '-'
+        try:
+            targets = sorted(entry for entry in os.listdir(device)
+                             if entry.startswith('target'))
+        except OSError:
+            targets = []
+        if targets:
+            _, channel, target_id = targets[0][len('target'):].split(':')
+        sessions.append({
+            'session': name,
+            'target': _read_sysfs(os.path.join(session_dir, name, 'targetname')),
+            'portal': '{0}:{1}'.format(address, port),
+            'host': os.path.basename(os.path.dirname(device)),
+            'channel': channel,
+            'target_id': target_id,
+        })
+    return sessions
+
+
+def rescan_scsi_host(host, channel='-', target='-', lun='-',
+                     sysfs_root=SYSFS_ROOT):
+    """Ask SCSI host ``host`` to scan for new LUNs.
+
+    Without a channel, target or lun this scans everything behind the host.
+    """
+    scan = os.path.join(sysfs_root, 'class', 'scsi_host', host, 'scan')
+    with open(scan, 'w') as scan_file:
+        scan_file.write('{0} {1} {2}'.format(channel, target, lun))
+
+
+def flush_multipath_map(map_name):
+    """Flush the multipath map called ``map_name``, see ``read_dm_name``."""
+    subprocess.check_call(['multipath', '-f', map_name])
+
+
+def resize_multipath_map(dm_name):
+    """Have multipathd resize the map ``dm_name`` to the size of its
+    paths."""
+    subprocess.check_call(['multipathd', 'resize', 'map', dm_name])
+
+
+def rescan_scsi_device(name, sysfs_root=SYSFS_ROOT):
+    """Have the kernel re-read the capacity of the SCSI device ``name``
+    (``sdX``), e.g. after the volume was extended."""
+    rescan = os.path.join(sysfs_root, 'block', name, 'device', 'rescan')
+    with open(rescan, 'w') as rescan_file:
+        rescan_file.write('1')
+
+
+def list_multipath_slaves(device, sysfs_root=SYSFS_ROOT):
+    """Return the SCSI path devices (``sdX``) of multipath ``device``."""
+    try:
+        return sorted(os.listdir(os.path.join(
+            sysfs_root, 'block', os.path.basename(device), 'slaves')))
+    except OSError:
+        return []
+
+
+def delete_scsi_device(name, sysfs_root=SYSFS_ROOT):
+    """Have the kernel delete the SCSI device ``name`` (``sdX``)."""
+    delete = os.path.join(sysfs_root, 'block', name, 'device', 'delete')
+    try:
+        with open(delete, 'w') as delete_file:
+            delete_file.write('1')
+    except (IOError, OSError) as err:
+        # Most likely already gone along with the map
+        eliot.Message.new(info='Unable to delete SCSI device',
+                          device=name, error=str(err)).write(_logger)
+
+
+def delete_scsi_devices(names, sysfs_root=SYSFS_ROOT):
+    """Delete the SCSI devices ``names`` all at once.
+
+    Each deletion blocks until the kernel has torn the device down, so they
+    are done from a thread each rather than one after another.
+    """
+    threads = [threading.Thread(target=delete_scsi_device,
+                                args=(name, sysfs_root))
+               for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def wait_for_multipath_devices(serials, timeout=DEVICE_WAIT_TIMEOUT,
+                               interval=DEVICE_WAIT_INTERVAL,
+                               sysfs_root=SYSFS_ROOT, dev_root=DEV_ROOT,
+                               clock=time.time, sleep=time.sleep):
+    """Wait for the multipath devices of several volumes at once.
+
+    :param serials: Purity serial numbers of the volumes.
+    :return: dictionary of serial to ``/dev/dm-N`` path for every volume
+        whose device showed up before ``timeout`` seconds.
+    """
+    pending = set(serial.lower() for serial in serials)
+    found = {}
+    deadline = clock() + timeout
+    while True:
+        for serial in list(pending):
+            device = find_multipath_device(serial, sysfs_root, dev_root)
+            if device is not None:
+                found[serial] = device
+                pending.discard(serial)
+        if not pending or clock() >= deadline:
+            return found
+        sleep(interval)
+
+
+class DevicePathIndex(object):
+    """Index of the local multipath devices of attached Flocker volumes.
+
+    Entries are keyed by blockdevice_id and remember the Purity serial of
+    the volume, so every hit can be checked against the kernel before it is
+    handed out: the device has to exist and still carry the volume's WWID.
+    A reused dm device can therefore never be returned for the wrong volume.
+    Devices are stored by their ``/dev/dm-N`` name.
+
+    The index is persisted as JSON at ``path`` (if given) so it survives
+    agent restarts, ``load`` then revalidates it in a single pass over the
+    host's multipath devices.
+    """
+    def __init__(self, path=None, sysfs_root=SYSFS_ROOT):
+        self._path = path
+        self._sysfs_root = sysfs_root
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Load the persisted index and rebuild it against the host."""
+        entries = state.load(self._path) or {}
+        with self._lock:
+            self._entries = dict(entries)
+        self.rebuild()
+
+    def rebuild(self, volumes=None):
+        """Refresh every entry from a single scan of the multipath devices.
+
+        Entries whose volume has moved to another dm device are updated,
+        entries whose volume is no longer present are dropped.
+        :param volumes: optional dictionary of the Purity serial of volumes
+            to their blockdevice_id. Those with a device on the host which
+            are not indexed yet, e.g. because the index file was lost, are
+            added.
+        """
+        devices = list_multipath_devices(self._sysfs_root)
+        with self._lock:
+            for blockdevice_id, entry in list(self._entries.items()):
+                device = devices.get(entry['serial'])
+                if device is None:
+                    del self._entries[blockdevice_id]
+                else:
+                    entry['device'] = device
+            indexed = set(entry['serial'] for entry in self._entries.values())
+            for serial, blockdevice_id in (volumes or {}).items():
+                serial = serial.lower()
+                if serial in devices and serial not in indexed:
+                    self._entries[blockdevice_id] = {
+                        'serial': serial,
+                        'device': devices[serial],
+                    }
+            self._save()
+
+    def lookup(self, blockdevice_id):
+        """Return the validated device path of ``blockdevice_id``.
+
+        :return: the device path, or ``None`` if it is not indexed or the
+            indexed device no longer belongs to the volume.
+        """
+        with self._lock:
+            entry = self._entries.get(blockdevice_id)
+            if entry is not None:
+                if self._is_valid(entry):
+                    self.hits += 1
+                    return entry['device']
+                del self._entries[blockdevice_id]
+                self._save()
+            self.misses += 1
+            return None
+
+    def find_serial(self, serial):
+        """Return the blockdevice_id indexed for ``serial``, or ``None``."""
+        serial = serial.lower()
+        with self._lock:
+            for blockdevice_id, entry in self._entries.items():
+                if entry['serial'] == serial:
+                    return blockdevice_id
+        return None
+
+    def add(self, blockdevice_id, serial, device):
+        """Record that ``blockdevice_id`` (``serial``) is at ``device``."""
+        with self._lock:
+            self._entries[blockdevice_id] = {
+                'serial': serial.lower(),
+                'device': os.path.realpath(device),
+            }
+            self._save()
+
+    def rename(self, blockdevice_id, new_blockdevice_id):
+        """Move the entry of ``blockdevice_id`` to ``new_blockdevice_id``,
+        after the volume was renamed."""
+        with self._lock:
+            entry = self._entries.pop(blockdevice_id, None)
+            if entry is not None:
+                self._entries[new_blockdevice_id] = entry
+                self._save()
+
+    def remove(self, blockdevice_id):
+        """Forget ``blockdevice_id``, e.g. because it was detached."""
+        with self._lock:
+            if self._entries.pop(blockdevice_id, None) is not None:
+                self._save()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _is_valid(self, entry):
+        # The dm device only has a uuid in sysfs while it exists, so this
+        # covers both the device going away and it being reused.
+        return serial_from_device(entry['device'],
+                                  self._sysfs_root) == entry['serial']
+
+    def _save(self):
+        state.save(self._path, self._entries)
+
+
+def parse_uevent(data):
+    """Return the environment of a kernel uevent message as a dictionary.
+
+    Kernel messages are ``action@devpath`` followed by NUL separated
+    ``KEY=value`` pairs.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    event = {}
+    for field in data.split('\0'):
+        key, sep, value = field.partition('=')
+        if sep:
+            event[key] = value
+    return event
+
+
+class NetlinkUeventSource(object):
+    """Kernel uevents read from a netlink socket.
+
+    :raises socket.error: If the socket can't be opened, e.g. because the
+        platform has no netlink.
+    """
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                     NETLINK_KOBJECT_UEVENT)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                UEVENT_BUFFER_SIZE)
+        # Port id 0 lets the kernel pick one
+        self._socket.bind((0, UEVENT_KERNEL_GROUP))
+
+    def receive(self, timeout=None):
+        """Return the next uevent, or ``None`` after ``timeout`` seconds."""
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        if not readable:
+            return None
+        return parse_uevent(self._socket.recv(UEVENT_BUFFER_SIZE))
+
+    def close(self):
+        self._socket.close()
+
+
+class QueueUeventSource(object):
+    """Uevents which are ``emit``-ed by hand, for tests."""
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def emit(self, **event):
+        self._queue.put(event)
+
+    def receive(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+
+def is_multipath_event(event):
+    """Return whether ``event`` may concern a Purity multipath device."""
+    if event.get('SUBSYSTEM') != 'block' or \
+            not event.get('DEVNAME', '').startswith('dm-'):
+        return False
+    dm_uuid = event.get('DM_UUID')
+    return dm_uuid is None or serial_from_dm_uuid(dm_uuid) is not None
+
+
+class DeviceWatcher(object):
+    """Wait for multipath devices by listening to kernel uevents.
+
+    A background thread reads the uevents of ``source`` and wakes up the
+    waiters whenever a device-mapper device appears or changes, so they
+    find their devices as soon as multipathd has set them up instead of at
+    the next poll. Devices are still only returned once
+    ``find_multipath_device`` confirms them, and are looked for every
+    ``recheck_interval`` seconds regardless in case an event was missed. If
+    ``source`` fails the watcher falls back to polling.
+
+    :param source: ``NetlinkUeventSource`` or another object with a
+        ``receive(timeout)`` method returning uevent dictionaries.
+    :param wait: Called with the watcher's condition and a timeout to wait
+        for uevents, like ``Condition.wait``.
+    """
+    def __init__(self, source, sysfs_root=SYSFS_ROOT, dev_root=DEV_ROOT,
+                 recheck_interval=DEVICE_RECHECK_INTERVAL, clock=time.time,
+                 wait=lambda condition, timeout: condition.wait(timeout)):
+        self._source = source
+        self._sysfs_root = sysfs_root
+        self._dev_root = dev_root
+        self._recheck_interval = recheck_interval
+        self._clock = clock
+        self._wait = wait
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._thread = None
+        self._failed = False
+
+    def start(self):
+        """Start listening for uevents, if not done already."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='purestorage-uevents')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                event = self._source.receive()
+            except Exception as err:
+                eliot.Message.new(warning='Unable to read uevents, polling '
+                                          'for devices instead',
+                                  error=str(err)).write(_logger)
+                with self._condition:
+                    self._failed = True
+                    self._condition.notify_all()
+                return
+            if event is not None:
+                self.handle_uevent(event)
+
+    def handle_uevent(self, event):
+        """Wake up the waiters if ``event`` concerns a multipath device."""
+        if is_multipath_event(event):
+            with self._condition:
+                self._generation += 1
+                self._condition.notify_all()
+
+    def wait_for_multipath_devices(self, serials, timeout=DEVICE_WAIT_TIMEOUT):
+        """Like ``wait_for_multipath_devices``, but woken up by uevents."""
+        self.start()
+        pending = set(serial.lower() for serial in serials)
+        found = {}
+        deadline = self._clock() + timeout
+        while True:
+            with self._condition:
+                generation = self._generation
+            for serial in list(pending):
+                device = find_multipath_device(serial, self._sysfs_root,
+                                               self._dev_root)
+                if device is not None:
+                    found[serial] = device
+                    pending.discard(serial)
+            remaining = deadline - self._clock()
+            if not pending or remaining <= 0:
+                return found
+            with self._condition:
+                if self._generation == generation:
+                    interval = (DEVICE_WAIT_INTERVAL if self._failed
+                                else self._recheck_interval)
+                    self._wait(self._condition, min(remaining, interval))
@@ -0,0 +1,149 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Eradication of destroyed volumes.
+
+Purity keeps destroyed volumes for 24 hours before eradicating them, and
+until then they hold on to their capacity and their name. The
+``EradicationScheduler`` eradicates the volumes destroyed by the driver a
+configurable time after they were destroyed instead.
+"""
+
+import threading
+import time
+
+import eliot
+import purestorage
+
+from purestorage_flasharray_flocker_driver import state
+
+_logger = eliot.Logger()
+
+# Eradication is tried again this long after it failed.
+RETRY_INTERVAL = 60  # seconds
+
+# Purity errors meaning there is nothing (left) to eradicate.
+ERR_MSG_NOT_EXIST = 'does not exist'
+ERR_MSG_NOT_DESTROYED = 'not destroyed'
+
+
+class EradicationScheduler(object):
+    """Eradicate destroyed volumes ``delay`` seconds after they were destroyed.
+
+    Scheduled volumes are persisted at ``path`` (if given), so eradications
+    due while the agent was down are carried out once it is back.
+
+    :param array: ``purestorage.FlashArray`` (or client pool).
+    :param delay: Seconds to keep destroyed volumes recoverable for.
+    :param background: Whether to eradicate from a background thread, or
+        only when ``eradicate_due`` is called.
+    """
+    def __init__(self, array, delay, path=None, background=True,
+                 clock=time.time):
+        self._array = array
+        self._delay = delay
+        self._path = path
+        self._background = background
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._pending = dict(state.load(path) or {})
+        self._thread = None
+        if self._pending:
+            self._start()
+
+    def _start(self):
+        if not self._background or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name='purestorage-eradication')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _save(self):
+        state.save(self._path, self._pending)
+
+    def schedule(self, vol_names):
+        """Schedule the eradication of the destroyed volumes ``vol_names``."""
+        if not vol_names:
+            return
+        with self._condition:
+            due = self._clock() + self._delay
+            for name in vol_names:
+                self._pending[name] = due
+            self._save()
+            self._start()
+            self._condition.notify()
+
+    def pending(self):
+        """Return the scheduled volumes and when they are due."""
+        with self._condition:
+            return dict(self._pending)
+
+    def eradicate_now(self, vol_name):
+        """Eradicate ``vol_name`` straight away if it is scheduled.
+
+        :return: whether the volume was scheduled.
+        """
+        with self._condition:
+            if self._pending.pop(vol_name, None) is None:
+                return False
+            self._save()
+        self._eradicate(vol_name)
+        return True
+
+    def eradicate_due(self):
+        """Eradicate all volumes whose time has come.
+
+        :return: seconds until the next volume is due, or ``None``.
+        """
+        with self._condition:
+            now = self._clock()
+            due = sorted(name for name, when in self._pending.items()
+                         if when <= now)
+        for name in due:
+            retry = not self._eradicate(name)
+            with self._condition:
+                if retry:
+                    self._pending[name] = self._clock() + RETRY_INTERVAL
+                else:
+                    self._pending.pop(name, None)
+        with self._condition:
+            if due:
+                self._save()
+            if not self._pending:
+                return None
+            return max(0, min(self._pending.values()) - self._clock())
+
+    def _eradicate(self, vol_name):
+        """Eradicate ``vol_name``, return ``False`` if it should be retried."""
+        try:
+            self._array.eradicate_volume(vol_name)
+        except purestorage.PureHTTPError as err:
+            if err.code == 400 and (ERR_MSG_NOT_EXIST in err.text or
+                                    ERR_MSG_NOT_DESTROYED in err.text):
+                # Already eradicated, or recovered by an administrator
+                return True
+            eliot.Message.new(warning='Unable to eradicate volume',
+                              volume=vol_name, error=str(err)).write(_logger)
+            return False
+        except purestorage.PureError as err:
+            eliot.Message.new(warning='Unable to eradicate volume',
+                              volume=vol_name, error=str(err)).write(_logger)
+            return False
+        eliot.Message.new(info='Eradicated volume',
+                          volume=vol_name).write(_logger)
+        return True
+
+    def _run(self):
+        while True:
+            self.eradicate_due()
+            with self._condition:
+                # Check again under the lock so a newly scheduled volume
+                # can't be missed.
+                if not self._pending:
+                    self._condition.wait()
+                else:
+                    wait = min(self._pending.values()) - self._clock()
+                    if wait > 0:
+                        self._condition.wait(wait)
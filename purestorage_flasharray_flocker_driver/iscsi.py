@@ -0,0 +1,148 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Long-lived iSCSI sessions to the FlashArray portals.
+
+os-brick discovers and logs in to the targets of a volume on every attach,
+and logs out again on detach once no LUN uses a session, so attaching pays
+for the logins over and over. ``SessionKeeper`` instead logs in to every
+portal of the array once, marks the node records for automatic login at
+boot, and checks every so often that the sessions are still there, logging
+in again where one dropped. Attaching a volume then only has to scan for its
+LUN on the existing sessions.
+"""
+
+import subprocess
+import threading
+
+import eliot
+
+from purestorage_flasharray_flocker_driver import devices
+
+_logger = eliot.Logger()
+
+DEFAULT_CHECK_INTERVAL = 30  # seconds
+
+# iscsiadm exit status when the session already exists
+ISCSI_ERR_SESS_EXISTS = 15
+
+
+def run_iscsiadm(*args):
+    """Run ``iscsiadm`` with ``args``.
+
+    :raises subprocess.CalledProcessError: If it fails.
+    """
+    subprocess.check_output(('iscsiadm',) + args, stderr=subprocess.STDOUT)
+
+
+class SessionKeeper(object):
+    """Keep an iSCSI session to each of the array's portals.
+
+    :param get_ports: callable returning the array's iSCSI ports, as
+        dictionaries with their target ``iqn`` and ``portal``.
+    :param chap: optional ``(username, password)`` to log in with.
+    :param interval: seconds between checks of the sessions.
+    :param run: callable running ``iscsiadm`` with its arguments, by default
+        ``run_iscsiadm``.
+    """
+    def __init__(self, get_ports, sysfs_root=devices.SYSFS_ROOT, chap=None,
+                 interval=DEFAULT_CHECK_INTERVAL, run=None):
+        self._get_ports = get_ports
+        self._sysfs_root = sysfs_root
+        self._chap = chap
+        self._interval = interval
+        self._run = run or run_iscsiadm
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Check the sessions now and then every ``interval`` seconds, in
+        the background."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._keep,
+                                            name='purestorage-iscsi-sessions')
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _keep(self):
+        while not self._stopped.is_set():
+            try:
+                self.ensure_sessions()
+            except Exception as err:
+                eliot.Message.new(warning='Unable to check iSCSI sessions',
+                                  error=self._describe(err)).write(_logger)
+            self._stopped.wait(self._interval)
+
+    def ensure_sessions(self):
+        """Log in to every portal without a session.
+
+        :return: list of the sessions to the array's portals, as returned by
+            ``devices.list_iscsi_sessions``, and whether every portal has
+            one.
+        """
+        with self._lock:
+            wanted = set((port['iqn'], port['portal'])
+                         for port in self._get_ports())
+            existing = set((session['target'], session['portal'])
+                           for session
+                           in devices.list_iscsi_sessions(self._sysfs_root))
+            for iqn, portal in sorted(wanted - existing):
+                try:
+                    self._login(iqn, portal)
+                except (subprocess.CalledProcessError, OSError) as err:
+                    eliot.Message.new(warning='Unable to log in to iSCSI '
+                                              'portal',
+                                      target=iqn, portal=portal,
+                                      error=self._describe(err)).write(_logger)
+            sessions = [session for session
+                        in devices.list_iscsi_sessions(self._sysfs_root)
+                        if (session['target'], session['portal']) in wanted]
+        complete = (set((session['target'], session['portal'])
+                        for session in sessions) == wanted)
+        return sessions, complete
+
+    def _describe(self, err):
+        """Return the text of ``err`` for the log.
+
+        A failed ``iscsiadm`` is described by its exit status and output,
+        its command line may hold the CHAP password. The password is masked
+        in the output as well, like os-brick does.
+        """
+        if not isinstance(err, subprocess.CalledProcessError):
+            return str(err)
+        output = err.output or b''
+        if not isinstance(output, str):
+            output = output.decode('utf-8', 'replace')
+        if self._chap and self._chap[1]:
+            output = output.replace(self._chap[1], '***')
+        return 'iscsiadm exited with status {0}: {1}'.format(
+            err.returncode, output.strip())
+
+    def _node(self, iqn, portal, *args):
+        self._run('-m', 'node', '-T', iqn, '-p', portal, *args)
+
+    def _login(self, iqn, portal):
+        eliot.Message.new(info='Logging in to iSCSI portal', target=iqn,
+                          portal=portal).write(_logger)
+        self._node(iqn, portal, '--op', 'new')
+        self._node(iqn, portal, '--op', 'update', '-n', 'node.startup',
+                   '-v', 'automatic')
+        if self._chap:
+            username, password = self._chap
+            for name, value in (('node.session.auth.authmethod', 'CHAP'),
+                                ('node.session.auth.username', username),
+                                ('node.session.auth.password', password)):
+                self._node(iqn, portal, '--op', 'update', '-n', name,
+                           '-v', value)
+        try:
+            self._node(iqn, portal, '--login')
+        except subprocess.CalledProcessError as err:
+            if err.returncode != ISCSI_ERR_SESS_EXISTS:
+                raise
@@ -0,0 +1,133 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Per-phase latency breakdown of the driver's operations from an eliot log.
+
+The driver traces every operation and the phases it is made of as nested
+eliot actions (see ``tracing``). This reads the JSON log of a dataset agent,
+e.g. ``/var/log/flocker/flocker-dataset-agent.log``, pairs the start and end
+message of each of these actions and prints the latency percentiles of every
+phase by where it ran, e.g.
+``detach_volume/detach_volumes/rest:disconnect_host``::
+
+    purestorage-flocker-latency-report /var/log/flocker/*.log
+"""
+
+import argparse
+import json
+import math
+import sys
+
+from purestorage_flasharray_flocker_driver.tracing import ACTION_PREFIX
+
+PERCENTILES = (50, 95, 99)
+STARTED = 'started'
+ENDED = ('succeeded', 'failed')
+
+
+def percentile(values, percent):
+    """Return the nearest-rank ``percent`` percentile of sorted ``values``."""
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def read_phases(lines):
+    """Pair up the start and end messages of the traced actions.
+
+    :param lines: iterable of eliot log lines, lines which are not JSON
+        messages are skipped.
+    :return: dictionary of each phase path to a list of ``(seconds,
+        failed)`` for every time it ran.
+    """
+    running = {}
+    phases = {}
+    for line in lines:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(message, dict):
+            continue
+        action_type = message.get('action_type')
+        status = message.get('action_status')
+        task_uuid = message.get('task_uuid')
+        task_level = message.get('task_level')
+        if action_type is None or status is None or not task_level:
+            continue
+        key = (task_uuid, tuple(task_level[:-1]))
+        if status == STARTED:
+            parent = running.get((task_uuid, tuple(task_level[:-2])))
+            path = None
+            if action_type.startswith(ACTION_PREFIX):
+                path = action_type[len(ACTION_PREFIX):]
+                if parent is not None and parent[0] is not None:
+                    path = parent[0] + '/' + path
+            elif parent is not None:
+                # Keep our phases together across foreign actions
+                path = parent[0]
+                if path is not None:
+                    running[key] = (path, None)
+                continue
+            running[key] = (path, message.get('timestamp'))
+        elif status in ENDED:
+            path, start = running.pop(key, (None, None))
+            if path is None or start is None or 'timestamp' not in message:
+                continue
+            phases.setdefault(path, []).append(
+                (message['timestamp'] - start, status == 'failed'))
+    return phases
+
+
+def format_report(phases):
+    """Return the latency table of ``phases`` as returned by
+    ``read_phases``, in milliseconds."""
+    header = ['phase', 'count', 'failed'] + [
+        'p{0}'.format(percent) for percent in PERCENTILES] + ['max']
+    rows = [header]
+    for path in sorted(phases):
+        seconds = sorted(duration for duration, _ in phases[path])
+        failed = sum(1 for _, failure in phases[path] if failure)
+        rows.append([path, str(len(seconds)), str(failed)] + [
+            '{0:.1f}'.format(1000 * percentile(seconds, percent))
+            for percent in PERCENTILES + (100,)])
+    widths = [max(len(row[column]) for row in rows)
+              for column in range(len(header))]
+    return '\n'.join(
+        '  '.join([row[0].ljust(widths[0])] +
+                  [cell.rjust(width)
+                   for cell, width in zip(row[1:], widths[1:])])
+        for row in rows) + '\n'
+
+
+def main(argv=None, stdin=None, stdout=None):
+    parser = argparse.ArgumentParser(
+        description='Per-phase latency breakdown of the Pure Storage Flocker '
+                    'driver from an eliot log, in milliseconds.')
+    parser.add_argument('logs', nargs='*', default=['-'], metavar='LOG',
+                        help='eliot JSON log files, "-" for stdin '
+                             '(the default)')
+    args = parser.parse_args(argv)
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+
+    def lines():
+        for name in args.logs:
+            if name == '-':
+                for line in stdin:
+                    yield line
+                continue
+            with open(name) as log:
+                for line in log:
+                    yield line
+
+    phases = read_phases(lines())
+    if not phases:
+        stdout.write('No traced operations found.\n')
+        return 1
+    stdout.write(format_report(phases))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Synchronization of concurrent block device operations.
+
+The dataset agent (from the reactor's thread pool) can call into
+the driver from several threads at once. ``KeyedLocks`` serializes the
+operations on the same volume while letting those on different volumes run
+in parallel, and ``SingleFlight`` runs identical requests which arrive while
+one is already in progress only once, handing its result to every caller.
+"""
+
+import contextlib
+import threading
+
+
+class KeyedLocks(object):
+    """Locks by key, e.g. one for each volume, created as they are needed
+    and dropped again once nobody holds or waits for them."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        """Hold the locks of all ``keys`` for the ``with`` block.
+
+        The locks are always taken in the same order, so holding several
+        keys at once can't deadlock with another caller doing the same.
+        """
+        keys = sorted(set(keys))
+        with self._lock:
+            locks = []
+            for key in keys:
+                entry = self._locks.setdefault(key, [threading.Lock(), 0])
+                entry[1] += 1
+                locks.append(entry[0])
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            with self._lock:
+                for key in keys:
+                    entry = self._locks[key]
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self._locks[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key into one.
+
+    :ivar shared: number of calls which were handed the result of a call
+        already in flight instead of running themselves.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, function, *args):
+        """Return ``function(*args)``, unless a call for ``key`` is already
+        in flight, then wait for it and return (or raise) its outcome."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args)
+            return call.result
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,290 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Latency and error metrics of the driver, in the Prometheus text format.
+
+The metrics are kept in memory by a ``Registry`` and can be exported by
+writing them to a file for the node exporter's textfile collector every few
+seconds, by serving them on a local HTTP port, or both.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import eliot
+
+_logger = eliot.Logger()
+
+# Latency buckets in seconds, from a fast REST call to a slow multipath
+# device showing up.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+DEFAULT_EXPORT_INTERVAL = 15  # seconds
+HTTP_ADDRESS = '127.0.0.1'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Names of the metrics recorded by the driver
+REST_SECONDS = 'purestorage_flocker_rest_request_seconds'
+REST_ERRORS = 'purestorage_flocker_rest_errors_total'
+OPERATION_SECONDS = 'purestorage_flocker_operation_seconds'
+OPERATION_ERRORS = 'purestorage_flocker_operation_errors_total'
+INITIATOR_SECONDS = 'purestorage_flocker_initiator_seconds'
+CACHE_HITS = 'purestorage_flocker_cache_hits_total'
+CACHE_MISSES = 'purestorage_flocker_cache_misses_total'
+REST_EVENTS = 'purestorage_flocker_rest_events_total'
+REST_CONCURRENCY = 'purestorage_flocker_rest_concurrency_limit'
+COALESCED_REQUESTS = 'purestorage_flocker_coalesced_requests_total'
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', r'\\')
+                           .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """Monotonically increasing count, per set of labels."""
+    metric_type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.items())]
+
+
+class Histogram(object):
+    """Distribution of observed values, per set of labels."""
+    metric_type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self._buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self._buckets), 0.0, 0]
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long the ``with`` block took, also when it fails."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(_label_key(labels))
+            return entry[2] if entry else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + '_bucket', key,
+                                    cumulative, (('le', _format_value(bound)),)))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, count))
+        return samples
+
+
+class Callback(object):
+    """Metric whose samples are read from elsewhere when it is exported.
+
+    Several callbacks can feed the same metric, e.g. one for each array.
+    """
+    def __init__(self, name, help, metric_type):
+        self.name = name
+        self.help = help
+        self.metric_type = metric_type
+        self._callbacks = []
+
+    def add(self, callback):
+        """Add ``callback``, returning a list of ``(labels, value)``."""
+        self._callbacks.append(callback)
+
+    def samples(self):
+        return [(self.name, _label_key(labels), value)
+                for callback in self._callbacks
+                for labels, value in callback()]
+
+
+class Registry(object):
+    """The metrics of one driver instance."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_add(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def counter(self, name, help):
+        return self._get_or_add(name, lambda: Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get_or_add(name, lambda: Histogram(name, help, buckets))
+
+    def callback(self, name, help, metric_type, callback):
+        self._get_or_add(
+            name, lambda: Callback(name, help, metric_type)).add(callback)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for name, metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as err:
+                eliot.Message.new(warning='Unable to collect metric',
+                                  metric=name, error=str(err)).write(_logger)
+                continue
+            lines.append('# HELP {0} {1}'.format(name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(name, metric.metric_type))
+            for sample in samples:
+                extra = sample[3] if len(sample) > 3 else ()
+                lines.append('{0}{1} {2}'.format(
+                    sample[0], _format_labels(sample[1], extra),
+                    _format_value(sample[2])))
+        return '\n'.join(lines) + '\n'
+
+
+def write_textfile(registry, path):
+    """Atomically replace ``path`` with the current metrics."""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as metrics_file:
+        metrics_file.write(registry.render())
+    os.rename(tmp_path, path)
+
+
+class TextfileExporter(object):
+    """Write the metrics to ``path`` every ``interval`` seconds.
+
+    The file is meant to be picked up by the node exporter's textfile
+    collector, so ``path`` should end in ``.prom``.
+    """
+    def __init__(self, registry, path, interval=DEFAULT_EXPORT_INTERVAL):
+        self._registry = registry
+        self._path = path
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='purestorage-metrics')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                write_textfile(self._registry, self._path)
+            except (IOError, OSError) as err:
+                eliot.Message.new(warning='Unable to write metrics file',
+                                  path=self._path,
+                                  error=str(err)).write(_logger)
+            self._stopped.wait(self._interval)
+
+
+def start_exporters(registry, textfile=None, port=None):
+    """Start exporting the metrics of ``registry`` as configured."""
+    if textfile:
+        TextfileExporter(registry, textfile).start()
+    if port:
+        serve_http(registry, int(port))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(registry, port, address=HTTP_ADDRESS):
+    """Serve the metrics on ``http://<address>:<port>/metrics``.
+
+    The server runs on a daemon thread, it is returned so it can be shut
+    down.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='purestorage-metrics-http')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,356 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Flocker volumes spread over several FlashArrays.
+
+``MultiFlashArrayBlockDeviceAPI`` presents a ``FlashArrayBlockDeviceAPI``
+for each array as a single backend. New volumes are placed on the array with
+the most free space for its current latency, using statistics cached for a
+while, and every other operation goes to the array holding the volume.
+Volume names are made from the dataset id, so they are unique across the
+arrays.
+"""
+
+import os
+import threading
+import time
+
+import eliot
+from zope.interface import implementer
+from flocker.node.agents import blockdevice
+
+from purestorage_flasharray_flocker_driver import metrics
+from purestorage_flasharray_flocker_driver import purestorage_blockdevice
+from purestorage_flasharray_flocker_driver.purestorage_blockdevice import (
+    BatchOperationError, InvalidConfig, parallel_map)
+
+_logger = eliot.Logger()
+
+DEFAULT_STATS_TTL = 60  # seconds
+
+# An array with this much latency (in microseconds) counts as having half its
+# free space when placing volumes.
+REFERENCE_LATENCY = 1000
+
+# Options which can be set for each of the pure_arrays, the others (and the
+# defaults for these) are taken from the top level of the configuration.
+ARRAY_OPTIONS = (
+    'pure_ip', 'pure_api_token', 'pure_storage_protocol',
+    'pure_manage_purity_hosts', 'pure_chap_host_user',
+    'pure_chap_host_password', 'pure_verify_https', 'pure_ssl_cert',
+    'pure_port_cache_ttl', 'pure_api_pool_size', 'pure_api_max_retries',
+    'pure_profiles', 'pure_eradicate_after', 'pure_iscsi_session_interval',
+    'pure_warm_pool_size', 'pure_volume_list_ttl',
+)
+SHARED_OPTIONS = (
+    'pure_state_dir', 'pure_log_level', 'pure_metrics_textfile',
+    'pure_metrics_port',
+)
+
+
+class NoArrayAvailableException(Exception):
+    def __init__(self, size):
+        msg = 'No FlashArray available with {0} bytes of free space.'.format(
+            size)
+        Exception.__init__(self, msg)
+
+
+@implementer(blockdevice.IBlockDeviceAPI)
+@implementer(blockdevice.IProfiledBlockDeviceAPI)
+class MultiFlashArrayBlockDeviceAPI(object):
+    """
+    Implementation of ``IBlockDeviceAPI`` over several FlashArrays.
+
+    Which array holds each volume is remembered from ``list_volumes`` and
+    from creating it, for volumes it doesn't know about all arrays are asked
+    at once.
+    """
+
+    def __init__(self, apis, stats_ttl=DEFAULT_STATS_TTL, clock=time.time):
+        """
+        :param apis: ``FlashArrayBlockDeviceAPI`` of each array, all for the
+            same cluster.
+        :param stats_ttl: Seconds to use the space and performance
+            statistics of an array for before asking for them again.
+        """
+        if not apis:
+            raise InvalidConfig('pure_arrays must list at least one array')
+        self._apis = list(apis)
+        self._stats_ttl = stats_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # blockdevice_id -> api of the array holding the volume
+        self._routes = {}
+        # api -> (expiry time, get_array_stats result)
+        self._stats = {}
+
+    def _vol_name_from_dataset_id(self, dataset_id):
+        return self._apis[0]._vol_name_from_dataset_id(dataset_id)
+
+    def _remember(self, api, blockdevice_id):
+        with self._lock:
+            self._routes[blockdevice_id] = api
+
+    def _forget(self, blockdevice_id):
+        with self._lock:
+            self._routes.pop(blockdevice_id, None)
+
+    def _route(self, blockdevice_id):
+        """Return the api of the array holding ``blockdevice_id``.
+
+        :raises UnknownVolume: If none of the arrays has the volume.
+        """
+        with self._lock:
+            api = self._routes.get(blockdevice_id)
+        if api is not None:
+            return api
+        results = parallel_map(lambda api: api.has_volume(blockdevice_id),
+                               self._apis)
+        errors = []
+        for api, (owned, err) in zip(self._apis, results):
+            if err is not None:
+                errors.append(err)
+            elif owned:
+                self._remember(api, blockdevice_id)
+                return api
+        if errors:
+            # It may well be on the array we couldn't ask
+            raise errors[0]
+        raise blockdevice.UnknownVolume(blockdevice_id)
+
+    def _to_array_instance(self, api, attach_to):
+        """Translate our ``compute_instance_id`` to the one of ``api``."""
+        if attach_to == self.compute_instance_id():
+            return api.compute_instance_id()
+        return attach_to
+
+    def _from_array_volume(self, api, volume):
+        """Translate ``attached_to`` of ``api``'s ``volume`` to ours."""
+        attached_to = volume.attached_to
+        if attached_to is not None and attached_to == api.compute_instance_id():
+            attached_to = self.compute_instance_id()
+        return blockdevice.BlockDeviceVolume(
+            blockdevice_id=volume.blockdevice_id,
+            size=volume.size,
+            attached_to=attached_to,
+            dataset_id=volume.dataset_id,
+        )
+
+    def _array_stats(self, api):
+        now = self._clock()
+        with self._lock:
+            cached = self._stats.get(api)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        stats = api.get_array_stats()
+        with self._lock:
+            self._stats[api] = (now + self._stats_ttl, stats)
+        return stats
+
+    def _place(self, size):
+        """Pick the array for a new volume of ``size`` bytes.
+
+        Arrays are scored by their free space, divided by how much their
+        latency exceeds ``REFERENCE_LATENCY``. The size of the volume counts
+        against the cached free space of the chosen array until its
+        statistics are refreshed, so a burst of new volumes spreads out.
+        :raises NoArrayAvailableException: If no array has ``size`` bytes
+            free.
+        """
+        best, best_score = None, None
+        results = parallel_map(self._array_stats, self._apis)
+        with self._lock:
+            for api, (stats, err) in zip(self._apis, results):
+                if err is not None:
+                    eliot.Message.new(warning='Unable to get array statistics',
+                                      array=api.array_name,
+                                      error=str(err)).write(_logger)
+                    continue
+                free = stats['capacity'] - stats['total']
+                if free < size:
+                    continue
+                latency = max(stats['usec_per_read_op'],
+                              stats['usec_per_write_op'])
+                score = free / (1.0 + float(latency) / REFERENCE_LATENCY)
+                if best_score is None or score > best_score:
+                    best, best_score = api, score
+            if best is None:
+                raise NoArrayAvailableException(size)
+            self._stats[best][1]['total'] += size
+        eliot.Message.new(info='Placing volume', array=best.array_name,
+                          size=size).write(_logger)
+        return best
+
+    def _batch(self, blockdevice_ids, operation):
+        """Run ``operation(api, ids)`` for the volumes of each array.
+
+        The arrays are handled concurrently.
+        :return: dictionary of the exception for each failed volume, and
+            list of the ``(api, result)`` of each array.
+        """
+        failures = {}
+        groups = {}
+        for blockdevice_id in blockdevice_ids:
+            try:
+                api = self._route(blockdevice_id)
+            except Exception as err:
+                failures[blockdevice_id] = err
+                continue
+            groups.setdefault(api, []).append(blockdevice_id)
+        apis = list(groups)
+        results = []
+        for api, (result, err) in zip(
+                apis, parallel_map(lambda api: operation(api, groups[api]),
+                                   apis)):
+            if isinstance(err, BatchOperationError):
+                failures.update(err.failures)
+                result = err.results
+            elif err is not None:
+                for blockdevice_id in groups[api]:
+                    failures[blockdevice_id] = err
+                continue
+            results.append((api, result))
+        return failures, results
+
+    def compute_instance_id(self):
+        return self._apis[0].compute_instance_id()
+
+    def allocation_unit(self):
+        return self._apis[0].allocation_unit()
+
+    def create_volume(self, dataset_id, size):
+        api = self._place(size)
+        volume = api.create_volume(dataset_id, size)
+        self._remember(api, volume.blockdevice_id)
+        return volume
+
+    def create_volume_with_profile(self, dataset_id, size, profile_name):
+        api = self._place(size)
+        volume = api.create_volume_with_profile(dataset_id, size,
+                                                profile_name)
+        self._remember(api, volume.blockdevice_id)
+        return volume
+
+    def clone_volume(self, source_dataset_id, dataset_id):
+        """Clone on the array holding the source, see
+        ``FlashArrayBlockDeviceAPI.clone_volume``."""
+        api = self._route(self._vol_name_from_dataset_id(source_dataset_id))
+        volume = api.clone_volume(source_dataset_id, dataset_id)
+        self._remember(api, volume.blockdevice_id)
+        return volume
+
+    def list_volume_limits(self):
+        limits = {}
+        for result, err in parallel_map(lambda api: api.list_volume_limits(),
+                                        self._apis):
+            if err is not None:
+                raise err
+            limits.update(result)
+        return limits
+
+    def destroy_volume(self, blockdevice_id):
+        self._route(blockdevice_id).destroy_volume(blockdevice_id)
+        self._forget(blockdevice_id)
+
+    def destroy_volumes(self, blockdevice_ids):
+        failures, _ = self._batch(
+            blockdevice_ids, lambda api, ids: api.destroy_volumes(ids))
+        for blockdevice_id in blockdevice_ids:
+            if blockdevice_id not in failures:
+                self._forget(blockdevice_id)
+        if failures:
+            raise BatchOperationError(failures, [])
+
+    def attach_volume(self, blockdevice_id, attach_to):
+        api = self._route(blockdevice_id)
+        return self._from_array_volume(
+            api, api.attach_volume(blockdevice_id,
+                                   self._to_array_instance(api, attach_to)))
+
+    def attach_volumes(self, blockdevice_ids, attach_to):
+        failures, results = self._batch(
+            blockdevice_ids,
+            lambda api, ids: api.attach_volumes(
+                ids, self._to_array_instance(api, attach_to)))
+        attached = {}
+        for api, volumes in results:
+            for volume in volumes:
+                attached[volume.blockdevice_id] = self._from_array_volume(
+                    api, volume)
+        volumes = [attached[blockdevice_id] for blockdevice_id
+                   in blockdevice_ids if blockdevice_id in attached]
+        if failures:
+            raise BatchOperationError(failures, volumes)
+        return volumes
+
+    def detach_volume(self, blockdevice_id):
+        self._route(blockdevice_id).detach_volume(blockdevice_id)
+
+    def detach_volumes(self, blockdevice_ids):
+        failures, _ = self._batch(
+            blockdevice_ids, lambda api, ids: api.detach_volumes(ids))
+        if failures:
+            raise BatchOperationError(failures, [])
+
+    def list_volumes(self):
+        """
+        Return the volumes of all arrays, listed concurrently.
+        """
+        routes = {}
+        volumes = []
+        for api, (result, err) in zip(
+                self._apis,
+                parallel_map(lambda api: api.list_volumes(), self._apis)):
+            if err is not None:
+                # Leaving out the volumes of an array would make Flocker
+                # think they are gone.
+                raise err
+            for volume in result:
+                routes[volume.blockdevice_id] = api
+                volumes.append(self._from_array_volume(api, volume))
+        with self._lock:
+            self._routes = routes
+        return volumes
+
+    def get_device_path(self, blockdevice_id):
+        return self._route(blockdevice_id).get_device_path(blockdevice_id)
+
+
+def multi_from_configuration(cluster_id, pure_arrays,
+                             pure_array_stats_ttl=None, **options):
+    """
+    :param cluster_id: Flocker cluster id.
+    :param pure_arrays: List of dictionaries with the options of each array,
+        at least ``pure_ip`` and ``pure_api_token``. Options missing from
+        them are taken from ``options``.
+    :param pure_array_stats_ttl: Seconds to cache the space and performance
+        statistics placement is based on.
+    :param options: The other ``pure_*`` options of the configuration.
+    :return: MultiFlashArrayBlockDeviceAPI object
+    """
+    defaults = dict((name, options.get(name)) for name in ARRAY_OPTIONS)
+    shared = dict((name, options.get(name)) for name in SHARED_OPTIONS)
+    state_dir = (shared.pop('pure_state_dir') or
+                 purestorage_blockdevice.DEFAULT_STATE_DIR)
+    registry = metrics.Registry()
+    apis = []
+    for array in pure_arrays:
+        unknown = set(array) - set(ARRAY_OPTIONS)
+        if unknown:
+            raise InvalidConfig('pure_arrays can not set {0}'.format(
+                ', '.join(sorted(unknown))))
+        array_options = dict(defaults)
+        array_options.update(array)
+        array_options.update(shared)
+        apis.append(purestorage_blockdevice.pure_from_configuration(
+            cluster_id,
+            pure_state_dir=os.path.join(state_dir,
+                                        str(array_options['pure_ip'])),
+            metrics_registry=registry,
+            **array_options))
+    metrics.start_exporters(registry, shared['pure_metrics_textfile'],
+                            shared['pure_metrics_port'])
+    if pure_array_stats_ttl is None:
+        pure_array_stats_ttl = DEFAULT_STATS_TTL
+    return MultiFlashArrayBlockDeviceAPI(apis, stats_ttl=pure_array_stats_ttl)
@@ -3,31 +3,89 @@
 # See LICENSE file for details..
 
 import base64
+import calendar
+import collections
+import contextlib
+import functools
+import hashlib
+import hmac
 import json
+import logging
 import os
 import re
 import platform
 import socket
+import threading
+import time
 import uuid
 
 import eliot
-from oslo_log import log as logging
 import purestorage
 from twisted.python import filepath
 from zope.interface import implementer
 from flocker.node.agents import blockdevice
 
+from purestorage_flasharray_flocker_driver import client
+from purestorage_flasharray_flocker_driver import devices
+from purestorage_flasharray_flocker_driver import eradication
+from purestorage_flasharray_flocker_driver import iscsi
+from purestorage_flasharray_flocker_driver import locking
+from purestorage_flasharray_flocker_driver import metrics
+from purestorage_flasharray_flocker_driver import state
+from purestorage_flasharray_flocker_driver import tracing
+from purestorage_flasharray_flocker_driver import warm_pool
+
 
 # Eliot is transitioning away from the "Logger instances all over the place"
 # approach.  And it's hard to put Logger instances on PRecord subclasses which
 # we have a lot of.  So just use this global logger for now.
 _logger = eliot.Logger()
 
+LOG_LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+}
+DEFAULT_LOG_LEVEL = 'INFO'
+
+# Loops over every volume or host only log details for this many items,
+# followed by a summary.
+LOG_SAMPLE_SIZE = 10
+
+# Level of the os-brick messages logged, see set_log_level
+_log_threshold = None
+
+
+def set_log_level(name):
+    """Log os-brick messages of level ``name`` and above as well.
+
+    os-brick logs through a single proxy for the whole process, so with
+    several APIs (e.g. with ``pure_arrays``) it logs what the most verbose
+    one asks for.
+    """
+    global _log_threshold
+    level = LOG_LEVELS[name.upper()]
+    if _log_threshold is None or level < _log_threshold:
+        _log_threshold = level
+
+
+def log_enabled(level):
+    """Return whether os-brick messages of ``level`` are logged."""
+    if _log_threshold is None:
+        return level >= LOG_LEVELS[DEFAULT_LOG_LEVEL]
+    return level >= _log_threshold
+
+
 class EliotOsloLogProxy(object):
     """Simple proxy to forward log messages to eliot.
 
     We will patch this in to be used instead of the oslo.log stuff that is
     currently relied upon for os-brick.
+
+    Messages below the level set with ``set_log_level`` are dropped before
+    their arguments are formatted, so disabled levels cost next to nothing.
     """
     def __init__(self, logger, name):
         self._logger = logger
@@ -37,43 +95,51 @@ class EliotOsloLogProxy(object):
         eliot.Message.new(source=self._name, **msg).write(self._logger)
 
     def _format(self, msg, args):
-        return msg % args
+        # Same as the logging module: a single dict argument is a mapping.
+        if len(args) == 1 and isinstance(args[0], dict):
+            args = args[0]
+        try:
+            return msg % args
+        except (TypeError, ValueError, KeyError):
+            return '{0} {1!r}'.format(msg, args)
+
+    def _emit(self, level, key, msg, args):
+        if not log_enabled(level):
+            return
+        if args and msg:
+            msg = self._format(msg, args)
+        self._log(**{key: msg})
+
+    def isEnabledFor(self, level):
+        return log_enabled(level)
 
     def log(self, level, msg, *args, **kwargs):
+        if not log_enabled(level):
+            return
         if args and msg:
-            msg = self._format(msg, *args)
+            msg = self._format(msg, args)
         self._log(level=level, msg=msg)
 
     def debug(self, msg, *args, **kwargs):
-        if args and msg:
-            msg = self._format(msg, *args)
-        self._log(debug=msg)
+        self._emit(logging.DEBUG, 'debug', msg, args)
 
     def info(self, msg, *args, **kwargs):
-        if args and msg:
-            msg = self._format(msg, *args)
-        self._log(info=msg)
+        self._emit(logging.INFO, 'info', msg, args)
 
     def warning(self, msg, *args, **kwargs):
-        if args and msg:
-            msg = self._format(msg, *args)
-        self._log(warning=msg)
+        self._emit(logging.WARNING, 'warning', msg, args)
 
     def error(self, msg, *args, **kwargs):
-        if args and msg:
-            msg = self._format(msg, *args)
-        self._log(error=msg)
+        self._emit(logging.ERROR, 'error', msg, args)
 
     def critical(self, msg, *args, **kwargs):
-        if args and msg:
-            msg = self._format(msg, *args)
-        self._log(critical=msg)
+        self._emit(logging.CRITICAL, 'critical', msg, args)
 
     def exception(self, msg, *args, **kwargs):
+        if not log_enabled(logging.ERROR):
+            return
         eliot.write_traceback()
-        if args and msg:
-            msg = self._format(msg, *args)
-        self._log(exception=msg)
+        self._emit(logging.ERROR, 'exception', msg, args)
 
     def __getattr__(self, name):
         """If we are called for anything else just ignore it..."""
@@ -89,20 +155,71 @@ class EliotOsloLogProxy(object):
 def get_logger_proxy(name, *args, **kwargs):
     return EliotOsloLogProxy(_logger, name)
 
-# TODO(patrickeast): See if there is a better way to intercept the os-brick logging...
-# Until then we are going to just patch the logging module that os_brick will
-# try and use. This has to be done before we import the connector.
-logging.getLogger = get_logger_proxy
-from os_brick.initiator import connector
+_os_brick_lock = threading.Lock()
+_os_brick_connector = []
+
+
+def os_brick_connector():
+    """Return the ``os_brick.initiator.connector`` module.
+
+    os-brick and oslo.log are expensive to import, so this only happens the
+    first time a volume is actually connected or disconnected.
+    """
+    with _os_brick_lock:
+        if not _os_brick_connector:
+            from oslo_log import log as logging
+            # TODO(patrickeast): See if there is a better way to intercept the os-brick logging...
+            # Until then we are going to just patch the logging module that os_brick will
+            # try and use. This has to be done before we import the connector.
+            logging.getLogger = get_logger_proxy
+            from os_brick.initiator import connector
+            _os_brick_connector.append(connector)
+        return _os_brick_connector[0]
 
 MiB = 1048576  # bytes
 
 PURE_ALLOCATION_UNIT = 1 * MiB
 PURE_BASE_PREFIX = 'flocker'
+# Spare volumes are created this small and extended when they are used
+WARM_POOL_VOLUME_SIZE = PURE_ALLOCATION_UNIT
+# Spare volumes connected to no node are only destroyed once they are this
+# old, until then the node which made them may still be connecting them.
+SPARE_VOLUME_GRACE_PERIOD = 600  # seconds
 
 FIBRE_CHANNEL = 'FIBRE_CHANNEL'
 ISCSI = 'ISCSI'
 
+DEFAULT_PORT_CACHE_TTL = 300  # seconds
+DEFAULT_VOLUME_LIST_TTL = 5  # seconds
+DEFAULT_API_POOL_SIZE = 4
+DEFAULT_API_MAX_RETRIES = client.DEFAULT_MAX_RETRIES
+DEFAULT_BATCH_CONCURRENCY = 8
+
+# Constructing FlashArrayBlockDeviceAPI should not take longer than this, it
+# only has to set up the REST client (os-brick and the initiator side are set
+# up on first use). Slower start ups are logged as a warning.
+COLD_START_BUDGET = 2.0  # seconds
+DEFAULT_STATE_DIR = '/var/lib/flocker/purestorage'
+DEVICE_INDEX_FILE = 'device_index.json'
+PURITY_HOST_FILE = 'purity_host.json'
+CLAIMED_VOLUMES_FILE = 'claimed_volumes.json'
+SECRET_FILE = 'secret.json'
+ERADICATION_FILE = 'eradication.json'
+
+# QoS limits of the volumes created for Flocker's storage profiles, more can
+# be added (or these changed) with pure_profiles. Bandwidth is in bytes per
+# second, no limit is set where one is missing.
+QOS_LIMITS = ('bandwidth_limit', 'iops_limit')
+DEFAULT_PROFILES = {
+    'gold': {},
+    'silver': {'bandwidth_limit': 500 * MiB, 'iops_limit': 50000},
+    'bronze': {'bandwidth_limit': 100 * MiB, 'iops_limit': 10000},
+}
+
+# Array statistics placement decisions are based on
+ARRAY_STATS = ('capacity', 'total', 'usec_per_read_op', 'usec_per_write_op',
+               'queue_depth')
+
 # Purity REST API Error message string matching helpers...
 ERR_MSG_ALREADY_EXISTS = 'already exists'
 ERR_MSG_NOT_EXIST = 'does not exist'
@@ -124,11 +241,262 @@ class UnknownStorageProtocolException(Exception):
         msg = 'Unknown storage protocol "{0}".'.format(protocol)
         Exception.__init__(self, msg)
 
+class UnknownProfileException(Exception):
+    def __init__(self, profile_name):
+        msg = 'Unknown storage profile "{0}".'.format(profile_name)
+        Exception.__init__(self, msg)
+
+
+class BatchOperationError(Exception):
+    """Some of the volumes of a batch operation failed.
+
+    The operation is still carried out for all other volumes.
+
+    :ivar failures: dictionary of blockdevice_id to the exception raised for
+        that volume.
+    :ivar results: the results for the volumes which succeeded.
+    """
+    def __init__(self, failures, results):
+        self.failures = failures
+        self.results = results
+        msg = 'Batch operation failed for volumes: {0}.'.format(
+            ', '.join(sorted(failures)))
+        Exception.__init__(self, msg)
+
+
+def parallel_map(function, items, concurrency=DEFAULT_BATCH_CONCURRENCY):
+    """Call ``function`` on every item using up to ``concurrency`` threads.
+
+    :return: list of ``(result, exception)`` pairs in the order of ``items``,
+        one of the two is always ``None``.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    work = iter(enumerate(items))
+    function = tracing.in_current_action(function)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    index, item = next(work)
+                except StopIteration:
+                    return
+            try:
+                results[index] = (function(item), None)
+            except Exception as err:
+                results[index] = (None, err)
+
+    if len(items) <= 1:
+        worker()
+        return results
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class PortTopologyCache(object):
+    """Cache of the FlashArray target ports.
+
+    Target ports (iSCSI portals/IQNs and FC WWNs) almost never change, so
+    the result of ``list_ports`` is kept for ``ttl`` seconds rather than
+    being fetched from the array on every attach and detach. Callers should
+    ``invalidate`` it whenever the topology looks stale, e.g. when the
+    initiator fails to connect to the targets we handed it.
+    """
+    def __init__(self, array, ttl, clock=time.time):
+        self._array = array
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._ports = None
+        self._expires = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_ports(self):
+        """Return the list of array port descriptions."""
+        with self._lock:
+            now = self._clock()
+            if self._ports is not None and now < self._expires:
+                self.hits += 1
+                return self._ports
+            self.misses += 1
+            self._ports = self._array.list_ports()
+            self._expires = now + self._ttl
+            return self._ports
+
+    def get_iscsi_ports(self):
+        """Return list of iSCSI-enabled port descriptions."""
+        return [port for port in self.get_ports() if port['iqn']]
+
+    def get_wwns(self):
+        """Return list of wwns from the array"""
+        return [port['wwn'] for port in self.get_ports() if port['wwn']]
+
+    def invalidate(self):
+        """Drop the cached ports so the next lookup goes to the array."""
+        with self._lock:
+            self._ports = None
+            self._expires = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class FcZoningCache(object):
+    """Cache of which array FC ports are zoned to which HBAs of this node.
+
+    Worked out from the remote ports in sysfs which carry one of the array's
+    WWNs, and kept for ``ttl`` seconds like the array ports themselves.
+    """
+    def __init__(self, port_cache, ttl, sysfs_root=devices.SYSFS_ROOT,
+                 clock=time.time):
+        self._port_cache = port_cache
+        self._ttl = ttl
+        self._sysfs_root = sysfs_root
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._paths = None
+        self._expires = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_paths(self):
+        """Return the paths from this node to the array.
+
+        :return: list of dictionaries with the local ``initiator`` WWN, the
+            array's ``target`` WWN, and the SCSI ``host``, ``channel`` and
+            ``target_id`` the array port's LUNs appear on.
+        """
+        with self._lock:
+            now = self._clock()
+            if self._paths is not None and now < self._expires:
+                self.hits += 1
+                return self._paths
+            self.misses += 1
+            wwns = set(devices.normalize_wwn(wwn)
+                       for wwn in self._port_cache.get_wwns())
+            hosts = devices.list_fc_hosts(self._sysfs_root)
+            self._paths = [
+                {'initiator': hosts[rport['host']],
+                 'target': rport['port_name'],
+                 'host': rport['host'],
+                 'channel': rport['channel'],
+                 'target_id': rport['target_id']}
+                for rport in devices.list_fc_remote_ports(self._sysfs_root)
+                if rport['port_name'] in wwns and rport['host'] in hosts
+                and rport['port_state'] == devices.FC_PORT_ONLINE]
+            self._expires = now + self._ttl
+            return self._paths
+
+    def invalidate(self):
+        """Drop the cached paths so the next lookup reads sysfs again."""
+        with self._lock:
+            self._paths = None
+            self._expires = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class VolumeListCache(object):
+    """Snapshot of the managed volumes, as listed by ``list_volumes``.
+
+    The agent lists the volumes over and over while it converges, so the
+    snapshot is kept for ``ttl`` seconds, and callers finding it expired
+    share a single refresh. Changes made through this node are written
+    through to the snapshot instead of dropping it; changes made elsewhere,
+    e.g. other nodes attaching volumes, show up once it expires.
+    :param fetch: callable returning the list of ``BlockDeviceVolume``.
+    """
+    def __init__(self, fetch, ttl, clock=time.time):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._flight = locking.SingleFlight()
+        self._volumes = None
+        self._expires = 0
+        # Bumped by every write, a refresh which overlapped one is not kept
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        """Return the list of ``BlockDeviceVolume``."""
+        with self._lock:
+            if self._volumes is not None and self._clock() < self._expires:
+                self.hits += 1
+                return list(self._volumes.values())
+            self.misses += 1
+        return list(self._flight.do('refresh', self._refresh))
+
+    def _refresh(self):
+        with self._lock:
+            generation = self._generation
+        now = self._clock()
+        volumes = self._fetch()
+        with self._lock:
+            if generation == self._generation:
+                self._volumes = collections.OrderedDict(
+                    (volume.blockdevice_id, volume) for volume in volumes)
+                self._expires = now + self._ttl
+        return volumes
+
+    def update(self, volume):
+        """Put ``volume``, e.g. one just created or attached, in the
+        snapshot in place of what it had for the volume."""
+        with self._lock:
+            self._generation += 1
+            if self._volumes is not None:
+                self._volumes[volume.blockdevice_id] = volume
+
+    def detached(self, blockdevice_id):
+        """Mark ``blockdevice_id`` as no longer attached."""
+        with self._lock:
+            self._generation += 1
+            volume = (self._volumes or {}).get(blockdevice_id)
+            if volume is not None:
+                self._volumes[blockdevice_id] = blockdevice.BlockDeviceVolume(
+                    blockdevice_id=volume.blockdevice_id,
+                    size=volume.size,
+                    attached_to=None,
+                    dataset_id=volume.dataset_id,
+                )
+
+    def remove(self, blockdevice_id):
+        """Drop ``blockdevice_id``, e.g. because it was destroyed."""
+        with self._lock:
+            self._generation += 1
+            if self._volumes is not None:
+                self._volumes.pop(blockdevice_id, None)
+
+    def invalidate(self):
+        """Drop the snapshot so the next lookup lists the volumes again."""
+        with self._lock:
+            self._generation += 1
+            self._volumes = None
+            self._expires = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
 
 class PureFlashArrayConfiguration(object):
     def __init__(self, ip, api_token, storage_protocol,
                  manage_purity_hosts, chap_host_user,
-                 chap_host_password, verify_https, ssl_cert):
+                 chap_host_password, verify_https, ssl_cert,
+                 port_cache_ttl=None, state_dir=None, api_pool_size=None,
+                 api_max_retries=None, log_level=None, metrics_textfile=None,
+                 metrics_port=None, profiles=None, eradicate_after=None,
+                 iscsi_session_interval=None, warm_pool_size=None,
+                 volume_list_ttl=None):
         self.ip = ip
         self.api_token = api_token
 
@@ -147,6 +515,61 @@ class PureFlashArrayConfiguration(object):
         self.verify_https = verify_https
         self.ssl_cert = ssl_cert
 
+        if port_cache_ttl is not None:
+            self.port_cache_ttl = port_cache_ttl
+        else:  # default
+            self.port_cache_ttl = DEFAULT_PORT_CACHE_TTL
+
+        if state_dir is not None:
+            self.state_dir = state_dir
+        else:  # default
+            self.state_dir = DEFAULT_STATE_DIR
+
+        if api_pool_size is not None:
+            self.api_pool_size = api_pool_size
+        else:  # default
+            self.api_pool_size = DEFAULT_API_POOL_SIZE
+
+        if api_max_retries is not None:
+            self.api_max_retries = api_max_retries
+        else:  # default
+            self.api_max_retries = DEFAULT_API_MAX_RETRIES
+
+        if log_level is not None:
+            self.log_level = log_level
+        else:  # default
+            self.log_level = DEFAULT_LOG_LEVEL
+
+        # Metrics are only exported when one of these is set
+        self.metrics_textfile = metrics_textfile
+        self.metrics_port = metrics_port
+
+        # Profiles from the configuration are added to (or replace) the
+        # default ones.
+        self.profiles = dict(DEFAULT_PROFILES)
+        for name, limits in (profiles or {}).items():
+            self.profiles[name.lower()] = limits
+
+        # Destroyed volumes are left to Purity (eradicated after 24 hours)
+        # unless this is set
+        self.eradicate_after = eradicate_after
+
+        # Sessions are left to os-brick unless this is set
+        if iscsi_session_interval is not None:
+            self.iscsi_session_interval = iscsi_session_interval
+        else:  # default
+            self.iscsi_session_interval = 0
+
+        if warm_pool_size is not None:
+            self.warm_pool_size = warm_pool_size
+        else:  # default
+            self.warm_pool_size = 0
+
+        if volume_list_ttl is not None:
+            self.volume_list_ttl = volume_list_ttl
+        else:  # default
+            self.volume_list_ttl = DEFAULT_VOLUME_LIST_TTL
+
     def __str__(self):
         return str({
             'ip': self.ip,
@@ -156,9 +579,74 @@ class PureFlashArrayConfiguration(object):
             'chap_host_user': self.chap_host_user,
             'chap_host_password': self.chap_host_password,
             'verify_https': self.verify_https,
-            'ssl_cert': self.ssl_cert
+            'ssl_cert': self.ssl_cert,
+            'port_cache_ttl': self.port_cache_ttl,
+            'state_dir': self.state_dir,
+            'api_pool_size': self.api_pool_size,
+            'api_max_retries': self.api_max_retries,
+            'log_level': self.log_level,
+            'metrics_textfile': self.metrics_textfile,
+            'metrics_port': self.metrics_port,
+            'profiles': self.profiles,
+            'eradicate_after': self.eradicate_after,
+            'iscsi_session_interval': self.iscsi_session_interval,
+            'warm_pool_size': self.warm_pool_size,
+            'volume_list_ttl': self.volume_list_ttl
         })
 
+def _created_time(volume):
+    """Return when the Purity ``volume`` was created, in seconds since the
+    epoch, or now if the array didn't say."""
+    try:
+        return calendar.timegm(time.strptime(volume['created'],
+                                             '%Y-%m-%dT%H:%M:%SZ'))
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+def _instrumented(method):
+    """Record the latency and errors of an API method in the metrics, and
+    trace it as an eliot action.
+
+    API methods called by another one (e.g. ``attach_volumes`` by
+    ``attach_volume``) are only traced, so each call is counted once, under
+    the method called.
+    """
+    operation = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self._operation, 'active', False):
+            with tracing.phase(operation, array=self._conf.ip):
+                return method(self, *args, **kwargs)
+        start = time.time()
+        self._operation.active = True
+        try:
+            with tracing.phase(operation, array=self._conf.ip):
+                return method(self, *args, **kwargs)
+        except Exception as err:
+            self._operation_errors.inc(array=self._conf.ip,
+                                       operation=operation,
+                                       error=type(err).__name__)
+            raise
+        finally:
+            self._operation.active = False
+            self._operation_seconds.observe(time.time() - start,
+                                            array=self._conf.ip,
+                                            operation=operation)
+    return wrapper
+
+
+def _volume_locked(method):
+    """Hold the locks of the volumes a batch method works on, so operations
+    on the same volume run one after the other."""
+    @functools.wraps(method)
+    def wrapper(self, blockdevice_ids, *args):
+        with self._volume_locks.hold(blockdevice_ids):
+            return method(self, blockdevice_ids, *args)
+    return wrapper
+
+
 @implementer(blockdevice.IBlockDeviceAPI)
 @implementer(blockdevice.IProfiledBlockDeviceAPI)
 class FlashArrayBlockDeviceAPI(object):
@@ -169,16 +657,33 @@ class FlashArrayBlockDeviceAPI(object):
 
     VERSION = '1.0.1'
 
-    def __init__(self, configuration, cluster_id):
+    def __init__(self, configuration, cluster_id, array_factory=None,
+                 connector=None, initiator_info=None,
+                 sysfs_root=devices.SYSFS_ROOT, dev_root=devices.DEV_ROOT,
+                 uevent_source=None, metrics_registry=None):
         """
        :param configuration: FlashArrayconfiguration
        :param cluster_id: Flocker cluster id
-       :param hostname: Current hostname
-       :param allocation_unit: allocation_unit
+       :param array_factory: Optional callable returning a logged in
+           ``purestorage.FlashArray``, used instead of connecting to the
+           configured array (e.g. to run against a simulated array).
+       :param connector: Optional os-brick style initiator connector.
+       :param initiator_info: Optional ``wwpns``/``initiator`` dictionary
+           used instead of reading them from the node.
+       :param sysfs_root: Where sysfs is mounted.
+       :param dev_root: Where the device nodes are.
+       :param uevent_source: Optional source of kernel uevents to wait for
+           new devices with, by default they are read from netlink.
+       :param metrics_registry: Optional ``metrics.Registry`` shared with
+           other instances, whose owner exports it. By default the metrics
+           are kept and exported by this instance.
        """
+        start = time.time()
         self._cluster_id = cluster_id
         self._hostname = unicode(socket.gethostname())
         self._conf = configuration
+        self._sysfs_root = sysfs_root
+        self._dev_root = dev_root
 
 
         eliot.Message.new(
@@ -189,6 +694,8 @@ class FlashArrayBlockDeviceAPI(object):
         ).write(_logger)
 
         self._validate_config()  # Will raise exception if something is missing
+        self._log_threshold = LOG_LEVELS[self._conf.log_level.upper()]
+        set_log_level(self._conf.log_level)
 
         self._full_vol_prefix = '{0}-{1}'.format(PURE_BASE_PREFIX,
                                                  self._cluster_id)
@@ -200,6 +707,10 @@ class FlashArrayBlockDeviceAPI(object):
         # starting uuid. Ideally we store metadata somewhere so we have both
         # full paths available so we can correctly list_volumes later.
         self._vol_prefix = self._full_vol_prefix[:26] + '-'
+        # Spare volumes of the warm pool, these don't look like Flocker's
+        # volumes to list_volumes.
+        self._pool_prefix = '{0}-pool-{1}-'.format(PURE_BASE_PREFIX,
+                                                   str(self._cluster_id)[:8])
 
         ua = '{cls}/{version} (flocker; {protocol}; {sys} {sys_version};)'.format(
             cls=self.__class__.__name__,
@@ -208,24 +719,201 @@ class FlashArrayBlockDeviceAPI(object):
             sys=platform.system(),
             sys_version=platform.version()
         )
-        self._array = purestorage.FlashArray(self._conf.ip,
-                                             api_token=self._conf.api_token,
-                                             verify_https=self._conf.verify_https,
-                                             ssl_cert=self._conf.ssl_cert,
-                                             user_agent=ua)
-
-        self._connector = connector.InitiatorConnector.factory(
-            self._conf.storage_protocol,
-            None,
-            use_multipath=True,
+        if array_factory is None:
+            array_factory = functools.partial(
+                client.KeepAliveFlashArray,
+                self._conf.ip,
+                api_token=self._conf.api_token,
+                verify_https=self._conf.verify_https,
+                ssl_cert=self._conf.ssl_cert,
+                user_agent=ua)
+        self._metrics = metrics_registry
+        if metrics_registry is None:
+            self._metrics = metrics.Registry()
+        self._operation_seconds = self._metrics.histogram(
+            metrics.OPERATION_SECONDS,
+            'Latency of block device API operations.')
+        self._operation_errors = self._metrics.counter(
+            metrics.OPERATION_ERRORS,
+            'Failed block device API operations, by exception.')
+        # Whether the thread is in an API operation, see _instrumented
+        self._operation = threading.local()
+        self._initiator_seconds = self._metrics.histogram(
+            metrics.INITIATOR_SECONDS,
+            'Latency of initiator side operations on this node.')
+        self._array = client.FlashArrayClientPool(
+            self._conf.ip,
+            array_factory,
+            self._conf.api_pool_size,
+            max_retries=self._conf.api_max_retries,
+            metrics=self._metrics,
         )
-        self._initiator_info = self._get_initiator_info()
-        eliot.Message.new(info='Found initiator info: ' + str(self._initiator_info)).write(_logger)
-
-        self._purity_hostname = self._ensure_purity_host()
-        eliot.Message.new(info='Using Purity host: ' + str(self._purity_hostname)).write(_logger)
-
-        self._volume_path_cache = {}
+        self._port_cache = PortTopologyCache(self._array,
+                                             self._conf.port_cache_ttl)
+        self._fc_zoning = FcZoningCache(self._port_cache,
+                                        self._conf.port_cache_ttl,
+                                        self._sysfs_root)
+        self._volume_list = VolumeListCache(self._list_volumes,
+                                            self._conf.volume_list_ttl)
+        self._eradicator = None
+        if self._conf.eradicate_after is not None:
+            self._eradicator = eradication.EradicationScheduler(
+                self._array, self._conf.eradicate_after,
+                os.path.join(self._conf.state_dir, ERADICATION_FILE))
+
+        # The initiator side and our Purity host are only set up the first
+        # time they are needed, see the properties below.
+        self._lazy_lock = threading.RLock()
+        self._initiator_connector = connector
+        self._initiator = initiator_info
+        self._purity_host = None
+        self._uevent_source = uevent_source
+        self._watcher = None
+
+        self._device_index = devices.DevicePathIndex(
+            os.path.join(self._conf.state_dir, DEVICE_INDEX_FILE),
+            self._sysfs_root)
+        self._device_index.load()
+        # The volumes attached here which are missing from the index are
+        # added from the first volume list, see _list_volumes
+        self._index_complete = False
+
+        # Operations on the same volume are serialized, and identical ones
+        # arriving while one is in progress share its outcome.
+        self._volume_locks = locking.KeyedLocks()
+        self._single_flight = locking.SingleFlight()
+
+        # Spare volumes create_volume turned into a dataset's volume. They
+        # are listed as attached to this node, and attach_volume only hands
+        # them over.
+        self._claimed = warm_pool.ClaimedVolumes(
+            os.path.join(self._conf.state_dir, CLAIMED_VOLUMES_FILE))
+        self._claimed.load()
+        self._warm_pool = None
+        if self._conf.warm_pool_size > 0:
+            self._warm_pool = warm_pool.WarmPool(
+                self._conf.warm_pool_size, self._find_spare_volumes,
+                self._make_spare_volumes)
+
+        # Log in to all portals of the array in the background straight away,
+        # rather than on the first attach.
+        self._session_keeper = None
+        if self._conf.storage_protocol == ISCSI and \
+                self._conf.iscsi_session_interval > 0:
+            chap = None
+            if self._conf.chap_host_user and self._conf.chap_host_password:
+                chap = (self._conf.chap_host_user,
+                        self._conf.chap_host_password)
+            self._session_keeper = iscsi.SessionKeeper(
+                self._get_target_iscsi_ports, self._sysfs_root, chap,
+                self._conf.iscsi_session_interval)
+            self._session_keeper.start()
+
+        self._metrics.callback(metrics.CACHE_HITS, 'Cache hits, by cache.',
+                               'counter',
+                               lambda: self._cache_stats('hits'))
+        self._metrics.callback(metrics.CACHE_MISSES, 'Cache misses, by cache.',
+                               'counter',
+                               lambda: self._cache_stats('misses'))
+        self._metrics.callback(
+            metrics.COALESCED_REQUESTS,
+            'Requests which shared the outcome of an identical one in '
+            'progress.',
+            'counter',
+            lambda: [({'array': self._conf.ip}, self._single_flight.shared)])
+        if metrics_registry is None:
+            metrics.start_exporters(self._metrics, self._conf.metrics_textfile,
+                                    self._conf.metrics_port)
+        # Only now that everything it uses is set up
+        if self._warm_pool is not None:
+            self._warm_pool.start()
+
+        self._startup_seconds = time.time() - start
+        self._log_info('Initialized FlashArrayBlockDeviceAPI',
+                       seconds=self._startup_seconds)
+        if self._startup_seconds > COLD_START_BUDGET:
+            eliot.Message.new(warning='FlashArrayBlockDeviceAPI took longer '
+                                      'than {0}s to initialize'
+                                      .format(COLD_START_BUDGET),
+                              seconds=self._startup_seconds).write(_logger)
+
+    def _log_enabled(self, level):
+        """Return whether messages of ``level`` are logged, see
+        ``pure_log_level``."""
+        return level >= self._log_threshold
+
+    def _log_debug(self, msg, *args):
+        """Write a debug message, only formatting it if debug is enabled."""
+        if self._log_enabled(logging.DEBUG):
+            eliot.Message.new(debug=msg.format(*args)).write(_logger)
+
+    def _log_info(self, msg, *args, **fields):
+        """Write an info message, only formatting it if info is enabled."""
+        if self._log_enabled(logging.INFO):
+            eliot.Message.new(Info=msg.format(*args), **fields).write(_logger)
+
+    def _cache_stats(self, stat):
+        return [({'array': self._conf.ip, 'cache': 'port_topology'},
+                 self._port_cache.stats()[stat]),
+                ({'array': self._conf.ip, 'cache': 'device_index'},
+                 self._device_index.stats()[stat]),
+                ({'array': self._conf.ip, 'cache': 'fc_zoning'},
+                 self._fc_zoning.stats()[stat]),
+                ({'array': self._conf.ip, 'cache': 'volume_list'},
+                 self._volume_list.stats()[stat])]
+
+    @property
+    def _connector(self):
+        """The os-brick initiator connector, created on first use."""
+        with self._lazy_lock:
+            if self._initiator_connector is None:
+                self._initiator_connector = (
+                    os_brick_connector().InitiatorConnector.factory(
+                        self._conf.storage_protocol,
+                        None,
+                        use_multipath=True,
+                    ))
+            return self._initiator_connector
+
+    @property
+    def _device_watcher(self):
+        """Watcher for new multipath devices, started on first use.
+
+        ``None`` if uevents can't be received on this node.
+        """
+        with self._lazy_lock:
+            if self._watcher is None:
+                source = self._uevent_source
+                if source is None:
+                    try:
+                        source = devices.NetlinkUeventSource()
+                    except (socket.error, AttributeError) as err:
+                        eliot.Message.new(warning='Unable to listen for '
+                                                  'uevents, polling for devices',
+                                          error=str(err)).write(_logger)
+                        self._watcher = False
+                        return None
+                self._watcher = devices.DeviceWatcher(
+                    source, self._sysfs_root, self._dev_root)
+            return self._watcher or None
+
+    @property
+    def _initiator_info(self):
+        """The wwpns and iqns of this node, looked up on first use."""
+        with self._lazy_lock:
+            if self._initiator is None:
+                self._initiator = self._get_initiator_info()
+                self._log_info('Found initiator info: {0}', self._initiator)
+            return self._initiator
+
+    @property
+    def _purity_hostname(self):
+        """The name of our Purity host, resolved on first use."""
+        with self._lazy_lock:
+            if self._purity_host is None:
+                self._purity_host = self._ensure_purity_host()
+                self._log_info('Using Purity host: {0}', self._purity_host)
+            return self._purity_host
 
     def _validate_config(self):
         if not self._conf.ip:
@@ -243,23 +931,62 @@ class FlashArrayBlockDeviceAPI(object):
             raise InvalidConfig('CHAP support requires both pure_chap_host_user'
                                 'and pure_chap_host_password.')
 
+        if str(self._conf.log_level).upper() not in LOG_LEVELS:
+            raise InvalidConfig('pure_log_level must be one of {0}'
+                                .format(', '.join(sorted(LOG_LEVELS))))
+
+        if self._conf.api_pool_size < 1:
+            raise InvalidConfig('pure_api_pool_size must be at least 1')
+
+        if self._conf.api_max_retries < 0:
+            raise InvalidConfig('pure_api_max_retries must not be negative')
+
+        if self._conf.metrics_port is not None and \
+                not 0 < int(self._conf.metrics_port) < 65536:
+            raise InvalidConfig('pure_metrics_port must be a TCP port number')
+
+        for name, limits in self._conf.profiles.items():
+            if not isinstance(limits, dict) or \
+                    set(limits) - set(QOS_LIMITS) or \
+                    [value for value in limits.values()
+                     if value is not None and int(value) <= 0]:
+                raise InvalidConfig('Storage profile {0} may only set positive '
+                                    '{1}'.format(name, ' and '.join(QOS_LIMITS)))
+
+        if self._conf.eradicate_after is not None and \
+                self._conf.eradicate_after < 0:
+            raise InvalidConfig('pure_eradicate_after must not be negative')
+
+        if self._conf.iscsi_session_interval < 0:
+            raise InvalidConfig('pure_iscsi_session_interval must not be '
+                                'negative')
+
+        if self._conf.port_cache_ttl < 0:
+            raise InvalidConfig('pure_port_cache_ttl must not be negative')
+
+        if self._conf.warm_pool_size < 0:
+            raise InvalidConfig('pure_warm_pool_size must not be negative')
+
+        if self._conf.volume_list_ttl < 0:
+            raise InvalidConfig('pure_volume_list_ttl must not be negative')
+
         if self._conf.ssl_cert and not self._verify_https:
             eliot.Message.new(warning='pure_ssl_cert specified but '
                                       'pure_verify_https is disabled. Requests '
                                       'are not being validated with certificate!')
 
-    @staticmethod
-    def _get_initiator_info():
-        info = connector.get_connector_properties(None, None, True, True)
-        if not 'wwpns' in info:
-            info['wwpns'] = []
-
-        if not 'initiator' in info:
-            info['initiator'] = []
-        elif not isinstance(info['initiator'], list):
-            info['initiator'] = [info['initiator']]
+    def _get_initiator_info(self):
+        """Read the initiator wwpns and iqn of this node.
 
-        return info
+        This is what os-brick's ``get_connector_properties`` reports for
+        them, but read straight from the files without probing any of the
+        iSCSI, FC or multipath tools.
+        """
+        iqn = devices.read_iscsi_initiator_name()
+        return {
+            'wwpns': devices.read_fc_wwpns(self._sysfs_root),
+            'initiator': [iqn] if iqn else [],
+        }
 
     def _get_managed_purity_hostname(self):
         return '{0}-{1}'.format(PURE_BASE_PREFIX, self._hostname)
@@ -268,7 +995,7 @@ class FlashArrayBlockDeviceAPI(object):
         hosts = self._array.list_hosts()
         purity_host = None
         managed_hostname = self._get_managed_purity_hostname()
-        for host in hosts:
+        for index, host in enumerate(hosts):
             # If there is one with our specific node name... take it, but
             # only if there isn't another one with the right iqn/wwns
             if host['name'] == managed_hostname:
@@ -279,36 +1006,108 @@ class FlashArrayBlockDeviceAPI(object):
                 for wwn in self._initiator_info['wwpns']:
                     if wwn.lower() in purity_wwpns:
                         return host
-            eliot.Message.new(debug='Looking at host: ' + str(host)).write(_logger)
+            if index < LOG_SAMPLE_SIZE:
+                self._log_debug('Looking at host: {0}', host)
             if self._conf.storage_protocol == ISCSI:
                 for iqn in self._initiator_info['initiator']:
-                    eliot.Message.new(debug='Checking for iqn {0} in {1}'.
-                                      format(iqn, host['iqn'])).write(_logger)
                     if iqn in host['iqn']:
                         return host
 
+        if purity_host is None:
+            self._log_info('Scanned Purity hosts, no host with our iqn or wwn',
+                           hosts=len(hosts))
         return purity_host
 
+    def _get_purity_host(self, name):
+        """Return the Purity host called ``name``, or ``None``."""
+        try:
+            return self._array.get_host(name)
+        except purestorage.PureHTTPError as err:
+            if err.code == 400 and ERR_MSG_NOT_EXIST in err.text:
+                return None
+            raise
+
+    def _initiators(self):
+        """Return the wwns or iqns of this node, for the protocol in use."""
+        if self._conf.storage_protocol == FIBRE_CHANNEL:
+            return self._initiator_info['wwpns']
+        return self._initiator_info['initiator']
+
+    def _missing_initiators(self, purity_host):
+        """Return the wwns/iqns of this node that ``purity_host`` lacks."""
+        if self._conf.storage_protocol == FIBRE_CHANNEL:
+            purity_wwpns = [wwpn.lower() for wwpn in purity_host['wwn']]
+            return [wwpn for wwpn in self._initiators()
+                    if not wwpn.lower() in purity_wwpns]
+        return [iqn for iqn in self._initiators()
+                if not iqn in purity_host['iqn']]
+
+    def _host_fingerprint(self):
+        """Digest of everything that decides which Purity host we use."""
+        return hashlib.sha1(json.dumps([
+            self._conf.ip,
+            self._conf.storage_protocol,
+            self._conf.manage_purity_hosts,
+            self._get_managed_purity_hostname(),
+            sorted(wwpn.lower() for wwpn in self._initiator_info['wwpns']),
+            sorted(self._initiator_info['initiator']),
+        ]).encode('utf-8')).hexdigest()
+
+    def _chap_fingerprint(self):
+        """Digest of the CHAP credentials, keyed with the node's secret so
+        the state file can't be used to guess them."""
+        if not (self._conf.chap_host_user and self._conf.chap_host_password):
+            return None
+        key = state.secret(os.path.join(self._conf.state_dir, SECRET_FILE))
+        return hmac.new(key.encode('ascii'), '{0}:{1}'.format(
+            self._conf.chap_host_user,
+            self._conf.chap_host_password).encode('utf-8'),
+            hashlib.sha256).hexdigest()
+
     def _ensure_purity_host(self):
         """Ensure that a Purity host exists for this compute instance.
 
         If configured to manage the host we will create one as needed and/or
         modify the host to to ensure that it has this initiators iqn/wwns and
-        CHAP credentials setup.
+        CHAP credentials setup. Only changes that are actually needed are
+        sent to the array.
 
         If not configured to manage the host we will just try and find a host
         to use, and if that fails log a message and raise exception.
+
+        The host we settle on is remembered in the state directory along
+        with a fingerprint of the initiator configuration. As long as that
+        hasn't changed a single ``get_host`` confirms the host is still good,
+        and scanning every host on the array is only the fallback.
         """
+        cache_path = os.path.join(self._conf.state_dir, PURITY_HOST_FILE)
+        cached = state.load(cache_path) or {}
+        fingerprint = self._host_fingerprint()
+        chap = self._chap_fingerprint()
+        if cached.get('fingerprint') == fingerprint:
+            purity_host = self._get_purity_host(cached['name'])
+            if purity_host is not None:
+                missing = self._missing_initiators(purity_host)
+                if self._conf.manage_purity_hosts:
+                    usable = not missing and cached.get('chap') == chap
+                else:
+                    usable = len(missing) < len(self._initiators())
+                if usable:
+                    return purity_host['name']
+
         purity_host = self._find_purity_host()
 
         if not self._conf.manage_purity_hosts:
             if purity_host:
+                state.save(cache_path, {'name': purity_host['name'],
+                                        'fingerprint': fingerprint})
                 return purity_host['name']
             else:
                 eliot.Message.new(Error='Unable to find purity host with '
                                   'iqn or wwn for initiator.').write(_logger)
                 raise UnmanagedPurityHostNotFoundException()
 
+        chap_configured = False
         if not purity_host:
             purity_host = self._array.create_host(
                 self._get_managed_purity_hostname(),
@@ -317,35 +1116,31 @@ class FlashArrayBlockDeviceAPI(object):
             )
         else:
             # Make sure the wwns/iqns are setup for the host
-            if self._conf.storage_protocol == FIBRE_CHANNEL:
-                wwnlist = []
-                purity_wwpns = [wwpn.lower() for wwpn in purity_host['wwn']]
-                for wwpn in self._initiator_info['wwpns']:
-                    if not wwpn.lower() in purity_wwpns:
-                        wwnlist.append(wwpn)
-
+            missing = self._missing_initiators(purity_host)
+            if missing and self._conf.storage_protocol == FIBRE_CHANNEL:
                 self._array.set_host(
                     purity_host['name'],
-                    addwwnlist=wwnlist,
+                    addwwnlist=missing,
                 )
-            elif self._conf.storage_protocol == ISCSI:
-                iqnlist = []
-                for iqn in self._initiator_info['initiator']:
-                    if not iqn in purity_host['iqn']:
-                        iqnlist.append(self._initiator_info['initiator'])
-
+            elif missing and self._conf.storage_protocol == ISCSI:
                 self._array.set_host(
                     purity_host['name'],
-                    addiqnlist=iqnlist
+                    addiqnlist=missing
                 )
+            chap_configured = (cached.get('name') == purity_host['name'] and
+                               cached.get('chap') == chap)
+
+        if (self._conf.storage_protocol == ISCSI and not chap_configured and
+                self._conf.chap_host_user and self._conf.chap_host_password):
+            self._array.set_host(
+                purity_host['name'],
+                host_user=self._conf.chap_host_user,
+                host_password=self._conf.chap_host_password
+            )
 
-                if self._conf.chap_host_user and self._conf.chap_host_password:
-                    self._array.set_host(
-                        purity_host['name'],
-                        host_user=self._conf.chap_host_user,
-                        host_password=self._conf.chap_host_password
-                    )
-
+        state.save(cache_path, {'name': purity_host['name'],
+                                'fingerprint': fingerprint,
+                                'chap': chap})
         return purity_host['name']
 
     @staticmethod
@@ -361,8 +1156,9 @@ class FlashArrayBlockDeviceAPI(object):
     def _connect_volume(self, vol_name):
         """Connect the volume object to our Purity host.
 
-        We need to return a dictionary with target information that will be
-        consumed by os-brick.
+        :return: the Purity connection dictionary, use
+            ``_format_connection_info`` to turn it into target information
+            that can be consumed by os-brick.
         """
         try:
             connection = self._array.connect_host(self._purity_hostname, vol_name)
@@ -373,7 +1169,7 @@ class FlashArrayBlockDeviceAPI(object):
                 raise blockdevice.UnknownVolume(vol_name)
             else:
                 raise
-        return self._format_connection_info(connection)
+        return connection
 
     def _disconnect_volume(self, vol_name):
         try:
@@ -386,22 +1182,11 @@ class FlashArrayBlockDeviceAPI(object):
             else:
                 raise
 
-    def _get_target_info(self, vol_name):
-        """Build a dictionary of information about the target.
-
-        :param vol_name:
-        :return: dictionary containing the following info:
-
-        iSCSI:
-            target_portal(s) - ip and optional port
-            target_iqn(s) - iSCSI Qualified Name
-            target_lun(s) - LUN id of the volume
-        FC:
-            target_wwn - World Wide Name
-            target_lun - LUN id of the volume
+    def _get_connection(self, vol_name):
+        """Return the Purity connection of ``vol_name`` to our host.
 
-        ALL:
-            volume - A dictionary representation of the Purity volume object
+        :raises UnknownVolume: If the volume does not exist.
+        :raises UnattachedVolume: If it is not connected to our host.
         """
         conn_info = {}
         try:
@@ -419,18 +1204,72 @@ class FlashArrayBlockDeviceAPI(object):
         if not conn_info:
             raise blockdevice.UnattachedVolume(vol_name)
 
-        return self._format_connection_info(conn_info)
+        return conn_info
+
+    def _get_target_info(self, vol_name):
+        """Build a dictionary of information about the target.
+
+        :param vol_name:
+        :return: dictionary containing the following info:
+
+        iSCSI:
+            target_portal(s) - ip and optional port
+            target_iqn(s) - iSCSI Qualified Name
+            target_lun(s) - LUN id of the volume
+        FC:
+            target_wwn - World Wide Name
+            target_lun - LUN id of the volume
+            initiator_target_map - local WWN to the array WWNs zoned to it
+
+        ALL:
+            volume - A dictionary representation of the Purity volume object
+        """
+        return self._format_connection_info(self._get_connection(vol_name))
 
     def _get_target_iscsi_ports(self):
         """Return list of iSCSI-enabled port descriptions."""
-        ports = self._array.list_ports()
-        iscsi_ports = [port for port in ports if port['iqn']]
-        return iscsi_ports
+        return self._port_cache.get_iscsi_ports()
 
     def _get_target_wwns(self):
         """Return list of wwns from the array"""
-        ports = self._array.list_ports()
-        return [port["wwn"] for port in ports if port["wwn"]]
+        return self._port_cache.get_wwns()
+
+    @contextlib.contextmanager
+    def _initiator_phase(self, operation):
+        """Time the initiator side ``operation`` in the ``with`` block, both
+        in the metrics and as a traced phase."""
+        with tracing.phase(operation), \
+                self._initiator_seconds.time(operation=operation):
+            yield
+
+    def _run_connector(self, operation, connection, *args):
+        """Run os-brick ``operation`` against the targets of ``connection``.
+
+        The target information is built from the cached port topology. If
+        the initiator fails we drop the cache, and when the array reports a
+        different topology the operation is retried once with it.
+        """
+        target_info = self._format_connection_info(connection)
+        timer = functools.partial(self._initiator_phase, operation.__name__)
+        try:
+            with timer():
+                return operation(target_info, *args)
+        except Exception as err:
+            self._port_cache.invalidate()
+            self._fc_zoning.invalidate()
+            try:
+                fresh_target_info = self._format_connection_info(connection)
+            except Exception as refresh_err:
+                # The initiator failure is what the caller needs to see
+                eliot.Message.new(warning='Unable to refresh target info',
+                                  error=str(refresh_err)).write(_logger)
+                raise err
+            if fresh_target_info == target_info:
+                raise err
+        self._log_info("Array port topology changed, retrying with "
+                       "refreshed target info")
+        with timer():
+            return operation(fresh_target_info, *args)
 
     def _format_connection_info(self, purity_connection_info):
         props = {}
@@ -463,7 +1302,19 @@ class FlashArrayBlockDeviceAPI(object):
         elif self._conf.storage_protocol == FIBRE_CHANNEL:
             props['target_discovered'] = True
             props['target_lun'] = purity_connection_info['lun']
-            props['target_wwn'] = self._get_target_wwns()
+            paths = self._fc_zoning.get_paths()
+            if paths:
+                # Only have os-brick look behind the HBAs and array ports
+                # which are zoned together.
+                initiator_target_map = {}
+                for path in paths:
+                    initiator_target_map.setdefault(
+                        path['initiator'], []).append(path['target'])
+                props['initiator_target_map'] = initiator_target_map
+                props['target_wwn'] = sorted(set(path['target']
+                                                 for path in paths))
+            else:
+                props['target_wwn'] = self._get_target_wwns()
         else:
             raise UnknownStorageProtocolException(self._conf.storage_protocol)
 
@@ -481,6 +1332,39 @@ class FlashArrayBlockDeviceAPI(object):
         """
         return PURE_ALLOCATION_UNIT
 
+    @property
+    def array_name(self):
+        """The management address of the array, as configured."""
+        return self._conf.ip
+
+    def get_array_stats(self):
+        """Return the space and load of the array, for volume placement.
+
+        :return: dictionary with the ``capacity`` and used (``total``) bytes
+            of the array, and its current ``usec_per_read_op``,
+            ``usec_per_write_op`` and ``queue_depth``.
+        """
+        stats = {}
+        for result in (self._array.get(space=True),
+                       self._array.get(action='monitor')):
+            # Purity answers with a list of one sample
+            if isinstance(result, list):
+                result = result[0] if result else {}
+            stats.update(result)
+        return dict((key, stats.get(key) or 0) for key in ARRAY_STATS)
+
+    def has_volume(self, blockdevice_id):
+        """Return whether the volume ``blockdevice_id`` is on this array."""
+        try:
+            self._array.get_volume(blockdevice_id)
+        except purestorage.PureHTTPError as err:
+            if err.code == 400 and (ERR_MSG_NOT_EXIST in err.text or
+                                    ERR_MSG_PENDING_ERADICATION in err.text):
+                return False
+            raise
+        return True
+
+    @_instrumented
     def create_volume(self, dataset_id, size):
         """
         Create a volume of specified size on the Pure Storage FlashArray.
@@ -490,29 +1374,264 @@ class FlashArrayBlockDeviceAPI(object):
         See ``IBlockDeviceAPI.create_volume`` for parameter and return type
         documentation.
         """
+        return self._create_volume(dataset_id, size, {})
 
+    def _create_volume(self, dataset_id, size, limits):
+        """Create the volume of ``dataset_id``, with the QoS ``limits``.
+
+        A spare volume of the warm pool is used when there is one.
+        :return: A ``BlockDeviceVolume``
+        """
         vol_name = self._vol_name_from_dataset_id(dataset_id)
+        self._log_info("Creating Volume: {0}", vol_name, **limits)
+        self._free_volume_name(vol_name)
+        if not self._claim_spare_volume(vol_name, size, limits):
+            self._array.create_volume(vol_name, size, **limits)
+        attached_to = None
+        if vol_name in self._claimed:
+            # Still connected here, and listed so, so no other node may
+            # attach it
+            attached_to = self.compute_instance_id()
         volume = blockdevice.BlockDeviceVolume(
             blockdevice_id=unicode(vol_name),
             size=size,
-            attached_to=None,
+            attached_to=attached_to,
             dataset_id=dataset_id,
         )
-        eliot.Message.new(Info="Creating Volume: " + vol_name).write(_logger)
-        self._array.create_volume(vol_name, size)
+        self._volume_list.update(volume)
         return volume
 
+    def _free_volume_name(self, vol_name):
+        """Eradicate our destroyed volume ``vol_name`` if it is still around.
+
+        A destroyed volume keeps its name until it is eradicated, so this
+        lets a dataset be created again straight after it was destroyed.
+        """
+        if self._eradicator is not None:
+            self._eradicator.eradicate_now(vol_name)
+
+    def _claim_spare_volume(self, vol_name, size, limits=None):
+        """Turn a spare volume of the warm pool into ``vol_name``.
+
+        The spare is extended to ``size``, given the QoS ``limits`` and
+        renamed, and its device on this node is resized. It stays connected,
+        and the next ``attach_volume`` only has to hand it over.
+        :return: whether a spare volume was used, if not the volume still has
+            to be created.
+        """
+        if self._warm_pool is None:
+            return False
+        spare = self._warm_pool.take()
+        if spare is None:
+            return False
+        try:
+            path = self._get_device_path(spare).path
+            if size != WARM_POOL_VOLUME_SIZE:
+                self._array.extend_volume(spare, size)
+            if limits:
+                self._array.set_volume(spare, **limits)
+            self._array.rename_volume(spare, vol_name)
+        except Exception as err:
+            eliot.Message.new(warning='Unable to use spare volume',
+                              volume=spare, error=str(err)).write(_logger)
+            self._destroy_spare_volumes([spare])
+            return False
+        self._device_index.rename(spare, vol_name)
+        try:
+            if size != WARM_POOL_VOLUME_SIZE:
+                self._resize_device(path)
+        except Exception as err:
+            # The volume is fine, but its device here has the wrong size, so
+            # leave attaching it to attach_volume.
+            eliot.Message.new(warning='Unable to resize device of spare '
+                                      'volume, detaching it',
+                              volume=vol_name, device=path,
+                              error=str(err)).write(_logger)
+            try:
+                self._detach_device(vol_name)
+            except Exception as err:
+                eliot.Message.new(warning='Unable to detach spare volume, '
+                                          'creating the volume instead',
+                                  volume=vol_name,
+                                  error=str(err)).write(_logger)
+                self._release_spare_volume(spare, vol_name)
+                return False
+            return True
+        self._claimed.add(vol_name)
+        self._log_info("Using spare volume {0} for {1}", spare, vol_name)
+        return True
+
+    def _release_spare_volume(self, spare, vol_name):
+        """Give the spare volume renamed to ``vol_name`` its name back and
+        destroy it, freeing ``vol_name``."""
+        try:
+            self._array.rename_volume(vol_name, spare)
+        except Exception as err:
+            eliot.Message.new(warning='Unable to rename spare volume back',
+                              volume=vol_name, spare=spare,
+                              error=str(err)).write(_logger)
+            return
+        self._device_index.rename(vol_name, spare)
+        self._destroy_spare_volumes([spare])
+
+    def _resize_device(self, path):
+        """Have the multipath device ``path`` pick up its volume's new size."""
+        with self._initiator_phase('resize_multipath_device'):
+            for name in devices.list_multipath_slaves(path, self._sysfs_root):
+                devices.rescan_scsi_device(name, self._sysfs_root)
+            devices.resize_multipath_map(os.path.basename(path))
+
+    def _find_spare_volumes(self):
+        """Return the spare volumes left connected to this node by an earlier
+        run of the agent, destroying those without a device.
+
+        Spare volumes connected to no node at all are left over from a node
+        which failed to attach them, and are destroyed as well once they are
+        older than ``SPARE_VOLUME_GRACE_PERIOD``.
+        """
+        now = time.time()
+        stale = [vol['name'] for vol in self._array.list_volumes()
+                 if vol['name'].startswith(self._pool_prefix) and
+                 now - _created_time(vol) > SPARE_VOLUME_GRACE_PERIOD]
+        connections = self._list_volume_connections(self._pool_prefix)
+        ready = []
+        broken = [name for name in sorted(stale) if name not in connections]
+        for name in sorted(connections):
+            for connection in connections[name]:
+                if connection['host'] != self._purity_hostname:
+                    continue
+                try:
+                    self._get_device_path(name, connection)
+                except blockdevice.UnattachedVolume:
+                    broken.append(name)
+                else:
+                    ready.append(name)
+        self._destroy_spare_volumes(broken)
+        return ready
+
+    def _make_spare_volumes(self, count):
+        """Create ``count`` spare volumes and attach them to this node.
+
+        :return: the names of the spare volumes which are ready.
+        """
+        names = ['{0}{1}'.format(self._pool_prefix, uuid.uuid4().hex)
+                 for _ in range(count)]
+        failures = {}
+        for name in names:
+            try:
+                self._array.create_volume(name, WARM_POOL_VOLUME_SIZE)
+            except Exception as err:
+                failures[name] = err
+        created = [name for name in names if name not in failures]
+        with self._volume_locks.hold(created):
+            attached = self._attach_devices(created, failures)
+            # Index the devices os-brick brought up as well, so taking a
+            # spare volume never has to look for its device.
+            for name, volume in attached.items():
+                try:
+                    self._get_device_path(name, serial=volume['serial'])
+                except Exception as err:
+                    failures[name] = err
+        for name, err in failures.items():
+            eliot.Message.new(warning='Unable to make spare volume',
+                              volume=name, error=str(err)).write(_logger)
+        self._destroy_spare_volumes([name for name in created
+                                     if name in failures])
+        return [name for name in names if name not in failures]
+
+    def _destroy_spare_volumes(self, names):
+        """Destroy spare volumes, removing what is left of their devices on
+        this node first."""
+        if not names:
+            return
+        for name in names:
+            try:
+                self._detach_device(name)
+            except Exception as err:
+                self._log_debug("Spare volume {0} was not attached: {1}",
+                                name, err)
+        try:
+            self.destroy_volumes(names)
+        except BatchOperationError as err:
+            eliot.Message.new(warning='Unable to destroy spare volumes',
+                              volumes=sorted(err.failures)).write(_logger)
+
+    @_instrumented
     def create_volume_with_profile(self, dataset_id, size, profile_name):
         """Create a new volume on the array.
+
+        The profile decides the bandwidth and IOPS limits Purity enforces for
+        the volume, see ``DEFAULT_PROFILES`` and ``list_volume_limits``.
         :param dataset_id: The Flocker dataset ID for the volume.
         :param size: The size of the new volume in bytes.
         :param profile_name: The name of the storage profile for
-                             this volume.
+                             this volume. A volume with an unknown profile
+                             is created without limits, like Flocker's
+                             default profile.
         :return: A ``BlockDeviceVolume``
         """
-        # We only have one type of volume: fast
-        return self.create_volume(dataset_id, size)
+        limits = self._conf.profiles.get(profile_name.lower())
+        if limits is None:
+            eliot.Message.new(warning='Unknown storage profile, creating the '
+                                      'volume without limits',
+                              profile=profile_name,
+                              dataset_id=str(dataset_id)).write(_logger)
+            limits = {}
+        limits = dict((name, int(value)) for name, value in limits.items()
+                      if value is not None)
+        return self._create_volume(dataset_id, size, limits)
+
+    def list_volume_limits(self):
+        """Return the QoS limits of all managed volumes.
+
+        ``BlockDeviceVolume`` has no room for them, so this goes along with
+        ``list_volumes``.
+        :return: dictionary of blockdevice_id to a dictionary with the
+            ``bandwidth_limit`` (bytes per second) and ``iops_limit`` of the
+            volume, ``None`` where there is no limit.
+        """
+        return dict((vol['name'], dict((limit, vol.get(limit))
+                                       for limit in QOS_LIMITS))
+                    for vol in self._array.list_volumes(qos=True)
+                    if vol['name'].startswith(self._vol_prefix))
+
+    @_instrumented
+    def clone_volume(self, source_dataset_id, dataset_id):
+        """Create a new volume with the contents of an existing one.
+
+        The copy is made by the array (``copy_volume``) and only shares the
+        source's data until either volume is written, so it takes about as
+        long as creating an empty volume regardless of the size. The source
+        may be attached and in use.
+        :param source_dataset_id: The Flocker dataset ID of the volume to
+            copy.
+        :param dataset_id: The Flocker dataset ID for the new volume.
+        :raises UnknownVolume: If there is no volume for
+            ``source_dataset_id``.
+        :return: A ``BlockDeviceVolume`` of the new volume.
+        """
+        source_name = self._vol_name_from_dataset_id(source_dataset_id)
+        vol_name = self._vol_name_from_dataset_id(dataset_id)
+        self._log_info("Cloning Volume {0} to {1}", source_name, vol_name)
+        self._free_volume_name(vol_name)
+        try:
+            pure_vol = self._array.copy_volume(source_name, vol_name)
+        except purestorage.PureHTTPError as err:
+            if (err.code == 400 and
+                    (ERR_MSG_NOT_EXIST in err.text
+                     or ERR_MSG_PENDING_ERADICATION in err.text)):
+                raise blockdevice.UnknownVolume(source_name)
+            raise
+        volume = blockdevice.BlockDeviceVolume(
+            blockdevice_id=unicode(vol_name),
+            size=pure_vol['size'],
+            attached_to=None,
+            dataset_id=dataset_id,
+        )
+        self._volume_list.update(volume)
+        return volume
 
+    @_instrumented
     def destroy_volume(self, blockdevice_id):
         """
         Destroy an existing volume.
@@ -523,24 +1642,81 @@ class FlashArrayBlockDeviceAPI(object):
         :return: ``None``
         """
         try:
-            eliot.Message.new(Info="Destroying Volume" + str(blockdevice_id)).write(_logger)
+            self.destroy_volumes([blockdevice_id])
+        except BatchOperationError as err:
+            raise err.failures[blockdevice_id]
+
+    @_instrumented
+    @_volume_locked
+    def destroy_volumes(self, blockdevice_ids):
+        """
+        Destroy several volumes.
+
+        For more than one volume the connections of all of them are looked up
+        with a single request, and only volumes connected to this node are
+        disconnected before they are destroyed in parallel. When
+        ``pure_eradicate_after`` is set the destroyed volumes are eradicated
+        in the background that many seconds later.
+        :param blockdevice_ids: The unique identifiers of the volumes.
+        :raises BatchOperationError: If any of the volumes could not be
+            destroyed, with the ``destroy_volume`` exception of each of them.
+            The other volumes are destroyed regardless.
+        :return: ``None``
+        """
+        self._log_info("Destroying volumes {0}", blockdevice_ids)
+        connections = None
+        if len(blockdevice_ids) > 1:
+            connections = self._list_volume_connections()
+
+        def destroy(blockdevice_id):
+            if self._claimed.take([blockdevice_id]):
+                self._detach_device(blockdevice_id)
+            elif connections is None:
+                # Disconnect speculatively rather than asking first, normally
+                # it won't be connected.
+                self._destroy_disconnect(blockdevice_id)
+            elif self._purity_hostname in [
+                    connection['host']
+                    for connection in connections.get(blockdevice_id, [])]:
+                self._destroy_disconnect(blockdevice_id)
+            self._device_index.remove(blockdevice_id)
             try:
-                self._disconnect_volume(blockdevice_id)
-            except blockdevice.UnattachedVolume:
-                # Don't worry if it is not connected, normally it won't be
-                pass
-            self._array.destroy_volume(blockdevice_id)
-        except purestorage.PureHTTPError as err:
-            if (err.code == 400 and
-                    (ERR_MSG_NOT_EXIST in err.text
-                     or ERR_MSG_PENDING_ERADICATION in err.text)):
-                raise blockdevice.UnknownVolume(blockdevice_id)
-            else:
+                self._array.destroy_volume(blockdevice_id)
+            except purestorage.PureHTTPError as err:
+                if (err.code == 400 and
+                        (ERR_MSG_NOT_EXIST in err.text
+                         or ERR_MSG_PENDING_ERADICATION in err.text)):
+                    raise blockdevice.UnknownVolume(blockdevice_id)
                 eliot.Message.new(Error="Failed to delete volume for dataset "
                                   + str(blockdevice_id),
-                            Exception=err).write(_logger)
+                                  Exception=err).write(_logger)
                 raise
 
+        failures = {}
+        destroyed = []
+        for blockdevice_id, (_, err) in zip(
+                blockdevice_ids, parallel_map(destroy, blockdevice_ids)):
+            if err is None:
+                destroyed.append(blockdevice_id)
+            else:
+                failures[blockdevice_id] = err
+
+        if self._eradicator is not None:
+            self._eradicator.schedule(destroyed)
+        for blockdevice_id in destroyed:
+            self._volume_list.remove(blockdevice_id)
+        if failures:
+            # Failed volumes may be half way, list them again
+            self._volume_list.invalidate()
+            raise BatchOperationError(failures, [])
+
+    def _destroy_disconnect(self, blockdevice_id):
+        try:
+            self._disconnect_volume(blockdevice_id)
+        except blockdevice.UnattachedVolume:
+            pass
+
+    @_instrumented
     def attach_volume(self, blockdevice_id, attach_to):
         """
         Attach ``blockdevice_id`` to the node indicated by ``attach_to``.
@@ -556,27 +1732,247 @@ class FlashArrayBlockDeviceAPI(object):
         :returns: A ``BlockDeviceVolume`` with a ``attached_to`` attribute set
             to ``attach_to``.
         """
+        try:
+            return self.attach_volumes([blockdevice_id], attach_to)[0]
+        except BatchOperationError as err:
+            raise err.failures[blockdevice_id]
 
-        eliot.Message.new(Info="Attaching volume %s to %s" %
-                               (blockdevice_id, attach_to)).write(_logger)
-        # Connect the volume internally in Purity so it is exposed for the
-        # initiator.
-        target_info = self._connect_volume(blockdevice_id)
+    @_instrumented
+    def attach_volumes(self, blockdevice_ids, attach_to):
+        """
+        Attach several volumes to the node indicated by ``attach_to``.
+
+        All volumes are connected in Purity first, then the initiator looks
+        for all of them with a single rescan of each SCSI host and waits for
+        their multipath devices together. Only volumes which don't show up
+        that way, e.g. because this node isn't logged in to the array yet, go
+        through a full os-brick connection.
+        :param blockdevice_ids: The unique identifiers of the volumes.
+        :param unicode attach_to: See ``attach_volume``.
+        :raises BatchOperationError: If any of the volumes could not be
+            attached, with the ``attach_volume`` exception of each of them.
+            The other volumes are attached regardless.
+        :returns: A list of ``BlockDeviceVolume`` with ``attached_to`` set to
+            ``attach_to``, in the order of ``blockdevice_ids``.
+        """
+        # Concurrent requests to attach the same volumes all get the outcome
+        # of the first, rather than racing into connect_host and the rescans
+        # again only to fail with AlreadyAttachedVolume.
+        return self._single_flight.do(
+            ('attach_volumes', tuple(blockdevice_ids), attach_to),
+            self._attach_volumes, blockdevice_ids, attach_to)
+
+    @_volume_locked
+    def _attach_volumes(self, blockdevice_ids, attach_to):
+        """Attach the volumes, see ``attach_volumes``."""
+        self._log_info("Attaching volumes {0} to {1}", blockdevice_ids,
+                       attach_to)
+        failures = {}
+
+        # Volumes made from spare volumes are connected here already
+        claimed = self._claimed.take(blockdevice_ids)
+        pure_vols = self._claimed_devices(claimed, failures)
+        for blockdevice_id in claimed:
+            # Keep the claim so retries don't connect the volume again
+            if blockdevice_id in failures and not isinstance(
+                    failures[blockdevice_id], blockdevice.UnknownVolume):
+                self._claimed.add(blockdevice_id)
+        pure_vols.update(self._attach_devices(
+            [blockdevice_id for blockdevice_id in blockdevice_ids
+             if blockdevice_id not in pure_vols and
+             blockdevice_id not in failures], failures))
 
-        # Do initiator connection steps to attach and discover the device.
-        self._connector.connect_volume(target_info)
+        volumes = []
+        for blockdevice_id in blockdevice_ids:
+            if blockdevice_id in failures:
+                continue
+            volume = pure_vols[blockdevice_id]
+            volumes.append(blockdevice.BlockDeviceVolume(
+                blockdevice_id=volume['name'],
+                size=volume['size'],
+                attached_to=attach_to,
+                dataset_id=self._dataset_id_from_vol_name(volume['name'])
+            ))
+        if self._log_enabled(logging.INFO):
+            self._log_info("Finished attaching volumes {0}",
+                           [volume.blockdevice_id for volume in volumes])
+        for volume in volumes:
+            self._volume_list.update(volume)
+        if failures:
+            self._volume_list.invalidate()
+            raise BatchOperationError(failures, volumes)
+        return volumes
 
-        volume = self._array.get_volume(blockdevice_id)
-        eliot.Message.new(Info="Finished attaching volume" + str(blockdevice_id)).write(_logger)
+    def _attach_devices(self, blockdevice_ids, failures):
+        """Connect the volumes to our Purity host and bring up their devices.
 
+        :param failures: dictionary the exception for each volume which
+            could not be attached is added to.
+        :return: dictionary of the Purity volume dictionary of each volume.
+        """
+        # Connect the volumes internally in Purity so they are exposed for
+        # the initiator.
+        connections = {}
+        for blockdevice_id in blockdevice_ids:
+            try:
+                connections[blockdevice_id] = self._connect_volume(blockdevice_id)
+            except Exception as err:
+                failures[blockdevice_id] = err
+
+        # A volume destroyed meanwhile, e.g. by another node, is missing from
+        # the listing.
+        pure_vols = self._get_volumes(list(connections))
+        for blockdevice_id in list(connections):
+            if blockdevice_id not in pure_vols:
+                failures[blockdevice_id] = blockdevice.UnknownVolume(
+                    blockdevice_id)
+                del connections[blockdevice_id]
+
+        # Try and pick up all the new LUNs by scanning for them, then do the
+        # full initiator connection steps for anything that didn't show up.
+        serials = dict((pure_vols[name]['serial'].lower(), name)
+                       for name in connections)
+        luns = dict((serial, connections[name]['lun'])
+                    for serial, name in serials.items())
+        for serial, device in self._discover_devices(luns).items():
+            self._device_index.add(serials[serial], serial, device)
+            del connections[serials[serial]]
+
+        def connect(blockdevice_id):
+            self._run_connector(self._connector.connect_volume,
+                                connections[blockdevice_id])
+
+        pending = list(connections)
+        for blockdevice_id, (_, err) in zip(pending,
+                                            parallel_map(connect, pending)):
+            if err is not None:
+                failures[blockdevice_id] = err
+        return dict((name, volume) for name, volume in pure_vols.items()
+                    if name not in failures)
+
+    def _claimed_devices(self, blockdevice_ids, failures):
+        """Return the Purity volume dictionaries of claimed volumes.
+
+        Their devices are normally in the device index. If an entry is gone,
+        e.g. dropped when the index was rebuilt after a restart, the device
+        is found again from the existing connection to our host rather than
+        connecting the volume once more.
+        :param failures: dictionary the exception for each volume whose
+            device could not be found is added to.
+        """
+        try:
+            pure_vols = self._get_volumes(blockdevice_ids)
+        except Exception as err:
+            failures.update((blockdevice_id, err)
+                            for blockdevice_id in blockdevice_ids)
+            return {}
+        for blockdevice_id in blockdevice_ids:
+            volume = pure_vols.get(blockdevice_id)
+            if volume is None:
+                failures[blockdevice_id] = blockdevice.UnknownVolume(
+                    blockdevice_id)
+            elif self._device_index.lookup(blockdevice_id) is None:
+                try:
+                    self._find_claimed_device(blockdevice_id, volume)
+                except Exception as err:
+                    failures[blockdevice_id] = err
+        return dict((name, volume) for name, volume in pure_vols.items()
+                    if name not in failures)
+
+    def _find_claimed_device(self, blockdevice_id, volume):
+        """Bring up the device of a claimed volume missing from the index."""
+        connection = self._get_connection(blockdevice_id)
+        try:
+            self._get_device_path(blockdevice_id, connection, volume['serial'])
+            return
+        except blockdevice.UnattachedVolume:
+            pass
+        serial = volume['serial'].lower()
+        found = self._discover_devices({serial: connection['lun']})
+        if serial in found:
+            self._device_index.add(blockdevice_id, serial, found[serial])
+        else:
+            self._run_connector(self._connector.connect_volume, connection)
 
-        return blockdevice.BlockDeviceVolume(
-            blockdevice_id=volume['name'],
-            size=volume['size'],
-            attached_to=attach_to,
-            dataset_id=self._dataset_id_from_vol_name(volume['name'])
-        )
+    def _get_volumes(self, vol_names):
+        """Return the Purity volume dictionaries of ``vol_names``.
 
+        A single volume is fetched directly, for more than that the volume
+        list is fetched once instead of each volume in turn.
+        """
+        if len(vol_names) <= 1:
+            return dict((name, self._array.get_volume(name))
+                        for name in vol_names)
+        wanted = set(vol_names)
+        return dict((vol['name'], vol) for vol in self._array.list_volumes()
+                    if vol['name'] in wanted)
+
+    def _scan_targets(self):
+        """Return the SCSI targets to scan to find newly connected volumes.
+
+        With persistent iSCSI sessions any portal without a session is
+        logged in to first.
+        :return: list of ``(host, channel, target_id)``, empty when a scan
+            alone is not enough, i.e. when there are array portals this node
+            has no iSCSI session with or no array FC port is zoned to it.
+        """
+        if self._conf.storage_protocol == FIBRE_CHANNEL:
+            return sorted(set((path['host'], path['channel'], path['target_id'])
+                              for path in self._fc_zoning.get_paths()))
+        if self._session_keeper is not None:
+            with self._initiator_phase('ensure_iscsi_sessions'):
+                sessions, complete = self._session_keeper.ensure_sessions()
+        else:
+            portals = set(port['portal']
+                          for port in self._get_target_iscsi_ports())
+            sessions = [session for session
+                        in devices.list_iscsi_sessions(self._sysfs_root)
+                        if session['portal'] in portals]
+            complete = set(session['portal'] for session in sessions) == portals
+        if not complete:
+            return []
+        return sorted(set((session['host'], session['channel'],
+                           session['target_id']) for session in sessions))
+
+    def _discover_devices(self, luns):
+        """Find the multipath devices of newly connected volumes by scanning
+        for their LUNs.
+
+        Each of the array's targets is scanned once, rather than everything
+        behind every SCSI host: for its LUN when there is one volume, and
+        for all of its LUNs for a batch.
+        :param luns: dictionary of the Purity serial number of each volume to
+            its LUN.
+        :return: dictionary of serial to device path for the volumes found.
+        """
+        targets = self._scan_targets()
+        if not luns or not targets:
+            return {}
+        watcher = self._device_watcher
+        if watcher is not None:
+            # Listen before rescanning so no uevent is missed
+            watcher.start()
+        scan_luns = sorted(set(luns.values()))
+        if len(scan_luns) > 1:
+            scan_luns = ['-']
+        try:
+            with self._initiator_phase('rescan_scsi_host'):
+                for host, channel, target_id in targets:
+                    for lun in scan_luns:
+                        devices.rescan_scsi_host(host, channel, target_id, lun,
+                                                 sysfs_root=self._sysfs_root)
+        except (IOError, OSError) as err:
+            eliot.Message.new(warning='Unable to rescan SCSI hosts',
+                              error=str(err)).write(_logger)
+            return {}
+        with self._initiator_phase('wait_for_multipath_devices'):
+            if watcher is not None:
+                return watcher.wait_for_multipath_devices(list(luns))
+            return devices.wait_for_multipath_devices(
+                list(luns), sysfs_root=self._sysfs_root,
+                dev_root=self._dev_root)
+
+    @_instrumented
     def detach_volume(self, blockdevice_id):
         """
         Detach ``blockdevice_id`` from whatever host it is attached to.
@@ -588,35 +1984,206 @@ class FlashArrayBlockDeviceAPI(object):
             not attached to anything.
         :returns: ``None``
         """
-        eliot.Message.new(Info="Detaching volume" + str(blockdevice_id)).write(_logger)
-        target_info = self._get_target_info(blockdevice_id)
+        try:
+            self.detach_volumes([blockdevice_id])
+        except BatchOperationError as err:
+            raise err.failures[blockdevice_id]
+
+    @_instrumented
+    @_volume_locked
+    def detach_volumes(self, blockdevice_ids):
+        """
+        Detach several volumes from this node.
+
+        With FC or persistent iSCSI sessions only the volumes' own devices are
+        removed, see ``_detach_device``. Otherwise the connections of all
+        volumes are looked up together, os-brick tears down the initiator
+        side of the volumes in parallel and then the volumes are disconnected
+        in Purity.
+        :param blockdevice_ids: The unique identifiers of the volumes.
+        :raises BatchOperationError: If any of the volumes could not be
+            detached, with the ``detach_volume`` exception of each of them.
+            The other volumes are detached regardless.
+        :returns: ``None``
+        """
+        self._log_info("Detaching volumes {0}", blockdevice_ids)
+        failures = {}
+        # Volumes made from spare volumes are detached like any other
+        self._claimed.take(blockdevice_ids)
+        if self._detach_devices_only:
+            connected = list(blockdevice_ids)
+            for blockdevice_id, (_, err) in zip(
+                    connected, parallel_map(self._detach_device, connected)):
+                if err is not None:
+                    failures[blockdevice_id] = err
+        else:
+            connected = self._detach_with_connector(blockdevice_ids, failures)
+
+        if self._log_enabled(logging.INFO):
+            self._log_info("Finished detaching volumes {0}",
+                           [blockdevice_id for blockdevice_id in connected
+                            if blockdevice_id not in failures])
+        for blockdevice_id in connected:
+            if blockdevice_id not in failures:
+                self._volume_list.detached(blockdevice_id)
+        if failures:
+            self._volume_list.invalidate()
+            raise BatchOperationError(failures, [])
+
+    @property
+    def _detach_devices_only(self):
+        """Whether detaching leaves the sessions (or FC logins) alone."""
+        return (self._conf.storage_protocol == FIBRE_CHANNEL or
+                self._session_keeper is not None)
+
+    def _detach_device(self, blockdevice_id):
+        """Detach ``blockdevice_id`` by removing only its own devices.
+
+        The device comes from the device index, so normally the array is
+        only asked to disconnect the volume. The multipath map is flushed
+        once, after which nothing can use its paths any more, so the volume
+        is disconnected in Purity while the path devices are deleted in
+        parallel.
+        :raises UnknownVolume: If the volume does not exist.
+        :raises UnattachedVolume: If it is not connected to our host.
+        """
+        path = self._device_index.lookup(blockdevice_id)
+        if path is None:
+            with self._initiator_phase('find_multipath_device'):
+                path = devices.find_multipath_device(
+                    self._get_volume_serial(blockdevice_id),
+                    self._sysfs_root, self._dev_root)
+        slaves = []
+        if path is not None:
+            slaves = devices.list_multipath_slaves(path, self._sysfs_root)
+            map_name = devices.read_dm_name(os.path.basename(path),
+                                            self._sysfs_root)
+            # No name means the map is already gone
+            if map_name is not None:
+                with self._initiator_phase('flush_multipath_map'):
+                    devices.flush_multipath_map(map_name)
+        self._device_index.remove(blockdevice_id)
+
+        def delete_paths():
+            with self._initiator_phase('delete_scsi_devices'):
+                devices.delete_scsi_devices(slaves, self._sysfs_root)
+
+        results = parallel_map(lambda step: step(), [
+            functools.partial(self._disconnect_volume, blockdevice_id),
+            delete_paths,
+        ])
+        for _, err in results:
+            if err is not None:
+                raise err
+
+    def _detach_with_connector(self, blockdevice_ids, failures):
+        """Detach the volumes with os-brick, see ``detach_volumes``.
+
+        :param failures: dictionary the exception for each volume which
+            could not be detached is added to.
+        :return: the volumes which were connected to our host.
+        """
+        connections = self._get_connections(blockdevice_ids, failures)
+
+        def disconnect(blockdevice_id):
+            self._run_connector(self._connector.disconnect_volume,
+                                connections[blockdevice_id], None)
 
+        connected = [blockdevice_id for blockdevice_id in blockdevice_ids
+                     if blockdevice_id in connections]
         # Disconnect on the initiator first
-        self._connector.disconnect_volume(target_info, None)
+        for blockdevice_id, (_, err) in zip(connected,
+                                            parallel_map(disconnect, connected)):
+            if err is not None:
+                failures[blockdevice_id] = err
+                continue
+            self._device_index.remove(blockdevice_id)
+            # Now disconnect internally in Purity
+            try:
+                self._disconnect_volume(blockdevice_id)
+            except Exception as err:
+                failures[blockdevice_id] = err
+        return connected
+
+    def _get_connections(self, vol_names, failures):
+        """Return the connection of each of ``vol_names`` to our host.
+
+        Like ``_get_connection``, but a single array-wide query is used for
+        more than one volume.
+        :param failures: dictionary the exception for each volume without a
+            connection is added to.
+        :return: dictionary of volume name to Purity connection dictionary.
+        """
+        all_connections = {}
+        if len(vol_names) > 1:
+            all_connections = self._list_volume_connections()
+        connections = {}
+        for name in vol_names:
+            for connection in all_connections.get(name, []):
+                if connection['host'] == self._purity_hostname:
+                    connections[name] = connection
+                    break
+            else:
+                # Not in the bulk listing (or there wasn't one), ask about
+                # this volume to tell unknown from unattached volumes.
+                try:
+                    connections[name] = self._get_connection(name)
+                except Exception as err:
+                    failures[name] = err
+        return connections
+
+    def _list_volume_connections(self, prefix=None):
+        """Return the private host connections of every Flocker volume.
 
-        # Now disconnect internally in Purity
-        self._disconnect_volume(blockdevice_id)
-        eliot.Message.new(Info="Finished detaching volume" + str(blockdevice_id)).write(_logger)
+        A single array-wide query is joined in memory by the callers instead
+        of asking the array for each volume's connections in turn.
 
+        :param prefix: Name prefix of the volumes, by default that of the
+            Flocker volumes.
+        :return: dictionary of volume name to a list of Purity connection
+            dictionaries (``host`` and ``lun``).
+        """
+        prefix = prefix or self._vol_prefix
+        connections = {}
+        for connection in self._array.list_volumes(connect=True):
+            name = connection['name']
+            # Shared (host group) connections were never reported by
+            # list_volume_private_connections, keep it that way.
+            if connection.get('hgroup') or not name.startswith(prefix):
+                continue
+            connections.setdefault(name, []).append(connection)
+        return connections
+
+    @_instrumented
     def list_volumes(self):
         """
         Return ``BlockDeviceVolume`` instances for all managed volumes.
+
+        The volumes are listed from a snapshot kept for
+        ``pure_volume_list_ttl`` seconds, see ``VolumeListCache``.
         """
+        return self._volume_list.get()
+
+    def _list_volumes(self):
+        """List the managed volumes and where they are attached on the
+        array."""
         volumes = []
         pure_vols = self._array.list_volumes()
+        if not self._index_complete:
+            self._device_index.rebuild(dict(
+                (vol['serial'], vol['name']) for vol in pure_vols
+                if vol['name'].startswith((self._vol_prefix,
+                                           self._pool_prefix))))
+            self._index_complete = True
+        connections = self._list_volume_connections()
         for vol in pure_vols:
             name = vol['name']
             if name.startswith(self._vol_prefix):
-                eliot.Message.new(Info="Found Purity volume managed by flocker " + str(vol)).write(_logger)
+                if len(volumes) < LOG_SAMPLE_SIZE:
+                    self._log_debug(
+                        "Found Purity volume managed by flocker {0}", vol)
                 attached_to = None
-                try:
-                    host_connections = self._array.list_volume_private_connections(name)
-                except purestorage.PureHTTPError as err:
-                    if err.code == 400 and ERR_MSG_NOT_EXIST in err.text:
-                        break  # Carry on... nothing to see here...
-                    else:
-                        raise
-                for connection in host_connections:
+                for connection in connections.get(name, []):
                     # Look for one thats our host, if not we'll take anything
                     # else that is connected. It *should* only ever be one
                     # host, but just in case we loop through them all...
@@ -624,7 +2191,8 @@ class FlashArrayBlockDeviceAPI(object):
                         # Make sure there is a path on the system, meaning
                         # it is fully attached.
                         try:
-                            self.get_device_path(name)
+                            self._get_device_path(name, connection,
+                                                  vol['serial'])
                         except blockdevice.UnattachedVolume:
                             pass
                         else:
@@ -632,7 +2200,9 @@ class FlashArrayBlockDeviceAPI(object):
                             break
                     else:
                         attached_to = connection['host']
-                eliot.Message.new(Info="Volume %s attached_to = %s" % (vol['name'], attached_to)).write(_logger)
+                if len(volumes) < LOG_SAMPLE_SIZE:
+                    self._log_debug("Volume {0} attached_to = {1}",
+                                    name, attached_to)
 
                 volumes.append(blockdevice.BlockDeviceVolume(
                     blockdevice_id=name,
@@ -640,8 +2210,16 @@ class FlashArrayBlockDeviceAPI(object):
                     attached_to=attached_to,
                     dataset_id=self._dataset_id_from_vol_name(name),
                 ))
+        if self._log_enabled(logging.INFO):
+            self._log_info("Found Purity volumes managed by flocker",
+                           volumes=len(volumes),
+                           attached_here=len([
+                               volume for volume in volumes
+                               if volume.attached_to == self._purity_hostname
+                           ]))
         return volumes
 
+    @_instrumented
     def get_device_path(self, blockdevice_id):
         """
         Return the device path that has been allocated to the block device on
@@ -657,49 +2235,96 @@ class FlashArrayBlockDeviceAPI(object):
             not attached to a host.
         :returns: A ``FilePath`` for the device.
         """
-        eliot.Message.new(Info="Looking for a volume path for {0}"
-                          .format(blockdevice_id)).write(_logger)
+        self._log_info("Looking for a volume path for {0}", blockdevice_id)
 
-        if blockdevice_id in self._volume_path_cache:
-            path = self._volume_path_cache[blockdevice_id]
-            eliot.Message.new(Info="Found volume path for {0} in cache at {1}"
-                          .format(blockdevice_id, path)).write(_logger)
-            return filepath.FilePath(path)
+        def lookup():
+            # Wait for an attach or detach of the volume in progress
+            with self._volume_locks.hold([blockdevice_id]):
+                return self._get_device_path(blockdevice_id)
+        return self._single_flight.do(('get_device_path', blockdevice_id),
+                                      lookup)
 
-        target_info = self._get_target_info(blockdevice_id)
+    def _get_volume_serial(self, vol_name):
+        """Return the Purity serial number of ``vol_name``."""
+        try:
+            return self._array.get_volume(vol_name)['serial']
+        except purestorage.PureHTTPError as err:
+            if err.code == 400 and ERR_MSG_NOT_EXIST in err.text:
+                raise blockdevice.UnknownVolume(vol_name)
+            else:
+                raise
 
-        host_devices = self._connector.get_volume_paths(target_info)
-        eliot.Message.new(Info="Found volume paths for {0} at {1}"
-                          .format(blockdevice_id, host_devices)).write(_logger)
+    def _get_device_path(self, blockdevice_id, connection=None, serial=None):
+        """Find the local device path for ``blockdevice_id``.
 
-        valid_device = None
-        if host_devices:
-            valid_device = next(dev for dev in host_devices if os.path.exists(dev))
+        :param connection: Optional Purity connection dictionary for this
+            host, as returned by ``_list_volume_connections``. When given the
+            array is not asked whether the volume is connected again.
+        :param serial: Optional Purity serial number of the volume.
+        :returns: A ``FilePath`` for the device.
+        """
+        path = self._device_index.lookup(blockdevice_id)
+        if path is not None:
+            self._log_debug("Found volume path for {0} in index at {1}",
+                            blockdevice_id, path)
+            return filepath.FilePath(path)
 
-        if not valid_device:
+        if connection is None:
+            # Raises if the volume isn't connected to this host
+            self._get_connection(blockdevice_id)
+        if serial is None:
+            serial = self._get_volume_serial(blockdevice_id)
+
+        # Go straight from the serial to the multipath device in sysfs rather
+        # than scanning the output of multipath -l.
+        with self._initiator_phase('find_multipath_device'):
+            path = devices.find_multipath_device(serial, self._sysfs_root,
+                                                 self._dev_root)
+        if path is None:
             raise blockdevice.UnattachedVolume(blockdevice_id)
 
-        # Slow way, check the output of multipath -l, and scan through the devices
-        # TODO: check if friendly names are off and just use /dev/mapper/<WWN>
-        valid_device = os.path.realpath(valid_device)
-        mpath_info = self._connector._linuxscsi.find_multipath_device(valid_device)
-        path = mpath_info['device']
-
-        eliot.Message.new(Info="Using volume path for {0} at {1}"
-                          .format(blockdevice_id, path)).write(_logger)
+        self._log_info("Using volume path for {0} at {1}", blockdevice_id,
+                       path)
 
-        self._volume_path_cache[blockdevice_id] = path
+        self._device_index.add(blockdevice_id, serial, path)
         return filepath.FilePath(path)
 
 
 def pure_from_configuration(cluster_id, pure_ip, pure_api_token,
                             pure_storage_protocol, pure_manage_purity_hosts,
                             pure_chap_host_user, pure_chap_host_password,
-                            pure_verify_https, pure_ssl_cert):
+                            pure_verify_https, pure_ssl_cert,
+                            pure_port_cache_ttl=None, pure_state_dir=None,
+                            pure_api_pool_size=None, pure_api_max_retries=None,
+                            pure_log_level=None, pure_metrics_textfile=None,
+                            pure_metrics_port=None, pure_profiles=None,
+                            pure_eradicate_after=None,
+                            pure_iscsi_session_interval=None,
+                            pure_warm_pool_size=None,
+                            pure_volume_list_ttl=None, metrics_registry=None):
     """
     :param cluster_id: Flocker cluster id.
     :param pure_ip: Management IP Address for the Array
     :param pure_api_token: API Token for management REST API calls.
+    :param pure_port_cache_ttl: Seconds to cache the array target ports.
+    :param pure_state_dir: Directory for state kept across agent restarts.
+    :param pure_api_pool_size: Maximum number of REST connections.
+    :param pure_api_max_retries: Retries for throttled or failed REST calls.
+    :param pure_log_level: Lowest level of driver and os-brick messages logged.
+    :param pure_metrics_textfile: File to write Prometheus metrics to.
+    :param pure_metrics_port: Local port to serve Prometheus metrics on.
+    :param pure_profiles: Storage profile names to dictionaries of QoS limits.
+    :param pure_eradicate_after: Seconds after which destroyed volumes are
+        eradicated, ``None`` to leave them to Purity.
+    :param pure_iscsi_session_interval: Seconds between checks of the iSCSI
+        sessions to the array, 0 (the default) to leave the sessions to
+        os-brick.
+    :param pure_warm_pool_size: Number of spare volumes kept connected to
+        this node for new datasets.
+    :param pure_volume_list_ttl: Seconds to keep the snapshot of the volume
+        list, 0 to list the volumes on every call.
+    :param metrics_registry: Optional ``metrics.Registry`` shared with the
+        APIs of other arrays.
     :return: FlashArrayBlockDeviceAPI object
     """
     return FlashArrayBlockDeviceAPI(
@@ -711,7 +2336,20 @@ def pure_from_configuration(cluster_id, pure_ip, pure_api_token,
             pure_chap_host_user,
             pure_chap_host_password,
             pure_verify_https,
-            pure_ssl_cert
+            pure_ssl_cert,
+            port_cache_ttl=pure_port_cache_ttl,
+            state_dir=pure_state_dir,
+            api_pool_size=pure_api_pool_size,
+            api_max_retries=pure_api_max_retries,
+            log_level=pure_log_level,
+            metrics_textfile=pure_metrics_textfile,
+            metrics_port=pure_metrics_port,
+            profiles=pure_profiles,
+            eradicate_after=pure_eradicate_after,
+            iscsi_session_interval=pure_iscsi_session_interval,
+            warm_pool_size=pure_warm_pool_size,
+            volume_list_ttl=pure_volume_list_ttl
         ),
         cluster_id=cluster_id,
+        metrics_registry=metrics_registry,
     )
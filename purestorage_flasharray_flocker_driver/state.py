@@ -0,0 +1,70 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Small JSON documents the driver keeps on local disk across agent restarts.
+
+All of them are optimisations, so failing to read or write one is logged
+and otherwise ignored. They are only readable by the agent's user.
+"""
+
+import binascii
+import errno
+import json
+import os
+
+import eliot
+
+_logger = eliot.Logger()
+
+
+def load(path):
+    """Return the document stored at ``path``, or ``None``."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (IOError, OSError, ValueError) as err:
+        eliot.Message.new(warning='Ignoring unreadable state file',
+                          path=path,
+                          error=str(err)).write(_logger)
+        return None
+
+
+def save(path, document):
+    """Atomically replace the document stored at ``path``."""
+    if not path:
+        return
+    tmp_path = path + '.tmp'
+    try:
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as state_file:
+            json.dump(document, state_file)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        eliot.Message.new(warning='Unable to save state file',
+                          path=path,
+                          error=str(err)).write(_logger)
+
+
+def secret(path):
+    """Return the random key of this node stored at ``path``, made the first
+    time it is needed.
+
+    Digests of credentials kept in the other documents are keyed with it,
+    so they can't be checked against guessed credentials without it. If it
+    can't be stored a new key is returned, which matches nothing stored.
+    """
+    key = (load(path) or {}).get('key')
+    if not key:
+        key = binascii.hexlify(os.urandom(32)).decode('ascii')
+        save(path, {'key': key})
+    return key
@@ -0,0 +1,52 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Eliot actions for the phases of the driver's operations.
+
+Every block device operation is an eliot action, and the REST calls and
+initiator work it is made of are nested actions of their own, so the agent's
+log shows where the time of a slow attach went. ``latency_report`` turns
+such a log into a latency breakdown per phase.
+"""
+
+import contextlib
+import time
+
+import eliot
+
+_logger = eliot.Logger()
+
+ACTION_PREFIX = 'purestorage:'
+
+
+@contextlib.contextmanager
+def phase(name, **fields):
+    """Run the ``with`` block as the eliot action ``purestorage:<name>``.
+
+    The action is nested in the current one (if any) and its success message
+    carries the ``seconds`` it took.
+    """
+    start = time.time()
+    with eliot.start_action(_logger, action_type=ACTION_PREFIX + name,
+                            **fields) as action:
+        try:
+            yield action
+        finally:
+            action.add_success_fields(seconds=time.time() - start)
+
+
+def in_current_action(function):
+    """Return ``function`` running in the current eliot action.
+
+    Eliot keeps the current action per thread, so this is needed for the
+    phases of work handed to other threads to nest in the operation.
+    """
+    action = eliot.current_action()
+    if action is None:
+        return function
+
+    def run(*args, **kwargs):
+        with action.context():
+            return function(*args, **kwargs)
+    return run
@@ -0,0 +1,145 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Spare volumes created and connected to this node ahead of time.
+
+Creating the volume of a new dataset and attaching it costs an array create,
+a ``connect_host``, a rescan and waiting for the multipath device to settle,
+all while the container waits for it. With ``pure_warm_pool_size`` set the
+driver keeps that many small spare volumes connected in the background, and
+``create_volume`` renames and extends one of them for the dataset instead,
+so the ``attach_volume`` following it finds the device already there.
+"""
+
+import threading
+
+import eliot
+
+from purestorage_flasharray_flocker_driver import state
+
+_logger = eliot.Logger()
+
+DEFAULT_REFILL_INTERVAL = 60  # seconds
+
+
+class WarmPool(object):
+    """Keep ``size`` spare volumes ready to be taken.
+
+    :param size: number of spare volumes to keep.
+    :param find: callable returning the names of the spare volumes left
+        ready by an earlier run, called once when the pool starts.
+    :param fill: callable making ``count`` new spare volumes ready, returning
+        the names of those it could.
+    :param interval: seconds between checks that the pool is full, it is
+        also refilled as soon as a volume is taken.
+    """
+    def __init__(self, size, find, fill, interval=DEFAULT_REFILL_INTERVAL):
+        self._size = size
+        self._find = find
+        self._fill = fill
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._ready = []
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ready)
+
+    def start(self):
+        """Find the existing spare volumes and keep the pool full, in the
+        background."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._keep,
+                                            name='purestorage-warm-pool')
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def take(self):
+        """Return the name of a ready spare volume, which is no longer part
+        of the pool, or ``None`` if there is none right now."""
+        with self._lock:
+            name = self._ready.pop(0) if self._ready else None
+        self._wakeup.set()
+        return name
+
+    def load(self):
+        """Add the spare volumes left by an earlier run to the pool."""
+        names = self._find()
+        with self._lock:
+            self._ready.extend(name for name in names
+                               if name not in self._ready)
+
+    def refill(self):
+        """Make new spare volumes until there are ``size`` of them."""
+        with self._lock:
+            missing = self._size - len(self._ready)
+        if missing <= 0:
+            return
+        names = self._fill(missing)
+        with self._lock:
+            self._ready.extend(names)
+
+    def _keep(self):
+        try:
+            self.load()
+        except Exception as err:
+            eliot.Message.new(warning='Unable to find spare volumes',
+                              error=str(err)).write(_logger)
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                self.refill()
+            except Exception as err:
+                eliot.Message.new(warning='Unable to refill the warm pool',
+                                  error=str(err)).write(_logger)
+            self._wakeup.wait(self._interval)
+
+
+class ClaimedVolumes(object):
+    """Names of the volumes ``create_volume`` made from spare volumes.
+
+    They are connected to this node, and the ``attach_volume`` following
+    their creation only has to hand them over. The names are persisted as
+    JSON at ``path`` (if given) so that still works after an agent restart.
+    """
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._names = set()
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._names
+
+    def load(self):
+        """Load the names persisted by an earlier run."""
+        names = state.load(self._path) or []
+        with self._lock:
+            self._names = set(names)
+
+    def add(self, name):
+        with self._lock:
+            self._names.add(name)
+            self._save()
+
+    def take(self, names):
+        """Remove ``names`` and return those which were claimed."""
+        with self._lock:
+            claimed = [name for name in names if name in self._names]
+            if claimed:
+                self._names.difference_update(claimed)
+                self._save()
+            return claimed
+
+    def _save(self):
+        state.save(self._path, sorted(self._names))
@@ -0,0 +1,148 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Scale benchmark of ``FlashArrayBlockDeviceAPI`` against a simulated array.
+
+Runs the driver against ``tests.utils.simulated_flasharray`` with a given
+number of Flocker volumes on the array and reports the time taken by each
+operation along with the REST requests it made, e.g.::
+
+    python -m tests.benchmark --volumes 10 1000 10000 --latency 0.002
+
+No array, initiator or root access is needed.
+"""
+
+import argparse
+import functools
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from tests.utils import simulated_flasharray
+
+DEFAULT_VOLUME_COUNTS = (10, 1000, 10000)
+DEFAULT_LATENCY = 0.002  # seconds per REST request
+DEFAULT_ITEM_LATENCY = 0.00001  # seconds per item in a REST response
+DEFAULT_SAMPLES = 5
+
+
+class OperationStats(object):
+    """Timings and REST requests of the calls of one operation."""
+    def __init__(self, name):
+        self.name = name
+        self.seconds = []
+        self.requests = 0
+        self.request_seconds = 0.0
+
+    def row(self):
+        calls = len(self.seconds)
+        return (self.name, calls,
+                1000 * sum(self.seconds) / calls,
+                1000 * max(self.seconds),
+                float(self.requests) / calls,
+                1000 * self.request_seconds / calls)
+
+
+def measure(server, stats, function, *args):
+    """Call ``function`` and add its cost to ``stats``."""
+    requests = server.request_count()
+    request_seconds = server.request_seconds
+    start = time.time()
+    result = function(*args)
+    stats.seconds.append(time.time() - start)
+    stats.requests += server.request_count() - requests
+    stats.request_seconds += server.request_seconds - request_seconds
+    return result
+
+
+def run(volume_count, samples=DEFAULT_SAMPLES, latency=DEFAULT_LATENCY,
+        item_latency=DEFAULT_ITEM_LATENCY):
+    """Benchmark the driver with ``volume_count`` volumes on the array.
+
+    :param samples: Number of volumes attached, looked up and detached.
+    :return: list of ``OperationStats``, and the REST requests made by
+        endpoint.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        server = simulated_flasharray.SimulatedFlashArrayServer(
+            latency=latency, item_latency=item_latency)
+        cluster_id = uuid.uuid4()
+        names = []
+        for _ in range(volume_count):
+            # Same naming as FlashArrayBlockDeviceAPI._vol_name_from_dataset_id
+            name = 'flocker-{0}'.format(cluster_id)[:26] + '-' + str(uuid.uuid4())
+            server.add_volume(name)
+            names.append(name)
+
+        operations = ['__init__', 'list_volumes (first)', 'list_volumes',
+                      'attach_volume', 'get_device_path',
+                      'list_volumes (attached)', 'detach_volume']
+        stats = dict((name, OperationStats(name)) for name in operations)
+        # Measure the listings themselves rather than the volume list
+        # snapshot.
+        api = measure(server, stats['__init__'],
+                      functools.partial(simulated_flasharray.build_simulated_api,
+                                        volume_list_ttl=0),
+                      server, directory, cluster_id)
+        measure(server, stats['list_volumes (first)'], api.list_volumes)
+        for _ in range(samples):
+            measure(server, stats['list_volumes'], api.list_volumes)
+
+        attach_to = api.compute_instance_id()
+        sampled = names[:samples]
+        for name in sampled:
+            measure(server, stats['attach_volume'], api.attach_volume,
+                    name, attach_to)
+        for name in sampled:
+            measure(server, stats['get_device_path'], api.get_device_path,
+                    name)
+        for _ in range(samples):
+            measure(server, stats['list_volumes (attached)'],
+                    api.list_volumes)
+        for name in sampled:
+            measure(server, stats['detach_volume'], api.detach_volume, name)
+
+        return ([stats[name] for name in operations if stats[name].seconds],
+                dict(server.requests))
+    finally:
+        shutil.rmtree(directory)
+
+
+def report(volume_count, stats, requests, out=sys.stdout):
+    out.write('\n{0} volumes\n'.format(volume_count))
+    out.write('{0:<26}{1:>7}{2:>12}{3:>12}{4:>12}{5:>12}\n'.format(
+        'operation', 'calls', 'mean ms', 'max ms', 'REST/call',
+        'REST ms'))
+    for row in stats:
+        out.write('{0:<26}{1:>7}{2:>12.2f}{3:>12.2f}{4:>12.1f}{5:>12.2f}\n'
+                  .format(*row.row()))
+    out.write('REST requests by endpoint:\n')
+    for endpoint, count in sorted(requests.items()):
+        out.write('  {0:<32}{1:>8}\n'.format(endpoint, count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--volumes', type=int, nargs='+',
+                        default=list(DEFAULT_VOLUME_COUNTS),
+                        help='Numbers of volumes on the array to run with.')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                        help='Volumes to attach, look up and detach.')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help='Seconds taken by every REST request.')
+    parser.add_argument('--item-latency', type=float,
+                        default=DEFAULT_ITEM_LATENCY,
+                        help='Additional seconds per item in a response.')
+    args = parser.parse_args(argv)
+    for volume_count in args.volumes:
+        stats, requests = run(volume_count, args.samples, args.latency,
+                              args.item_latency)
+        report(volume_count, stats, requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``purestorage_flasharray_flocker_driver.async_blockdevice``.
+"""
+
+import os
+from uuid import uuid4
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+from zope.interface.verify import verifyObject
+
+from flocker.node.agents import blockdevice
+
+import purestorage_flasharray_flocker_driver
+from purestorage_flasharray_flocker_driver import async_blockdevice
+from tests.utils import simulated_flasharray
+
+
+class ThreadPoolReactor(object):
+    """Just enough of a reactor to size its thread pool."""
+    thread_pool_size = None
+
+    def suggestThreadPoolSize(self, size):
+        self.thread_pool_size = size
+
+
+class AsyncBackendTests(SynchronousTestCase):
+    """
+    Tests for the ``async_blockdevice`` backend.
+    """
+    def setUp(self):
+        directory = self.mktemp()
+        os.makedirs(directory)
+        self.api = simulated_flasharray.build_simulated_api(
+            simulated_flasharray.SimulatedFlashArrayServer(), directory)
+        self.patch(purestorage_flasharray_flocker_driver, 'api_factory',
+                   lambda cluster_id, **kwargs: self.api)
+        self.reactor = ThreadPoolReactor()
+
+    def test_deployer(self):
+        """
+        The backend's API is the synchronous one, which the block device
+        deployer runs on the reactor's thread pool, sized as configured.
+        """
+        api = async_blockdevice.FLOCKER_BACKEND.api_factory(
+            cluster_id=uuid4(), reactor=self.reactor, pure_ip=u'array',
+            pure_api_token=u'token', pure_async_threads=16)
+        deployer = blockdevice.BlockDeviceDeployer(
+            hostname=u'192.0.2.1',
+            node_uuid=uuid4(),
+            block_device_api=api,
+            mountroot=FilePath(self.mktemp()),
+        )
+        self.assertTrue(verifyObject(blockdevice.IBlockDeviceAPI,
+                                     deployer.block_device_api))
+        self.assertTrue(verifyObject(blockdevice.IProfiledBlockDeviceAPI,
+                                     deployer.block_device_api))
+        self.assertEqual(
+            (self.api.compute_instance_id(), [], True, 16),
+            (deployer.block_device_api.compute_instance_id(),
+             deployer.block_device_api.list_volumes(),
+             isinstance(deployer.async_block_device_api,
+                        blockdevice._SyncToThreadedAsyncAPIAdapter),
+             self.reactor.thread_pool_size)
+        )
+
+    def test_default_thread_pool(self):
+        """
+        Without ``pure_async_threads`` the reactor's thread pool is left as
+        it is.
+        """
+        api = async_blockdevice.api_factory(uuid4(), self.reactor)
+        self.assertEqual((self.api, None), (api, self.reactor.thread_pool_size))
@@ -0,0 +1,38 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``tests.benchmark`` and the simulated array it runs against.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from tests import benchmark
+
+
+class BenchmarkTests(SynchronousTestCase):
+    """
+    Tests for ``benchmark.run``.
+    """
+    def requests_per_call(self, volume_count):
+        stats, _ = benchmark.run(volume_count, samples=2, latency=0,
+                                 item_latency=0)
+        return dict((row.name, float(row.requests) / len(row.seconds))
+                    for row in stats)
+
+    def test_rest_requests_independent_of_volume_count(self):
+        """
+        The number of REST requests of each operation does not grow with the
+        number of volumes on the array.
+        """
+        self.assertEqual(self.requests_per_call(2),
+                         self.requests_per_call(50))
+
+    def test_list_volumes_requests(self):
+        """
+        Listing volumes takes one request for the volumes and one for their
+        connections, also when some of them are attached here.
+        """
+        requests = self.requests_per_call(10)
+        self.assertEqual((2, 2), (requests['list_volumes'],
+                                  requests['list_volumes (attached)']))
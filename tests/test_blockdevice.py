@@ -0,0 +1,1226 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``FlashArrayBlockDeviceAPI`` against a simulated array.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from uuid import uuid4
+
+from twisted.trial.unittest import SynchronousTestCase
+
+import eliot
+
+from flocker.node.agents import blockdevice
+
+from purestorage_flasharray_flocker_driver import devices
+from purestorage_flasharray_flocker_driver import eradication
+from purestorage_flasharray_flocker_driver import iscsi
+from purestorage_flasharray_flocker_driver import metrics
+from purestorage_flasharray_flocker_driver import multi_array
+from purestorage_flasharray_flocker_driver import purestorage_blockdevice
+from purestorage_flasharray_flocker_driver import warm_pool
+from purestorage_flasharray_flocker_driver.purestorage_blockdevice import MiB
+from tests.test_devices import make_fc_host, make_fc_remote_port
+from tests.test_locking import wait_until
+from tests.utils import simulated_flasharray
+
+
+class SimulatedArrayTestCase(SynchronousTestCase):
+    """
+    Test case with a ``FlashArrayBlockDeviceAPI`` using a simulated array.
+    """
+    def setUp(self):
+        self.server = simulated_flasharray.SimulatedFlashArrayServer()
+        self.directory = self.mktemp()
+        os.makedirs(self.directory)
+        self.api = self.build_api()
+
+    def build_api(self, **kwargs):
+        return simulated_flasharray.build_simulated_api(
+            self.server, self.directory, **kwargs)
+
+
+class CloneVolumeTests(SimulatedArrayTestCase):
+    """
+    Tests for ``clone_volume``.
+    """
+    def test_clone(self):
+        """
+        The clone is a new volume of the source's size, named for the new
+        dataset, and made by the array from the source.
+        """
+        source = self.api.create_volume(uuid4(), 8 * MiB)
+        dataset_id = uuid4()
+        clone = self.api.clone_volume(source.dataset_id, dataset_id)
+        self.assertEqual(
+            (dataset_id, 8 * MiB, None, source.blockdevice_id),
+            (clone.dataset_id, clone.size, clone.attached_to,
+             self.server.volumes[clone.blockdevice_id]['source'])
+        )
+        self.assertIn(clone, self.api.list_volumes())
+
+    def test_unknown_source(self):
+        """
+        Cloning a dataset without a volume raises ``UnknownVolume``.
+        """
+        self.assertRaises(blockdevice.UnknownVolume,
+                          self.api.clone_volume, uuid4(), uuid4())
+
+
+class ProfileTests(SimulatedArrayTestCase):
+    """
+    Tests for ``create_volume_with_profile`` and ``list_volume_limits``.
+    """
+    def test_default_profiles(self):
+        """
+        Flocker's profiles create volumes with their QoS limits.
+        """
+        gold = self.api.create_volume_with_profile(uuid4(), MiB, u'gold')
+        bronze = self.api.create_volume_with_profile(uuid4(), MiB, u'BRONZE')
+        self.assertEqual(
+            {gold.blockdevice_id: {'bandwidth_limit': None,
+                                   'iops_limit': None},
+             bronze.blockdevice_id: {'bandwidth_limit': 100 * MiB,
+                                     'iops_limit': 10000}},
+            self.api.list_volume_limits()
+        )
+
+    def test_configured_profile(self):
+        """
+        Profiles from the configuration can add to the default ones.
+        """
+        api = self.build_api(profiles={'Analytics': {'iops_limit': 500}})
+        volume = api.create_volume_with_profile(uuid4(), MiB, u'analytics')
+        self.assertEqual({'bandwidth_limit': None, 'iops_limit': 500},
+                         api.list_volume_limits()[volume.blockdevice_id])
+
+    def test_unknown_profile(self):
+        """
+        A volume with an unknown profile is created without limits.
+        """
+        volume = self.api.create_volume_with_profile(uuid4(), MiB,
+                                                     u'platinum')
+        self.assertEqual([volume], self.api.list_volumes())
+        self.assertEqual({'bandwidth_limit': None, 'iops_limit': None},
+                         self.api.list_volume_limits()[volume.blockdevice_id])
+
+
+class ColdStartTests(SimulatedArrayTestCase):
+    """
+    Tests for what starting the agent sets up.
+    """
+    def test_no_initiator_setup(self):
+        """
+        Starting and listing the volumes neither set up os-brick nor listen
+        for uevents.
+        """
+        def os_brick_connector():
+            raise AssertionError('os-brick was set up')
+        self.patch(purestorage_blockdevice, 'os_brick_connector',
+                   os_brick_connector)
+        self.patch(devices, 'read_iscsi_initiator_name',
+                   lambda: simulated_flasharray.INITIATOR_IQN)
+        self.server.add_volume(u'other')
+        configuration = purestorage_blockdevice.PureFlashArrayConfiguration(
+            'simulated-array', 'simulated-api-token',
+            purestorage_blockdevice.ISCSI, True, None, None, False, None,
+            state_dir=os.path.join(self.directory, 'cold'))
+        api = purestorage_blockdevice.FlashArrayBlockDeviceAPI(
+            configuration, uuid4(),
+            array_factory=lambda: simulated_flasharray.SimulatedFlashArray(
+                self.server),
+            sysfs_root=os.path.join(self.directory, 'sys'),
+            dev_root=os.path.join(self.directory, 'dev'))
+        self.assertEqual(([], None, None),
+                         (api.list_volumes(), api._initiator_connector,
+                          api._watcher))
+
+
+class DeviceIndexTests(SimulatedArrayTestCase):
+    """
+    Tests for the device index of the API.
+    """
+    def test_lost_index(self):
+        """
+        When the index file was lost the devices of the attached volumes are
+        indexed again from the first volume list.
+        """
+        cluster_id = uuid4()
+        api = self.build_api(cluster_id=cluster_id)
+        volume = api.create_volume(uuid4(), MiB)
+        api.attach_volume(volume.blockdevice_id, api.compute_instance_id())
+        device = api.get_device_path(volume.blockdevice_id).path
+        os.remove(os.path.join(self.directory, 'state',
+                               purestorage_blockdevice.DEVICE_INDEX_FILE))
+        restarted = self.build_api(cluster_id=cluster_id)
+        restarted.list_volumes()
+        self.assertEqual(device,
+                         restarted._device_index.lookup(volume.blockdevice_id))
+
+
+class PurityHostTests(SimulatedArrayTestCase):
+    """
+    Tests for resolving the Purity host of the node.
+    """
+    def start(self, **kwargs):
+        """Start an agent and return the Purity host it uses, counting the
+        requests finding it took."""
+        api = self.build_api(**kwargs)
+        self.server.reset_stats()
+        return api.compute_instance_id()
+
+    def test_cached_host(self):
+        """
+        After a restart the remembered host is confirmed with a single
+        request.
+        """
+        name = self.start()
+        self.assertEqual((name, {'GET host/:name': 1}),
+                         (self.start(), self.server.requests))
+
+    def test_initiators_changed(self):
+        """
+        When the node's initiators changed the hosts are scanned again, and
+        the missing initiator is added to the host.
+        """
+        name = self.start()
+        iqn = u'iqn.1993-08.org.debian:01:second'
+        initiator_info = {'wwpns': [], 'initiator': [
+            simulated_flasharray.INITIATOR_IQN, iqn]}
+        self.assertEqual(
+            (name, {'GET host': 1, 'PUT host/:name': 1}, 2),
+            (self.start(initiator_info=initiator_info), self.server.requests,
+             len(self.server.hosts[name]['iqn']))
+        )
+
+    def test_chap(self):
+        """
+        The CHAP credentials are only set on the host again when they
+        changed, and can't be read from the state directory.
+        """
+        self.start(chap_host_user=u'user', chap_host_password=u'secret')
+        self.start(chap_host_user=u'user', chap_host_password=u'secret')
+        unchanged_requests = dict(self.server.requests)
+        self.start(chap_host_user=u'user', chap_host_password=u'changed')
+        path = os.path.join(self.directory, 'state',
+                            purestorage_blockdevice.PURITY_HOST_FILE)
+        with open(path) as state_file:
+            content = state_file.read()
+        self.assertEqual(
+            ({'GET host/:name': 1}, 1, 0o600, False),
+            (unchanged_requests, self.server.requests['PUT host/:name'],
+             os.stat(path).st_mode & 0o777,
+             hashlib.sha1(b'user:changed').hexdigest() in content)
+        )
+
+    def test_unmanaged_host_lost_initiator(self):
+        """
+        An unmanaged host is only used again while it has one of the node's
+        initiators for the protocol in use, other protocols don't count.
+        """
+        self.server.hosts[u'node'] = {
+            'name': u'node', 'hgroup': None,
+            'iqn': [simulated_flasharray.INITIATOR_IQN],
+            'wwn': [u'10000090fa000001']}
+        initiator_info = {'wwpns': [u'10000090fa000001'],
+                          'initiator': [simulated_flasharray.INITIATOR_IQN]}
+        self.assertEqual(u'node', self.start(manage_purity_hosts=False,
+                                             initiator_info=initiator_info))
+        self.server.hosts[u'node']['iqn'] = []
+        self.assertRaises(
+            purestorage_blockdevice.UnmanagedPurityHostNotFoundException,
+            self.start, manage_purity_hosts=False,
+            initiator_info=initiator_info)
+
+    def test_scan_logged_on_miss(self):
+        """
+        The scan of the Purity hosts is only reported when none of them is
+        the node's, not when the host named for the node is found.
+        """
+        name = self.start()
+        messages = []
+        eliot.add_destinations(messages.append)
+        self.addCleanup(eliot.remove_destination, messages.append)
+        # Messages written before the first destination are replayed to it
+        del messages[:]
+        self.server.hosts[name]['iqn'] = []
+        self.start()
+        self.server.hosts.clear()
+        self.start()
+        self.assertEqual(1, len([
+            message for message in messages
+            if message.get('Info', '').startswith('Scanned Purity hosts')]))
+
+
+class LogLevelTests(SimulatedArrayTestCase):
+    """
+    Tests for the ``log_level`` of the driver and of os-brick's messages.
+    """
+    def setUp(self):
+        super(LogLevelTests, self).setUp()
+        self.patch(purestorage_blockdevice, '_log_threshold', None)
+        self.messages = []
+        eliot.add_destinations(self.messages.append)
+        self.addCleanup(eliot.remove_destination, self.messages.append)
+        # Messages written before the first destination are replayed to it
+        del self.messages[:]
+
+    def test_per_api(self):
+        """
+        Each API logs debug messages at its own level, os-brick's messages
+        at the most verbose one.
+        """
+        debug = self.build_api(log_level=u'DEBUG')
+        warning = self.build_api(log_level=u'WARNING')
+        debug._log_debug('debug {0}', 1)
+        warning._log_debug('warning {0}', 2)
+        self.assertEqual(
+            ([u'debug 1'], True),
+            ([message['debug'] for message in self.messages
+              if 'debug' in message],
+             purestorage_blockdevice.log_enabled(logging.DEBUG))
+        )
+
+
+    def test_warning_level(self):
+        """
+        With ``log_level`` WARNING the driver writes no info messages.
+        """
+        api = self.build_api(log_level=u'WARNING')
+        volume = api.create_volume(uuid4(), MiB)
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertEqual([], [message for message in self.messages
+                              if 'Info' in message])
+
+
+class EliotOsloLogProxyTests(SynchronousTestCase):
+    """
+    Tests for ``EliotOsloLogProxy``.
+    """
+    def setUp(self):
+        self.patch(purestorage_blockdevice, '_log_threshold', logging.INFO)
+        self.messages = []
+        eliot.add_destinations(self.messages.append)
+        self.addCleanup(eliot.remove_destination, self.messages.append)
+        # Messages written before the first destination are replayed to it
+        del self.messages[:]
+        self.proxy = purestorage_blockdevice.EliotOsloLogProxy(
+            purestorage_blockdevice._logger, 'os_brick')
+
+    def test_filtering(self):
+        """
+        Messages below the level are dropped without formatting their
+        arguments.
+        """
+        class Unformattable(object):
+            def __str__(self):
+                raise AssertionError('formatted')
+        self.proxy.debug('dropped %s', Unformattable())
+        self.proxy.log(logging.DEBUG, 'dropped %s', Unformattable())
+        self.proxy.info('info %s', 1)
+        self.proxy.warning('warning')
+        self.proxy.log(logging.ERROR, 'error %d', 2)
+        self.assertEqual(
+            ([{'info': u'info 1'}, {'warning': u'warning'},
+              {'level': logging.ERROR, 'msg': u'error 2'}],
+             [False, True]),
+            ([dict((key, message[key]) for key in
+                   ('info', 'warning', 'level', 'msg') if key in message)
+              for message in self.messages],
+             [self.proxy.isEnabledFor(logging.DEBUG),
+              self.proxy.isEnabledFor(logging.INFO)])
+        )
+
+    def test_format(self):
+        """
+        Arguments are formatted like the logging module does, a single dict
+        being a mapping, and arguments not matching the message are shown
+        after it.
+        """
+        self.assertEqual(
+            ['a 1 b', 'volume vol-1', 'a %d (\'b\',)', 'a 100%'],
+            [self.proxy._format('a %s %s', (1, 'b')),
+             self.proxy._format('volume %(name)s', ({'name': 'vol-1'},)),
+             self.proxy._format('a %d', ('b',)),
+             self.proxy._format('a %d%%', (100,))]
+        )
+
+
+class InstrumentationTests(SimulatedArrayTestCase):
+    """
+    Tests for the operation metrics of the API.
+    """
+    def test_counted_once(self):
+        """
+        A single volume operation is counted under its own name, not also
+        under the batch operation doing the work.
+        """
+        registry = metrics.Registry()
+        api = self.build_api(metrics_registry=registry)
+        volume = api.create_volume(uuid4(), MiB)
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertRaises(blockdevice.UnknownVolume,
+                          api.destroy_volume, u'unknown')
+        rendered = registry.render()
+        self.assertEqual(
+            (1, 0, True, False),
+            (api._operation_errors.value(array='simulated-array',
+                                         operation='destroy_volume',
+                                         error='UnknownVolume'),
+             api._operation_errors.value(array='simulated-array',
+                                         operation='destroy_volumes',
+                                         error='UnknownVolume'),
+             'operation="destroy_volume"} 2.0' in rendered,
+             'operation="destroy_volumes"' in rendered)
+        )
+
+
+class DetachVolumeTests(SimulatedArrayTestCase):
+    """
+    Tests for ``detach_volume`` leaving the iSCSI sessions alone.
+    """
+    def setUp(self):
+        SimulatedArrayTestCase.setUp(self)
+
+        def run_iscsiadm(*args):
+            raise OSError('iscsiadm is not available')
+        self.patch(iscsi, 'run_iscsiadm', run_iscsiadm)
+        self.flushed = []
+        self.patch(devices, 'flush_multipath_map', self.flushed.append)
+        self.api = self.build_api(iscsi_session_interval=3600)
+
+    def test_detach_device_only(self):
+        """
+        The volume's multipath map is flushed by its name and its paths
+        deleted, and the array is only asked to disconnect the volume.
+        """
+        volume = self.api.create_volume(uuid4(), MiB)
+        self.api.attach_volume(volume.blockdevice_id,
+                               self.api.compute_instance_id())
+        device = self.api.get_device_path(volume.blockdevice_id)
+        self.server.reset_stats()
+
+        self.api.detach_volume(volume.blockdevice_id)
+        delete = os.path.join(self.directory, 'sys', 'block',
+                              'sd' + device.basename()[3:], 'device', 'delete')
+        with open(delete) as delete_file:
+            deleted = delete_file.read()
+        self.assertEqual(
+            ([devices.pure_wwid(self.server.volumes[volume.blockdevice_id]
+                                ['serial'])], '1',
+             {'DELETE host/:name/volume/:name': 1}, {}),
+            (self.flushed, deleted, self.server.requests,
+             self.server.connections[volume.blockdevice_id])
+        )
+
+    def test_detach_unattached(self):
+        """
+        Detaching a volume which isn't attached raises ``UnattachedVolume``.
+        """
+        volume = self.api.create_volume(uuid4(), MiB)
+        self.assertRaises(blockdevice.UnattachedVolume,
+                          self.api.detach_volume, volume.blockdevice_id)
+
+
+class BatchAttachDetachTests(SimulatedArrayTestCase):
+    """
+    Tests for ``attach_volumes`` and ``detach_volumes``.
+    """
+    TARGETS = [('host3', '0', '0'), ('host4', '0', '0')]
+
+    def setUp(self):
+        SimulatedArrayTestCase.setUp(self)
+        self.rescans = []
+        connector = self.api._connector
+        self.connected = []
+        self.patch(connector, 'connect_volume', self.connected.append)
+
+        def rescan_scsi_host(host, channel, target_id, lun, sysfs_root):
+            # The kernel brings up every LUN connected since the last scan
+            self.rescans.append((host, channel, target_id, lun))
+            present = devices.list_multipath_devices(sysfs_root)
+            with self.server._lock:
+                serials = [self.server.volumes[name]['serial']
+                           for name, hosts in self.server.connections.items()
+                           if hosts]
+            for serial in serials:
+                if serial.lower() not in present:
+                    connector.add_device(serial)
+        self.patch(devices, 'rescan_scsi_host', rescan_scsi_host)
+        self.patch(self.api, '_scan_targets', lambda: list(self.TARGETS))
+        # Poll for the devices rather than listen for uevents
+        self.api._watcher = False
+        self.attach_to = self.api.compute_instance_id()
+
+    def create_volumes(self, count):
+        return [self.api.create_volume(uuid4(), MiB).blockdevice_id
+                for _ in range(count)]
+
+    def test_attach_batch(self):
+        """
+        A batch of volumes is connected with one rescan of each target and
+        one listing of the volumes, without os-brick.
+        """
+        ids = self.create_volumes(3)
+        self.server.reset_stats()
+        attached = self.api.attach_volumes(ids, self.attach_to)
+        paths = set(self.api.get_device_path(blockdevice_id)
+                    for blockdevice_id in ids)
+        self.assertEqual(
+            ([(blockdevice_id, self.attach_to) for blockdevice_id in ids],
+             [target + ('-',) for target in self.TARGETS], 3, [],
+             {'POST host/:name/volume/:name': 3, 'GET volume': 1}),
+            ([(volume.blockdevice_id, volume.attached_to)
+              for volume in attached], self.rescans, len(paths),
+             self.connected, self.server.requests)
+        )
+
+    def test_attach_single(self):
+        """
+        A single volume is only scanned for at its own LUN.
+        """
+        [blockdevice_id] = self.create_volumes(1)
+        self.api.attach_volume(blockdevice_id, self.attach_to)
+        [lun] = self.server.connections[blockdevice_id].values()
+        self.assertEqual([target + (lun,) for target in self.TARGETS],
+                         self.rescans)
+
+    def test_attach_failures(self):
+        """
+        Volumes which can't be attached are reported with their own
+        exception, and the others are attached regardless.
+        """
+        first, attached, last = self.create_volumes(3)
+        self.api.attach_volume(attached, self.attach_to)
+        error = self.assertRaises(
+            purestorage_blockdevice.BatchOperationError,
+            self.api.attach_volumes, [first, u'unknown', attached, last],
+            self.attach_to)
+        self.assertEqual(
+            ({u'unknown': blockdevice.UnknownVolume,
+              attached: blockdevice.AlreadyAttachedVolume},
+             [first, last]),
+            (dict((blockdevice_id, type(err))
+                  for blockdevice_id, err in error.failures.items()),
+             [volume.blockdevice_id for volume in error.results])
+        )
+
+    def test_attach_destroyed_meanwhile(self):
+        """
+        A volume destroyed after it was connected, and so missing from the
+        listing of the connected volumes, is reported as unknown and the
+        others are attached regardless.
+        """
+        first, destroyed, last = self.create_volumes(3)
+        get_volumes = self.api._get_volumes
+
+        def destroy_and_get_volumes(vol_names):
+            if destroyed in vol_names:
+                with self.server._lock:
+                    del self.server.volumes[destroyed]
+                    del self.server.connections[destroyed]
+            return get_volumes(vol_names)
+        self.patch(self.api, '_get_volumes', destroy_and_get_volumes)
+        error = self.assertRaises(
+            purestorage_blockdevice.BatchOperationError,
+            self.api.attach_volumes, [first, destroyed, last],
+            self.attach_to)
+        self.assertEqual(
+            ({destroyed: blockdevice.UnknownVolume}, [first, last]),
+            (dict((blockdevice_id, type(err))
+                  for blockdevice_id, err in error.failures.items()),
+             [volume.blockdevice_id for volume in error.results])
+        )
+
+    def test_detach_failures(self):
+        """
+        Volumes which can't be detached are reported with their own
+        exception, and the others are detached regardless.
+        """
+        first, unattached, last = self.create_volumes(3)
+        self.api.attach_volumes([first, last], self.attach_to)
+        self.server.reset_stats()
+        error = self.assertRaises(
+            purestorage_blockdevice.BatchOperationError,
+            self.api.detach_volumes, [first, unattached, u'unknown', last])
+        self.assertEqual(
+            ({unattached: blockdevice.UnattachedVolume,
+              u'unknown': blockdevice.UnknownVolume},
+             {first: {}, last: {}}, 1),
+            (dict((blockdevice_id, type(err))
+                  for blockdevice_id, err in error.failures.items()),
+             self.server.connections, self.server.requests['GET volume'])
+        )
+
+    def test_single_volume_errors(self):
+        """
+        ``attach_volume`` and ``detach_volume`` raise the Flocker exception
+        of their volume rather than ``BatchOperationError``.
+        """
+        [blockdevice_id] = self.create_volumes(1)
+        self.assertRaises(blockdevice.UnattachedVolume,
+                          self.api.detach_volume, blockdevice_id)
+        self.assertRaises(blockdevice.UnknownVolume,
+                          self.api.detach_volume, u'unknown')
+        self.assertRaises(blockdevice.UnknownVolume,
+                          self.api.attach_volume, u'unknown', self.attach_to)
+        self.api.attach_volume(blockdevice_id, self.attach_to)
+        self.assertRaises(blockdevice.AlreadyAttachedVolume,
+                          self.api.attach_volume, blockdevice_id,
+                          self.attach_to)
+
+
+class ConcurrentAttachTests(SimulatedArrayTestCase):
+    """
+    Tests for concurrent ``attach_volume`` and ``get_device_path`` calls.
+    """
+    def test_attach_coalesced(self):
+        """
+        Attaching a volume while it is already being attached connects it
+        once, and both callers get the attached volume.
+        """
+        volume = self.api.create_volume(uuid4(), MiB)
+        release = threading.Event()
+        connect_volume = self.api._connect_volume
+
+        def slow_connect_volume(vol_name):
+            release.wait()
+            return connect_volume(vol_name)
+        self.patch(self.api, '_connect_volume', slow_connect_volume)
+        self.server.reset_stats()
+        attach_to = self.api.compute_instance_id()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.api.attach_volume(volume.blockdevice_id, attach_to)))
+            for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        wait_until(lambda: self.api._single_flight.shared)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            ([(volume.blockdevice_id, attach_to)] * 2, 1),
+            ([(result.blockdevice_id, result.attached_to)
+              for result in results],
+             self.server.requests.get('POST host/:name/volume/:name', 0))
+        )
+        self.assertEqual(self.api.get_device_path(volume.blockdevice_id),
+                         self.api.get_device_path(volume.blockdevice_id))
+
+
+class WarmPoolTests(SimulatedArrayTestCase):
+    """
+    Tests for creating volumes from the spare volumes of the warm pool.
+    """
+    def setUp(self):
+        SimulatedArrayTestCase.setUp(self)
+        self.resized = []
+        self.patch(devices, 'resize_multipath_map', self.resized.append)
+        self.patch(devices, 'flush_multipath_map', lambda dm_name: None)
+        self.api = self.build_api(warm_pool_size=2)
+        wait_until(lambda: len(self.api._warm_pool) == 2)
+        # Keep the refills out of the request counts
+        self.api._warm_pool.stop()
+        self.server.reset_stats()
+
+    def test_create_attach(self):
+        """
+        A new volume is a renamed and extended spare volume. It is returned
+        and listed as attached to this node, so no other node takes it, and
+        ``attach_volume`` hands it over without connecting it or looking for
+        its device.
+        """
+        device = self.api._device_index.lookup(self.api._warm_pool._ready[0])
+        dataset_id = uuid4()
+        volume = self.api.create_volume(dataset_id, 8 * MiB)
+        listed = self.api.list_volumes()
+        self.server.reset_stats()
+
+        attached = self.api.attach_volume(volume.blockdevice_id,
+                                          self.api.compute_instance_id())
+        self.assertEqual(
+            (self.api.compute_instance_id(),
+             [(volume.blockdevice_id, dataset_id, 8 * MiB,
+               self.api.compute_instance_id())],
+             (8 * MiB, self.api.compute_instance_id()),
+             {'GET volume/:name': 1}, 1),
+            (volume.attached_to,
+             [(listed.blockdevice_id, listed.dataset_id, listed.size,
+               listed.attached_to) for listed in listed],
+             (attached.size, attached.attached_to),
+             self.server.requests, len(self.resized))
+        )
+        self.assertEqual(
+            device, self.api.get_device_path(volume.blockdevice_id).path)
+
+    def test_listed_attached(self):
+        """
+        Before it is handed over the new volume is listed as attached to
+        this node on the array as well, and its device can be used.
+        """
+        device = self.api._device_index.lookup(self.api._warm_pool._ready[0])
+        volume = self.api.create_volume(uuid4(), MiB)
+        self.api._volume_list.invalidate()
+        self.assertEqual(
+            ([self.api.compute_instance_id()], device),
+            ([listed.attached_to for listed in self.api.list_volumes()],
+             self.api.get_device_path(volume.blockdevice_id).path)
+        )
+
+    def test_claim_survives_restart(self):
+        """
+        After an agent restart a volume made from a spare volume is still
+        handed over, rather than connected again.
+        """
+        volume = self.api.create_volume(uuid4(), MiB)
+        api = self.build_api()
+        self.server.reset_stats()
+        attached = api.attach_volume(volume.blockdevice_id,
+                                     api.compute_instance_id())
+        self.assertEqual(
+            (api.compute_instance_id(), 0),
+            (attached.attached_to,
+             self.server.requests.get('POST host/:name/volume/:name', 0))
+        )
+
+    def test_resize_and_detach_fail(self):
+        """
+        When the device of the spare volume can neither be resized nor
+        detached, the spare is destroyed and the volume created as usual.
+        """
+        def fail(dm_name):
+            raise OSError('multipath failed')
+        self.patch(devices, 'resize_multipath_map', fail)
+        self.patch(devices, 'flush_multipath_map', fail)
+        spare = self.api._warm_pool._ready[0]
+        volume = self.api.create_volume(uuid4(), 8 * MiB)
+        self.assertEqual(
+            (None, 1, True, 8 * MiB),
+            (volume.attached_to, self.server.requests['POST volume/:name'],
+             self.server.volumes[spare]['destroyed'],
+             self.server.volumes[volume.blockdevice_id]['size'])
+        )
+
+    def test_claimed_not_indexed(self):
+        """
+        A volume made from a spare volume whose device is missing from the
+        index is still handed over, finding its device from its existing
+        connection rather than connecting it again.
+        """
+        volume = self.api.create_volume(uuid4(), MiB)
+        device = self.api._device_index.lookup(volume.blockdevice_id)
+        self.api._device_index.remove(volume.blockdevice_id)
+        self.server.reset_stats()
+        attached = self.api.attach_volume(volume.blockdevice_id,
+                                          self.api.compute_instance_id())
+        self.assertEqual(
+            (self.api.compute_instance_id(), 0, device),
+            (attached.attached_to,
+             self.server.requests.get('POST host/:name/volume/:name', 0),
+             self.api.get_device_path(volume.blockdevice_id).path)
+        )
+
+    def test_detach_claimed(self):
+        """
+        A volume made from a spare volume can be detached before it was
+        handed over.
+        """
+        volume = self.api.create_volume(uuid4(), MiB)
+        self.api.detach_volume(volume.blockdevice_id)
+        self.assertEqual(
+            ({}, [None]),
+            (self.server.connections[volume.blockdevice_id],
+             [listed.attached_to for listed in self.api.list_volumes()])
+        )
+
+    def test_unconnected_spare_destroyed(self):
+        """
+        Spare volumes connected to no node are destroyed when the pool is
+        loaded.
+        """
+        name = self.api._pool_prefix + uuid4().hex
+        self.server.add_volume(name)
+        self.assertEqual(
+            (sorted(self.api._warm_pool._ready), True),
+            (sorted(self.api._find_spare_volumes()),
+             self.server.volumes[name]['destroyed'])
+        )
+
+    def test_new_unconnected_spare_kept(self):
+        """
+        Spare volumes connected to no node yet are left alone while they are
+        new, another node may be about to connect them.
+        """
+        name = self.api._pool_prefix + uuid4().hex
+        self.server.add_volume(name)
+        self.server.volumes[name]['created'] = time.strftime(
+            '%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.api._find_spare_volumes()
+        self.assertEqual(False, self.server.volumes[name]['destroyed'])
+
+    def test_pool_empty(self):
+        """
+        Without spare volumes left volumes are created as usual.
+        """
+        for _ in range(3):
+            self.api.create_volume(uuid4(), MiB)
+        self.assertEqual(1, self.server.requests['POST volume/:name'])
+
+    def test_destroy_unattached(self):
+        """
+        Destroying a volume made from a spare volume before it was attached
+        removes its device from this node.
+        """
+        volume = self.api.create_volume(uuid4(), MiB)
+        self.api.destroy_volume(volume.blockdevice_id)
+        self.assertEqual(
+            (None, {}, True, []),
+            (self.api._device_index.lookup(volume.blockdevice_id),
+             self.server.connections[volume.blockdevice_id],
+             self.server.volumes[volume.blockdevice_id]['destroyed'],
+             self.api.list_volumes())
+        )
+
+
+class WarmPoolRefillTests(SynchronousTestCase):
+    """
+    Tests for ``WarmPool``.
+    """
+    def test_refill(self):
+        """
+        The spare volumes of an earlier run are used, and the pool is only
+        filled up to its size.
+        """
+        made = []
+
+        def fill(count):
+            names = ['spare-{0}'.format(len(made) + index)
+                     for index in range(count)]
+            made.extend(names)
+            return names
+        pool = warm_pool.WarmPool(3, lambda: ['old'], fill)
+        pool.load()
+        pool.refill()
+        taken = [pool.take(), pool.take()]
+        pool.refill()
+        self.assertEqual(
+            (['old', 'spare-0'], ['spare-0', 'spare-1', 'spare-2', 'spare-3'],
+             3),
+            (taken, made, len(pool))
+        )
+
+
+class PortTopologyCacheTests(SynchronousTestCase):
+    """
+    Tests for ``PortTopologyCache``.
+    """
+    def test_ttl(self):
+        """
+        The ports are listed again once the cache expired or was
+        invalidated.
+        """
+        server = simulated_flasharray.SimulatedFlashArrayServer()
+        now = [0]
+        cache = purestorage_blockdevice.PortTopologyCache(
+            simulated_flasharray.SimulatedFlashArray(server), 60,
+            clock=lambda: now[0])
+        cache.get_iscsi_ports()
+        now[0] = 59
+        cache.get_iscsi_ports()
+        now[0] = 60
+        cache.get_iscsi_ports()
+        cache.invalidate()
+        self.assertEqual(
+            (len(simulated_flasharray.ISCSI_PORTALS),
+             {'hits': 1, 'misses': 3}, 3),
+            (len(cache.get_iscsi_ports()), cache.stats(),
+             server.requests['GET port'])
+        )
+
+
+class RunConnectorTests(SimulatedArrayTestCase):
+    """
+    Tests for ``_run_connector`` retrying with a changed port topology.
+    """
+    def setUp(self):
+        SimulatedArrayTestCase.setUp(self)
+        self.calls = []
+        # Fill the port cache
+        self.api._format_connection_info({'lun': 1})
+        self.server.reset_stats()
+
+    def operation(self, *failures):
+        """Return an initiator operation failing with ``failures`` in turn,
+        then returning the portals it was called with."""
+        failures = list(failures)
+
+        def connect_volume(target_info):
+            self.calls.append(target_info['target_portals'])
+            if failures:
+                raise failures.pop(0)
+            return target_info['target_portals']
+        return connect_volume
+
+    def test_retry_changed_topology(self):
+        """
+        When the initiator fails and the array reports different ports, the
+        operation is retried once with them.
+        """
+        self.server.ports.pop()
+        result = self.api._run_connector(self.operation(OSError('login')),
+                                         {'lun': 1})
+        portals = list(simulated_flasharray.ISCSI_PORTALS)
+        self.assertEqual(
+            ([portals, portals[:-1]], portals[:-1], 1),
+            (self.calls, result, self.server.requests['GET port'])
+        )
+
+    def test_unchanged_topology(self):
+        """
+        When the ports did not change the initiator's error is raised
+        without retrying.
+        """
+        error = OSError('login')
+        raised = self.assertRaises(
+            OSError, self.api._run_connector, self.operation(error),
+            {'lun': 1})
+        self.assertEqual((error, 1, 1),
+                         (raised, len(self.calls),
+                          self.server.requests['GET port']))
+
+    def test_refresh_fails(self):
+        """
+        When the ports can't be listed again the initiator's error is raised,
+        not the array's.
+        """
+        error = OSError('login')
+
+        def list_ports():
+            raise RuntimeError('array unreachable')
+        self.patch(self.api._array, 'list_ports', list_ports)
+        raised = self.assertRaises(
+            OSError, self.api._run_connector, self.operation(error),
+            {'lun': 1})
+        self.assertEqual((error, 1), (raised, len(self.calls)))
+
+
+class FcZoningCacheTests(SynchronousTestCase):
+    """
+    Tests for ``FcZoningCache``.
+    """
+    class PortCache(object):
+        def get_wwns(self):
+            return ['524A937000000001', '524A937000000002']
+
+    def test_zoned_paths(self):
+        """
+        Only online remote ports of the array are paths to it, and they are
+        looked up again once the cache expired.
+        """
+        sysfs_root = self.mktemp()
+        now = [0]
+        make_fc_host(sysfs_root, 'host7', '10000090fa000001')
+        make_fc_host(sysfs_root, 'host8', '10000090fa000002')
+        make_fc_remote_port(sysfs_root, 'rport-7:0-0', '524a937000000001', 0)
+        make_fc_remote_port(sysfs_root, 'rport-7:0-1', '500a098000000009', 1)
+        make_fc_remote_port(sysfs_root, 'rport-8:0-0', '524a937000000002', 0,
+                            port_state='Blocked')
+        cache = purestorage_blockdevice.FcZoningCache(
+            self.PortCache(), 60, sysfs_root, clock=lambda: now[0])
+        path = {'initiator': '10000090fa000001', 'target': '524a937000000001',
+                'host': 'host7', 'channel': '0', 'target_id': '0'}
+        self.assertEqual([path], cache.get_paths())
+
+        make_fc_remote_port(sysfs_root, 'rport-8:0-1', '524a937000000002', 3)
+        self.assertEqual([path], cache.get_paths())
+        now[0] = 60
+        self.assertEqual(
+            [path, {'initiator': '10000090fa000002',
+                    'target': '524a937000000002',
+                    'host': 'host8', 'channel': '0', 'target_id': '3'}],
+            cache.get_paths())
+        self.assertEqual({'hits': 1, 'misses': 2}, cache.stats())
+
+
+class VolumeListCacheTests(SynchronousTestCase):
+    """
+    Tests for ``VolumeListCache``.
+    """
+    def volume(self, name, attached_to=None):
+        return blockdevice.BlockDeviceVolume(
+            blockdevice_id=name, size=MiB, attached_to=attached_to,
+            dataset_id=uuid4())
+
+    def test_expiry(self):
+        """
+        The volumes are listed again once the snapshot expired, and the
+        changes written to it are listed until then.
+        """
+        now = [0]
+        listed = [[self.volume(u'a'), self.volume(u'b')], []]
+        cache = purestorage_blockdevice.VolumeListCache(
+            lambda: listed.pop(0), 5, clock=lambda: now[0])
+        first = cache.get()
+        created = self.volume(u'c')
+        cache.update(created)
+        attached = self.volume(u'a', attached_to=u'node')
+        cache.update(attached)
+        cache.remove(u'b')
+        changed = cache.get()
+        cache.detached(u'a')
+        detached = cache.get()[0].attached_to
+        now[0] = 5
+        self.assertEqual(
+            ([u'a', u'b'], [attached, created], None, [],
+             {'hits': 2, 'misses': 2}),
+            ([volume.blockdevice_id for volume in first], changed, detached,
+             cache.get(), cache.stats())
+        )
+
+    def test_shared_refresh(self):
+        """
+        Callers finding the snapshot expired while it is being refreshed
+        share that refresh.
+        """
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(None)
+            release.wait()
+            return [self.volume(u'a')]
+        cache = purestorage_blockdevice.VolumeListCache(fetch, 5)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get()))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        wait_until(lambda: cache._flight.shared)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((1, [[u'a'], [u'a']]),
+                         (len(calls), [[volume.blockdevice_id
+                                        for volume in result]
+                                       for result in results]))
+
+    def test_write_during_refresh(self):
+        """
+        A listing which overlapped a change is not kept, as it may be from
+        before the change.
+        """
+        listed = [[], [self.volume(u'a')]]
+
+        def fetch():
+            volumes = listed.pop(0)
+            cache.update(self.volume(u'a'))
+            return volumes
+        cache = purestorage_blockdevice.VolumeListCache(fetch, 5)
+        cache.get()
+        self.assertEqual([u'a'], [volume.blockdevice_id
+                                  for volume in cache.get()])
+
+
+class VolumeListWriteThroughTests(SimulatedArrayTestCase):
+    """
+    Tests for ``list_volumes`` following the API's own changes.
+    """
+    def test_write_through(self):
+        """
+        Volumes created, attached, detached and destroyed through the API are
+        listed accordingly without listing them on the array again.
+        """
+        self.patch(devices, 'flush_multipath_map', lambda dm_name: None)
+        self.api.list_volumes()
+        self.server.reset_stats()
+        attach_to = self.api.compute_instance_id()
+        kept = self.api.create_volume(uuid4(), MiB)
+        attached = self.api.create_volume(uuid4(), 2 * MiB)
+        detached = self.api.create_volume(uuid4(), MiB)
+        destroyed = self.api.create_volume(uuid4(), MiB)
+        self.api.attach_volume(attached.blockdevice_id, attach_to)
+        self.api.attach_volume(detached.blockdevice_id, attach_to)
+        self.api.detach_volume(detached.blockdevice_id)
+        self.api.destroy_volume(destroyed.blockdevice_id)
+
+        def listing(volumes):
+            return sorted((volume.blockdevice_id, volume.size,
+                           volume.attached_to) for volume in volumes)
+        cached = listing(self.api.list_volumes())
+        self.assertEqual(
+            (sorted(listing([kept, detached]) +
+                    [(attached.blockdevice_id, 2 * MiB, attach_to)]),
+             None),
+            (cached, self.server.requests.get('GET volume'))
+        )
+        self.api._volume_list.invalidate()
+        self.assertEqual(cached, listing(self.api.list_volumes()))
+
+
+class DestroyVolumesTests(SimulatedArrayTestCase):
+    """
+    Tests for ``destroy_volumes``.
+    """
+    def test_destroy_volumes(self):
+        """
+        Connected and unconnected volumes are destroyed with one connection
+        lookup, only connected ones are disconnected, and unknown volumes
+        are reported without stopping the others.
+        """
+        volumes = [self.api.create_volume(uuid4(), MiB) for _ in range(3)]
+        ids = [volume.blockdevice_id for volume in volumes]
+        self.api.attach_volume(ids[0], self.api.compute_instance_id())
+        self.server.reset_stats()
+
+        error = self.assertRaises(purestorage_blockdevice.BatchOperationError,
+                                  self.api.destroy_volumes, ids + [u'unknown'])
+        self.assertEqual(
+            (1, 1, 4),
+            (self.server.requests['GET volume'],
+             self.server.requests['DELETE host/:name/volume/:name'],
+             self.server.requests['DELETE volume/:name'])
+        )
+        self.assertEqual([u'unknown'], list(error.failures))
+        self.assertIsInstance(error.failures[u'unknown'],
+                              blockdevice.UnknownVolume)
+        self.assertEqual([], self.api.list_volumes())
+
+    def test_recreate_with_eradication(self):
+        """
+        With eradication enabled a dataset can be created again straight
+        after its volume was destroyed.
+        """
+        api = self.build_api(eradicate_after=3600)
+        dataset_id = uuid4()
+        volume = api.create_volume(dataset_id, MiB)
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertEqual([volume], [api.create_volume(dataset_id, MiB)])
+
+
+class MultiArrayTests(SynchronousTestCase):
+    """
+    Tests for ``MultiFlashArrayBlockDeviceAPI``.
+    """
+    def setUp(self):
+        cluster_id = uuid4()
+        self.now = [0]
+        self.servers = []
+        apis = []
+        for index in range(2):
+            server = simulated_flasharray.SimulatedFlashArrayServer(
+                capacity=100 * MiB)
+            directory = self.mktemp()
+            os.makedirs(directory)
+            self.servers.append(server)
+            apis.append(simulated_flasharray.build_simulated_api(
+                server, directory, cluster_id,
+                target='array-{0}'.format(index)))
+        self.api = multi_array.MultiFlashArrayBlockDeviceAPI(
+            apis, stats_ttl=60, clock=lambda: self.now[0])
+
+    def test_placement(self):
+        """
+        New volumes go to the array with the most free space for its
+        latency, also before its statistics are refreshed.
+        """
+        self.servers[0].add_volume(u'other', 20 * MiB)
+        # 80 MiB free on the first array and 100 MiB on the second
+        first = self.api.create_volume(uuid4(), 30 * MiB)
+        # 80 MiB and 70 MiB
+        second = self.api.create_volume(uuid4(), 30 * MiB)
+        # 50 MiB and 70 MiB, but the second array has become slow
+        self.servers[1].usec_per_op = 10000
+        self.now[0] = 60
+        third = self.api.create_volume(uuid4(), 30 * MiB)
+        self.assertEqual(
+            (set([u'other', second.blockdevice_id, third.blockdevice_id]),
+             set([first.blockdevice_id])),
+            (set(self.servers[0].volumes), set(self.servers[1].volumes))
+        )
+        # Space and performance, once before and once after the refresh
+        self.assertEqual(4, self.servers[0].requests['GET array'])
+
+    def test_no_space(self):
+        """
+        Creating a volume larger than the free space of every array fails.
+        """
+        self.assertRaises(multi_array.NoArrayAvailableException,
+                          self.api.create_volume, uuid4(), 200 * MiB)
+
+    def test_routing(self):
+        """
+        Volumes are listed from all arrays, and operations on them go to the
+        array holding them, also for volumes created elsewhere.
+        """
+        volumes = [self.api.create_volume(uuid4(), 60 * MiB)
+                   for _ in range(2)]
+        self.assertEqual([1, 1], [len(server.volumes)
+                                  for server in self.servers])
+        fresh = multi_array.MultiFlashArrayBlockDeviceAPI(self.api._apis)
+        attached = fresh.attach_volume(volumes[1].blockdevice_id,
+                                       fresh.compute_instance_id())
+        clone = fresh.clone_volume(volumes[1].dataset_id, uuid4())
+        self.assertEqual(
+            sorted([volumes[0], attached, clone],
+                   key=lambda volume: volume.blockdevice_id),
+            sorted(fresh.list_volumes(),
+                   key=lambda volume: volume.blockdevice_id))
+        fresh.destroy_volumes([volume.blockdevice_id for volume in volumes])
+        self.assertEqual([clone], fresh.list_volumes())
+        self.assertRaises(blockdevice.UnknownVolume,
+                          fresh.get_device_path, volumes[0].blockdevice_id)
+
+
+class EradicationSchedulerTests(SynchronousTestCase):
+    """
+    Tests for ``EradicationScheduler``.
+    """
+    def setUp(self):
+        self.server = simulated_flasharray.SimulatedFlashArrayServer()
+        self.array = simulated_flasharray.SimulatedFlashArray(self.server)
+        self.now = [0]
+        self.path = os.path.join(self.mktemp(), 'eradication.json')
+
+    def scheduler(self):
+        return eradication.EradicationScheduler(
+            self.array, 60, self.path, background=False,
+            clock=lambda: self.now[0])
+
+    def test_eradicate_due(self):
+        """
+        Destroyed volumes are eradicated once their delay has passed, also
+        by a new scheduler after a restart.
+        """
+        for name in (u'vol-a', u'vol-b'):
+            self.server.add_volume(name)
+            self.array.destroy_volume(name)
+        self.scheduler().schedule([u'vol-a'])
+        self.now[0] = 30
+        self.scheduler().schedule([u'vol-b'])
+
+        scheduler = self.scheduler()
+        self.now[0] = 60
+        self.assertEqual(30, scheduler.eradicate_due())
+        self.assertEqual([u'vol-b'], list(self.server.volumes))
+        self.now[0] = 90
+        self.assertEqual(None, scheduler.eradicate_due())
+        self.assertEqual(({}, {}), (self.server.volumes, scheduler.pending()))
+
+    def test_recovered_volume(self):
+        """
+        A volume recovered on the array is dropped from the schedule.
+        """
+        self.server.add_volume(u'vol-a')
+        scheduler = self.scheduler()
+        scheduler.schedule([u'vol-a'])
+        self.now[0] = 60
+        scheduler.eradicate_due()
+        self.assertEqual(({}, [u'vol-a']),
+                         (scheduler.pending(), list(self.server.volumes)))
@@ -0,0 +1,324 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``purestorage_flasharray_flocker_driver.client``.
+"""
+
+import importlib
+import threading
+
+import requests
+from twisted.trial.unittest import SynchronousTestCase
+
+from purestorage_flasharray_flocker_driver import client
+from tests.test_locking import wait_until
+from tests.utils import simulated_flasharray
+
+
+class KeepAliveFlashArrayTests(SynchronousTestCase):
+    """
+    Tests for ``KeepAliveFlashArray`` against a simulated array.
+    """
+    def setUp(self):
+        self.server = simulated_flasharray.SimulatedFlashArrayServer()
+        self.server.add_volume(u'vol-1')
+        self.transport = simulated_flasharray.SimulatedTransport(self.server)
+
+    def array(self, **kwargs):
+        return client.KeepAliveFlashArray(
+            'simulated-array', api_token='simulated-api-token',
+            adapter=self.transport, **kwargs)
+
+    def test_session(self):
+        """
+        Every request goes over the client's session with the configured
+        request arguments, and the responses carry their headers.
+        """
+        array = self.array(request_kwargs={'timeout': 7})
+        volume = array.get_volume(u'vol-1')
+        self.assertEqual(
+            (u'vol-1', 'application/json', [7] * 3),
+            (volume['name'], volume.headers['Content-Type'],
+             [kwargs['timeout'] for kwargs in self.transport.sent])
+        )
+
+    def test_expired_session(self):
+        """
+        When the Purity session expired the client logs in again and retries
+        the request.
+        """
+        array = self.array()
+        self.server.expire_sessions()
+        self.assertEqual(u'vol-1', array.get_volume(u'vol-1')['name'])
+        # The refused request never got to the array
+        self.assertEqual((2, 1),
+                         (self.server.requests['POST auth/session'],
+                          self.server.requests['GET volume/:name']))
+
+    def test_renegotiate_rest_version(self):
+        """
+        When the array no longer offers the REST version in use the client
+        switches to another one.
+        """
+        self.server.rest_versions = ['1.4', '1.5']
+        array = self.array()
+        self.server.rest_versions = ['1.4']
+        self.assertEqual(u'vol-1', array.get_volume(u'vol-1')['name'])
+        self.assertEqual('1.4', str(array._rest_version))
+
+    def test_install_session_requests(self):
+        """
+        The ``purestorage`` module is switched over to the session requests
+        by the first client created, and only once.
+        """
+        module = importlib.import_module(
+            client.purestorage.FlashArray.__module__)
+        self.patch(module, 'requests', requests)
+        self.array()
+        installed = module.requests
+        self.array()
+        self.assertEqual((client._session_requests, client._session_requests),
+                         (installed, module.requests))
+
+
+class FlashArrayClientPoolTests(SynchronousTestCase):
+    """
+    Tests for checking clients out of and back into ``FlashArrayClientPool``.
+    """
+    def setUp(self):
+        self.server = simulated_flasharray.SimulatedFlashArrayServer()
+        self.server.add_volume(u'vol-1')
+        self.created = []
+
+    def factory(self):
+        array = simulated_flasharray.SimulatedFlashArray(self.server)
+        self.created.append(array)
+        return array
+
+    def test_reuse(self):
+        """
+        The client created at startup is used again for calls one after the
+        other.
+        """
+        pool = client.FlashArrayClientPool('array', self.factory, 4)
+        for _ in range(3):
+            pool.get_volume(u'vol-1')
+        self.assertEqual((1, 3),
+                         (len(self.created),
+                          self.server.requests['GET volume/:name']))
+
+    def test_size(self):
+        """
+        Concurrent calls get clients of their own up to the pool's size, the
+        others wait for one of them to be checked in.
+        """
+        pool = client.FlashArrayClientPool('array', self.factory, 2)
+        release = threading.Event()
+        waiting = []
+
+        def sleep(seconds):
+            waiting.append(seconds)
+            release.wait()
+        self.server._sleep = sleep
+        self.server.latency = 1
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(pool.get_volume(u'vol-1')['name']))
+            for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        wait_until(lambda: len(waiting) == 2)
+        in_flight = len(waiting)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((2, 2, [u'vol-1'] * 3),
+                         (in_flight, len(self.created), results))
+
+
+class RetryTests(SynchronousTestCase):
+    """
+    Tests for the retries of ``FlashArrayClientPool``.
+    """
+    def setUp(self):
+        self.server = simulated_flasharray.SimulatedFlashArrayServer()
+        self.server.add_volume(u'vol-1')
+        self.now = [0]
+        self.sleeps = []
+        # The longest jittered delay, every time
+        self.patch(client.random, 'uniform', lambda low, high: high)
+
+    def pool(self, **kwargs):
+        return client.FlashArrayClientPool(
+            'array', lambda: simulated_flasharray.SimulatedFlashArray(
+                self.server), 2, clock=lambda: self.now[0],
+            sleep=self.sleeps.append, **kwargs)
+
+    def test_throttled(self):
+        """
+        Throttled requests are retried with exponential backoff.
+        """
+        pool = self.pool()
+        self.server.fail('GET volume/:name', 429, 503)
+        self.assertEqual(u'vol-1', pool.get_volume(u'vol-1')['name'])
+        self.assertEqual(
+            ([client.RETRY_BASE_DELAY, 2 * client.RETRY_BASE_DELAY],
+             {'requests': 3, 'retries': 2, 'throttled': 2, 'failures': 2,
+              'rejected': 0, 'circuit_opened': 0}),
+            (self.sleeps, pool.counters)
+        )
+
+    def test_max_retries(self):
+        """
+        A request still failing after ``max_retries`` retries raises.
+        """
+        pool = self.pool(max_retries=2)
+        self.server.fail('GET volume/:name', 429, 429, 429, 429)
+        error = self.assertRaises(client.purestorage.PureHTTPError,
+                                  pool.get_volume, u'vol-1')
+        self.assertEqual((429, 3, 2),
+                         (error.code, pool.counters['requests'],
+                          pool.counters['retries']))
+
+    def test_server_errors(self):
+        """
+        Server errors are only retried for read only requests.
+        """
+        pool = self.pool()
+        self.server.fail('GET volume/:name', 500)
+        self.server.fail('POST volume/:name', 500)
+        pool.get_volume(u'vol-1')
+        self.assertRaises(client.purestorage.PureHTTPError,
+                          pool.create_volume, u'vol-2', 1024)
+        self.assertEqual(
+            ({'requests': 3, 'retries': 1, 'throttled': 0, 'failures': 2,
+              'rejected': 0, 'circuit_opened': 0}, [u'vol-1']),
+            (pool.counters, sorted(self.server.volumes))
+        )
+
+    def test_client_errors(self):
+        """
+        Requests the array refused are neither retried nor count as failures.
+        """
+        pool = self.pool()
+        self.assertRaises(client.purestorage.PureHTTPError,
+                          pool.get_volume, u'unknown')
+        self.assertEqual((1, 0, 0, 2),
+                         (pool.counters['requests'], pool.counters['retries'],
+                          pool.counters['failures'], pool.concurrency_limit))
+
+    def test_backoff_limit(self):
+        """
+        The delay doubles with every attempt, up to ``RETRY_MAX_DELAY``, and
+        is jittered down to half of it.
+        """
+        pool = self.pool()
+        self.patch(client.random, 'uniform', lambda low, high: (low, high))
+        self.assertEqual(
+            [(client.RETRY_BASE_DELAY / 2, client.RETRY_BASE_DELAY),
+             (client.RETRY_BASE_DELAY * 4, client.RETRY_BASE_DELAY * 8),
+             (client.RETRY_MAX_DELAY / 2.0, client.RETRY_MAX_DELAY)],
+            [pool._backoff(attempt) for attempt in (0, 3, 20)])
+
+    def test_circuit_breaker(self):
+        """
+        Once the circuit opened requests fail without being sent, until the
+        trial request after the reset timeout succeeds.
+        """
+        pool = self.pool(max_retries=0)
+        self.server.fail('GET volume/:name',
+                         *[503] * client.CIRCUIT_FAILURE_THRESHOLD)
+        for _ in range(client.CIRCUIT_FAILURE_THRESHOLD):
+            self.assertRaises(client.purestorage.PureHTTPError,
+                              pool.get_volume, u'vol-1')
+        self.assertRaises(client.ArrayUnavailableError,
+                          pool.get_volume, u'vol-1')
+        self.now[0] = client.CIRCUIT_RESET_TIMEOUT
+        pool.get_volume(u'vol-1')
+        pool.get_volume(u'vol-1')
+        self.assertEqual(
+            (1, 1, client.CIRCUIT_FAILURE_THRESHOLD + 2),
+            (pool.counters['circuit_opened'], pool.counters['rejected'],
+             self.server.requests['GET volume/:name'])
+        )
+
+
+class AdaptiveLimiterTests(SynchronousTestCase):
+    """
+    Tests for ``AdaptiveLimiter``.
+    """
+    def test_adapt(self):
+        """
+        The limit is halved on overload, reduced a little for slow requests
+        and grows back by one over its value for each normal request.
+        """
+        limiter = client.AdaptiveLimiter(8, latency_tolerance=3.0)
+        limits = []
+        for latency, overloaded in [(None, True), (None, True),
+                                    (1.0, False), (4.0, False),
+                                    (2.0, False)]:
+            limiter.acquire()
+            limiter.release('get_volume', latency, overloaded)
+            limits.append(round(limiter.limit, 2))
+        self.assertEqual([4, 2, 2.5, 2.25, 2.69], limits)
+
+    def test_bounds(self):
+        """
+        The limit stays between its minimum and maximum.
+        """
+        limiter = client.AdaptiveLimiter(2, min_limit=1)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release('get_volume', overloaded=True)
+        low = limiter.limit
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release('get_volume', latency=1.0)
+        self.assertEqual((1, 2), (low, limiter.limit))
+
+    def test_wait_for_slot(self):
+        """
+        Callers wait while ``limit`` requests are in flight.
+        """
+        limiter = client.AdaptiveLimiter(1)
+        limiter.acquire()
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(limiter.acquire()))
+        thread.start()
+        thread.join(0.01)
+        waited = not acquired
+        limiter.release('get_volume', latency=1.0)
+        thread.join()
+        self.assertEqual((True, [None]), (waited, acquired))
+
+
+class CircuitBreakerTests(SynchronousTestCase):
+    """
+    Tests for ``CircuitBreaker``.
+    """
+    def test_half_open(self):
+        """
+        After the reset timeout a single trial request is allowed, and the
+        circuit opens again if it fails.
+        """
+        now = [0]
+        breaker = client.CircuitBreaker(failure_threshold=2, reset_timeout=30,
+                                        clock=lambda: now[0])
+        opened = [breaker.record_failure(), breaker.record_failure()]
+        now[0] = 29
+        closed_early = breaker.allow()
+        now[0] = 30
+        trials = [breaker.allow(), breaker.allow()]
+        reopened = breaker.record_failure()
+        now[0] = 59
+        still_open = breaker.allow()
+        now[0] = 60
+        trial = breaker.allow()
+        breaker.record_success()
+        self.assertEqual(
+            ([False, True], False, [True, False], True, False, True, True),
+            (opened, closed_early, trials, reopened, still_open, trial,
+             breaker.allow())
+        )
@@ -0,0 +1,478 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``purestorage_flasharray_flocker_driver.devices``.
+"""
+
+import os
+import subprocess
+
+from twisted.trial.unittest import SynchronousTestCase
+
+import eliot
+
+from purestorage_flasharray_flocker_driver import devices
+from purestorage_flasharray_flocker_driver import iscsi
+
+SERIAL_A = '1f9b2c7d3e5a4b6c00011a2b'
+SERIAL_B = '1f9b2c7d3e5a4b6c00011a2c'
+
+
+def make_dm_device(sysfs_root, dm_name, serial, slaves=('sdb', 'sdc')):
+    """Create a fake multipath map ``dm_name`` for ``serial`` in sysfs."""
+    dm_dir = os.path.join(sysfs_root, 'block', dm_name, 'dm')
+    if not os.path.isdir(dm_dir):
+        os.makedirs(dm_dir)
+    with open(os.path.join(dm_dir, 'uuid'), 'w') as uuid_file:
+        uuid_file.write('mpath-' + devices.pure_wwid(serial) + '\n')
+    with open(os.path.join(dm_dir, 'name'), 'w') as name_file:
+        name_file.write(devices.pure_wwid(serial) + '\n')
+    for slave in slaves:
+        slave_dir = os.path.join(sysfs_root, 'block', dm_name, 'slaves', slave)
+        if not os.path.isdir(slave_dir):
+            os.makedirs(slave_dir)
+
+
+def make_by_id_link(dev_root, dm_name, serial):
+    """Create the udev ``dm-uuid-mpath-<wwid>`` link for ``dm_name``."""
+    by_id = os.path.join(dev_root, 'disk', 'by-id')
+    if not os.path.isdir(by_id):
+        os.makedirs(by_id)
+    os.symlink(os.path.join('..', '..', dm_name),
+               os.path.join(by_id, 'dm-uuid-mpath-' + devices.pure_wwid(serial)))
+
+
+class FindMultipathDeviceTests(SynchronousTestCase):
+    """
+    Tests for ``find_multipath_device``.
+    """
+    def setUp(self):
+        self.sysfs_root = self.mktemp()
+        self.dev_root = self.mktemp()
+        os.makedirs(os.path.join(self.sysfs_root, 'block'))
+        os.makedirs(self.dev_root)
+
+    def find(self, serial):
+        return devices.find_multipath_device(serial, self.sysfs_root,
+                                             self.dev_root)
+
+    def test_by_id_link(self):
+        """
+        The udev by-id link resolves the serial to its dm device.
+        """
+        make_dm_device(self.sysfs_root, 'dm-4', SERIAL_A)
+        make_by_id_link(self.dev_root, 'dm-4', SERIAL_A)
+        self.assertEqual('/dev/dm-4', self.find(SERIAL_A.upper()))
+
+    def test_sysfs_scan(self):
+        """
+        Without a by-id link the dm maps in sysfs are scanned.
+        """
+        make_dm_device(self.sysfs_root, 'dm-1', SERIAL_B)
+        make_dm_device(self.sysfs_root, 'dm-2', SERIAL_A)
+        self.assertEqual('/dev/dm-2', self.find(SERIAL_A))
+
+    def test_stale_by_id_link(self):
+        """
+        A by-id link pointing at a map of another volume is not trusted.
+        """
+        make_dm_device(self.sysfs_root, 'dm-1', SERIAL_B)
+        make_by_id_link(self.dev_root, 'dm-1', SERIAL_A)
+        self.assertEqual(None, self.find(SERIAL_A))
+
+    def test_no_paths(self):
+        """
+        A multipath map without any path devices is not usable.
+        """
+        make_dm_device(self.sysfs_root, 'dm-0', SERIAL_A, slaves=())
+        self.assertEqual(None, self.find(SERIAL_A))
+
+    def test_read_dm_name(self):
+        """
+        The name of a map is the one multipath knows it by, not its dm
+        device.
+        """
+        make_dm_device(self.sysfs_root, 'dm-3', SERIAL_A)
+        self.assertEqual(
+            (devices.pure_wwid(SERIAL_A), None),
+            (devices.read_dm_name('dm-3', self.sysfs_root),
+             devices.read_dm_name('dm-4', self.sysfs_root))
+        )
+
+
+class DevicePathIndexTests(SynchronousTestCase):
+    """
+    Tests for ``DevicePathIndex``.
+    """
+    def setUp(self):
+        self.sysfs_root = self.mktemp()
+        os.makedirs(os.path.join(self.sysfs_root, 'block'))
+        self.index_path = os.path.join(self.mktemp(), 'device_index.json')
+
+    def test_lookup_validates_wwid(self):
+        """
+        A reused dm device carrying another volume's WWID is not returned.
+        """
+        make_dm_device(self.sysfs_root, 'dm-0', SERIAL_A)
+        index = devices.DevicePathIndex(sysfs_root=self.sysfs_root)
+        index.add(u'vol-a', SERIAL_A, '/dev/dm-0')
+        self.assertEqual('/dev/dm-0', index.lookup(u'vol-a'))
+
+        make_dm_device(self.sysfs_root, 'dm-0', SERIAL_B)
+        self.assertEqual(None, index.lookup(u'vol-a'))
+        self.assertEqual({'hits': 1, 'misses': 1}, index.stats())
+
+    def test_remove(self):
+        """
+        Removed entries are no longer returned.
+        """
+        make_dm_device(self.sysfs_root, 'dm-0', SERIAL_A)
+        index = devices.DevicePathIndex(sysfs_root=self.sysfs_root)
+        index.add(u'vol-a', SERIAL_A, '/dev/dm-0')
+        index.remove(u'vol-a')
+        self.assertEqual(None, index.lookup(u'vol-a'))
+
+    def test_load_rebuilds_persisted_index(self):
+        """
+        A persisted index is reloaded and moved to the current dm devices,
+        volumes which are gone from the host are dropped.
+        """
+        make_dm_device(self.sysfs_root, 'dm-0', SERIAL_A)
+        make_dm_device(self.sysfs_root, 'dm-1', SERIAL_B)
+        index = devices.DevicePathIndex(self.index_path, self.sysfs_root)
+        index.add(u'vol-a', SERIAL_A, '/dev/dm-0')
+        index.add(u'vol-b', SERIAL_B, '/dev/dm-1')
+
+        # Simulate a reboot where vol-a came back as dm-2 and vol-b is gone.
+        os.rename(os.path.join(self.sysfs_root, 'block', 'dm-0'),
+                  os.path.join(self.sysfs_root, 'block', 'dm-2'))
+        with open(os.path.join(self.sysfs_root, 'block', 'dm-1', 'dm',
+                               'uuid'), 'w') as uuid_file:
+            uuid_file.write('')
+
+        reloaded = devices.DevicePathIndex(self.index_path, self.sysfs_root)
+        reloaded.load()
+        self.assertEqual(
+            ('/dev/dm-2', None),
+            (reloaded.lookup(u'vol-a'), reloaded.lookup(u'vol-b'))
+        )
+
+    def test_rebuild_adds_attached_volumes(self):
+        """
+        Volumes with a device on the host which aren't indexed, e.g. because
+        the index file was lost, are added by a rebuild.
+        """
+        make_dm_device(self.sysfs_root, 'dm-0', SERIAL_A)
+        make_dm_device(self.sysfs_root, 'dm-3', SERIAL_B)
+        index = devices.DevicePathIndex(self.index_path, self.sysfs_root)
+        index.add(u'vol-a', SERIAL_A, '/dev/dm-0')
+        index.rebuild({SERIAL_A.upper(): u'other',
+                       SERIAL_B.upper(): u'vol-b',
+                       SERIAL_A[:-1] + 'f': u'vol-c'})
+        self.assertEqual(
+            ('/dev/dm-0', '/dev/dm-3', None, None),
+            (index.lookup(u'vol-a'), index.lookup(u'vol-b'),
+             index.lookup(u'other'), index.lookup(u'vol-c'))
+        )
+
+
+def make_iscsi_session(sysfs_root, number, target, address, host,
+                       scsi_target=None):
+    """Create a fake iSCSI session ``number`` to ``target`` at ``address``.
+
+    :param scsi_target: Optional ``(channel, target_id)`` of the session's
+        SCSI target.
+    """
+    host_dir = os.path.join(sysfs_root, 'devices', 'platform', host)
+    session = os.path.join(host_dir, 'session{0}'.format(number))
+    os.makedirs(session)
+    if scsi_target is not None:
+        os.makedirs(os.path.join(session, 'target{0}:{1}:{2}'.format(
+            host[len('host'):], *scsi_target)))
+    session_dir = os.path.join(sysfs_root, 'class', 'iscsi_session',
+                               'session{0}'.format(number))
+    os.makedirs(session_dir)
+    os.symlink(os.path.abspath(session), os.path.join(session_dir, 'device'))
+    with open(os.path.join(session_dir, 'targetname'), 'w') as target_file:
+        target_file.write(target + '\n')
+    connection_dir = os.path.join(sysfs_root, 'class', 'iscsi_connection',
+                                  'connection{0}:0'.format(number))
+    os.makedirs(connection_dir)
+    with open(os.path.join(connection_dir, 'persistent_address'), 'w') as f:
+        f.write(address + '\n')
+    with open(os.path.join(connection_dir, 'persistent_port'), 'w') as f:
+        f.write('3260\n')
+
+
+def make_fc_host(sysfs_root, host, port_name, port_state='Online'):
+    """Create a fake FC HBA ``host`` with WWN ``port_name``."""
+    host_dir = os.path.join(sysfs_root, 'class', 'fc_host', host)
+    os.makedirs(host_dir)
+    for attribute, value in (('port_name', '0x' + port_name),
+                             ('port_state', port_state)):
+        with open(os.path.join(host_dir, attribute), 'w') as f:
+            f.write('{0}\n'.format(value))
+
+
+def make_fc_remote_port(sysfs_root, name, port_name, target_id,
+                        port_state='Online'):
+    """Create a fake FC remote port ``name`` (``rport-H:C-N``)."""
+    rport_dir = os.path.join(sysfs_root, 'class', 'fc_remote_ports', name)
+    os.makedirs(rport_dir)
+    for attribute, value in (('port_name', '0x' + port_name),
+                             ('scsi_target_id', target_id),
+                             ('port_state', port_state)):
+        with open(os.path.join(rport_dir, attribute), 'w') as f:
+            f.write('{0}\n'.format(value))
+
+
+class DiscoveryTests(SynchronousTestCase):
+    """
+    Tests for finding new LUNs with ``list_iscsi_sessions`` and
+    ``wait_for_multipath_devices``.
+    """
+    def setUp(self):
+        self.sysfs_root = self.mktemp()
+        os.makedirs(os.path.join(self.sysfs_root, 'block'))
+
+    def test_list_iscsi_sessions(self):
+        """
+        Each session is reported with its target, portal, SCSI host and
+        SCSI target, if there is one yet.
+        """
+        target = 'iqn.2010-06.com.purestorage:flasharray.1234'
+        make_iscsi_session(self.sysfs_root, 1, target, '10.0.0.1', 'host3',
+                           scsi_target=(0, 0))
+        make_iscsi_session(self.sysfs_root, 2, target, '10.0.0.2', 'host4')
+        self.assertEqual(
+            [{'session': 'session1', 'target': target,
+              'portal': '10.0.0.1:3260', 'host': 'host3',
+              'channel': '0', 'target_id': '0'},
+             {'session': 'session2', 'target': target,
+              'portal': '10.0.0.2:3260', 'host': 'host4',
+              'channel': '-', 'target_id': '-'}],
+            devices.list_iscsi_sessions(self.sysfs_root)
+        )
+
+    def test_list_fc_remote_ports(self):
+        """
+        FC remote ports are reported with the SCSI host, channel and target
+        their LUNs appear on, ports which aren't SCSI targets are left out.
+        """
+        make_fc_remote_port(self.sysfs_root, 'rport-7:0-1',
+                            '524a937000000001', 2)
+        make_fc_remote_port(self.sysfs_root, 'rport-7:0-0',
+                            '10000090fa000001', -1)
+        make_fc_remote_port(self.sysfs_root, 'rport-8:0-3',
+                            '524a937000000002', 0, port_state='Blocked')
+        self.assertEqual(
+            [{'host': 'host7', 'channel': '0', 'target_id': '2',
+              'port_name': '524a937000000001', 'port_state': 'Online'},
+             {'host': 'host8', 'channel': '0', 'target_id': '0',
+              'port_name': '524a937000000002', 'port_state': 'Blocked'}],
+            devices.list_fc_remote_ports(self.sysfs_root)
+        )
+
+    def test_read_fc_wwpns(self):
+        """
+        The WWNs of the online FC HBAs are reported, offline ones are left
+        out.
+        """
+        make_fc_host(self.sysfs_root, 'host7', '10000090fa000001')
+        make_fc_host(self.sysfs_root, 'host8', '10000090fa000002',
+                     port_state='Linkdown')
+        self.assertEqual(['10000090fa000001'],
+                         devices.read_fc_wwpns(self.sysfs_root))
+
+    def test_wait_for_multipath_devices(self):
+        """
+        Devices are waited for together, and the ones which never show up
+        are left out once the timeout expires.
+        """
+        now = [0]
+        make_dm_device(self.sysfs_root, 'dm-0', SERIAL_A)
+
+        def sleep(seconds):
+            now[0] += seconds
+            make_dm_device(self.sysfs_root, 'dm-1', SERIAL_A.upper()[:-1] + 'F')
+
+        found = devices.wait_for_multipath_devices(
+            [SERIAL_A, SERIAL_A[:-1] + 'f', SERIAL_B], timeout=1, interval=0.5,
+            sysfs_root=self.sysfs_root, dev_root=self.mktemp(),
+            clock=lambda: now[0], sleep=sleep)
+        self.assertEqual({SERIAL_A: '/dev/dm-0',
+                          SERIAL_A[:-1] + 'f': '/dev/dm-1'}, found)
+
+    def test_delete_scsi_devices(self):
+        """
+        All path devices of a multipath map are deleted, ones which are
+        already gone are skipped.
+        """
+        make_dm_device(self.sysfs_root, 'dm-3', SERIAL_A,
+                       slaves=('sdb', 'sdc', 'sdd'))
+        for slave in ('sdb', 'sdc'):
+            os.makedirs(os.path.join(self.sysfs_root, 'block', slave,
+                                     'device'))
+        slaves = devices.list_multipath_slaves('/dev/dm-3', self.sysfs_root)
+        devices.delete_scsi_devices(slaves, self.sysfs_root)
+        deleted = []
+        for slave in ('sdb', 'sdc'):
+            with open(os.path.join(self.sysfs_root, 'block', slave, 'device',
+                                   'delete')) as delete_file:
+                deleted.append(delete_file.read())
+        self.assertEqual((['sdb', 'sdc', 'sdd'], ['1', '1']),
+                         (slaves, deleted))
+
+
+class SessionKeeperTests(SynchronousTestCase):
+    """
+    Tests for ``iscsi.SessionKeeper``.
+    """
+    target = 'iqn.2010-06.com.purestorage:flasharray.1234'
+
+    def setUp(self):
+        self.sysfs_root = self.mktemp()
+        os.makedirs(self.sysfs_root)
+        self.ports = [{'iqn': self.target, 'portal': '10.0.0.1:3260'},
+                      {'iqn': self.target, 'portal': '10.0.0.2:3260'}]
+        self.commands = []
+
+    def run_iscsiadm(self, *args):
+        self.commands.append(args)
+        if args[-1] == '--login':
+            make_iscsi_session(self.sysfs_root, len(self.commands),
+                               args[3], args[5].split(':')[0], 'host5')
+
+    def keeper(self, chap=None):
+        return iscsi.SessionKeeper(lambda: self.ports, self.sysfs_root, chap,
+                                   run=self.run_iscsiadm)
+
+    def test_login_missing_portals(self):
+        """
+        Only portals without a session are logged in to, with automatic
+        login at boot.
+        """
+        make_iscsi_session(self.sysfs_root, 100, self.target, '10.0.0.1',
+                           'host4')
+        sessions, complete = self.keeper().ensure_sessions()
+        node = ('-m', 'node', '-T', self.target, '-p', '10.0.0.2:3260')
+        self.assertEqual(
+            ([node + ('--op', 'new'),
+              node + ('--op', 'update', '-n', 'node.startup',
+                      '-v', 'automatic'),
+              node + ('--login',)],
+             ['10.0.0.1:3260', '10.0.0.2:3260'], True),
+            (self.commands, sorted(session['portal'] for session in sessions),
+             complete)
+        )
+
+    def test_login_failure(self):
+        """
+        A portal which can't be logged in to makes the sessions incomplete.
+        """
+        def run_iscsiadm(*args):
+            raise OSError('iscsiadm not found')
+        keeper = iscsi.SessionKeeper(lambda: self.ports, self.sysfs_root,
+                                     run=run_iscsiadm)
+        self.assertEqual(([], False), keeper.ensure_sessions())
+
+
+    def test_password_not_logged(self):
+        """
+        A failed ``iscsiadm`` is logged without its command line, which holds
+        the CHAP password.
+        """
+        def run_iscsiadm(*args):
+            raise subprocess.CalledProcessError(
+                1, ('iscsiadm',) + args,
+                output=b'iscsiadm: failed to set s3cret\n')
+        messages = []
+        eliot.add_destinations(messages.append)
+        self.addCleanup(eliot.remove_destination, messages.append)
+        keeper = iscsi.SessionKeeper(lambda: self.ports, self.sysfs_root,
+                                     ('user', 's3cret'), run=run_iscsiadm)
+        keeper.ensure_sessions()
+        errors = [message['error'] for message in messages
+                  if message.get('warning') == 'Unable to log in to iSCSI '
+                                               'portal']
+        self.assertEqual(
+            ['iscsiadm exited with status 1: iscsiadm: failed to set ***'] * 2,
+            errors)
+
+
+class DeviceWatcherTests(SynchronousTestCase):
+    """
+    Tests for ``DeviceWatcher`` and ``parse_uevent``.
+    """
+    def setUp(self):
+        self.sysfs_root = self.mktemp()
+        os.makedirs(os.path.join(self.sysfs_root, 'block'))
+        self.now = 0
+        self.waits = []
+        self.later = []
+        # Nothing is emitted, uevents are handed to the watcher in wait()
+        self.watcher = devices.DeviceWatcher(
+            devices.QueueUeventSource(), self.sysfs_root, self.mktemp(),
+            recheck_interval=60, clock=lambda: self.now, wait=self.wait)
+
+    def wait(self, condition, timeout):
+        """Run what happens while the waiter waits, and move the clock to
+        the timeout unless a uevent woke it up."""
+        self.waits.append(timeout)
+        generation = self.watcher._generation
+        for action in self.later:
+            action()
+        del self.later[:]
+        if self.watcher._generation == generation:
+            self.now += timeout
+
+    def add_device_later(self, dm_name, serial, **event):
+        def add():
+            make_dm_device(self.sysfs_root, dm_name, serial)
+            self.watcher.handle_uevent(event)
+        self.later.append(add)
+
+    def test_woken_up_by_uevent(self):
+        """
+        A uevent for a new dm device wakes up the waiter straight away.
+        """
+        self.add_device_later('dm-0', SERIAL_A, ACTION='change',
+                              SUBSYSTEM='block', DEVNAME='dm-0',
+                              DM_UUID='mpath-' + devices.pure_wwid(SERIAL_A))
+        found = self.watcher.wait_for_multipath_devices([SERIAL_A], timeout=30)
+        self.assertEqual(({SERIAL_A: '/dev/dm-0'}, [30], 0),
+                         (found, self.waits, self.now))
+
+    def test_other_devices_ignored(self):
+        """
+        Uevents of other devices don't wake up the waiter, it only finds the
+        device when it looks again at the timeout.
+        """
+        self.add_device_later('dm-0', SERIAL_A, ACTION='add',
+                              SUBSYSTEM='block', DEVNAME='sdc')
+        found = self.watcher.wait_for_multipath_devices([SERIAL_A],
+                                                        timeout=0.5)
+        self.assertEqual(({SERIAL_A: '/dev/dm-0'}, [0.5], 0.5),
+                         (found, self.waits, self.now))
+
+    def test_recheck(self):
+        """
+        Without uevents the devices are looked for again every
+        ``recheck_interval`` seconds until the timeout.
+        """
+        found = self.watcher.wait_for_multipath_devices([SERIAL_A],
+                                                        timeout=150)
+        self.assertEqual(({}, [60, 60, 30], 150),
+                         (found, self.waits, self.now))
+
+    def test_parse_uevent(self):
+        """
+        The environment of a kernel uevent message is parsed.
+        """
+        self.assertEqual(
+            {'ACTION': 'change', 'DEVNAME': 'dm-3', 'SUBSYSTEM': 'block'},
+            devices.parse_uevent(b'change@/devices/virtual/block/dm-3\0'
+                                 b'ACTION=change\0DEVNAME=dm-3\0'
+                                 b'SUBSYSTEM=block\0')
+        )
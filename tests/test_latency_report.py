@@ -0,0 +1,102 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``purestorage_flasharray_flocker_driver.latency_report``.
+"""
+
+import json
+import os
+from io import StringIO
+from uuid import uuid4
+
+import eliot
+from twisted.trial.unittest import SynchronousTestCase
+
+from purestorage_flasharray_flocker_driver import latency_report
+from purestorage_flasharray_flocker_driver.purestorage_blockdevice import MiB
+from tests.utils import simulated_flasharray
+
+
+def action_lines(task_uuid, level, action_type, start, end,
+                 status='succeeded'):
+    """Return the eliot log lines of an action."""
+    return [
+        json.dumps({'task_uuid': task_uuid, 'task_level': level + [1],
+                    'action_type': action_type, 'action_status': 'started',
+                    'timestamp': start}),
+        json.dumps({'task_uuid': task_uuid, 'task_level': level + [2],
+                    'action_type': action_type, 'action_status': status,
+                    'timestamp': end}),
+    ]
+
+
+class ReadPhasesTests(SynchronousTestCase):
+    """
+    Tests for ``read_phases`` and ``format_report``.
+    """
+    def test_nested_phases(self):
+        """
+        Phases are named after the operation they ran in, also through
+        actions which aren't the driver's, and lines which aren't eliot
+        messages are skipped.
+        """
+        outer = action_lines('t1', [], 'flocker:agent:attach', 0.0, 5.0)
+        attach = action_lines('t1', [1], 'purestorage:attach_volume',
+                              1.0, 4.0)
+        connect = action_lines('t1', [1, 2], 'purestorage:rest:connect_host',
+                               1.5, 2.0, status='failed')
+        lines = ([outer[0], attach[0], 'not json', connect[0], connect[1],
+                  attach[1], outer[1]] +
+                 action_lines('t2', [], 'purestorage:attach_volume', 0, 1))
+        self.assertEqual(
+            {'attach_volume': [(3.0, False), (1, False)],
+             'attach_volume/rest:connect_host': [(0.5, True)]},
+            latency_report.read_phases(lines)
+        )
+
+    def test_percentiles(self):
+        """
+        The report has the nearest-rank percentiles of each phase in
+        milliseconds.
+        """
+        phases = {'list_volumes': [(index / 1000.0, False)
+                                   for index in range(1, 101)]}
+        self.assertEqual(
+            'phase         count  failed   p50   p95   p99    max\n'
+            'list_volumes    100       0  50.0  95.0  99.0  100.0\n',
+            latency_report.format_report(phases)
+        )
+
+
+class TracedOperationsTests(SynchronousTestCase):
+    """
+    Tests for the phases traced by ``FlashArrayBlockDeviceAPI``.
+    """
+    def test_attach_phases(self):
+        """
+        Attaching a volume and looking up its device are reported with the
+        REST calls and initiator work they are made of.
+        """
+        directory = self.mktemp()
+        os.makedirs(directory)
+        api = simulated_flasharray.build_simulated_api(
+            simulated_flasharray.SimulatedFlashArrayServer(), directory)
+        volume = api.create_volume(uuid4(), MiB)
+        output = StringIO()
+        destination = lambda message: output.write(
+            u'{0}\n'.format(json.dumps(message)))
+        eliot.add_destinations(destination)
+        self.addCleanup(eliot.remove_destination, destination)
+
+        api.attach_volume(volume.blockdevice_id, api.compute_instance_id())
+        api.get_device_path(volume.blockdevice_id)
+
+        phases = latency_report.read_phases(
+            output.getvalue().splitlines())
+        expected = set([
+            'attach_volume', 'attach_volume/attach_volumes',
+            'attach_volume/attach_volumes/rest:connect_host',
+            'attach_volume/attach_volumes/connect_volume',
+            'get_device_path', 'get_device_path/find_multipath_device'])
+        self.assertEqual(expected, expected & set(phases))
@@ -0,0 +1,112 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``purestorage_flasharray_flocker_driver.locking``.
+"""
+
+import threading
+import time
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from purestorage_flasharray_flocker_driver import locking
+
+
+def wait_until(predicate, timeout=5.0):
+    """Wait for another thread to make ``predicate`` true."""
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting')
+        time.sleep(0.001)
+
+
+class KeyedLocksTests(SynchronousTestCase):
+    """
+    Tests for ``KeyedLocks``.
+    """
+    def test_same_key(self):
+        """
+        A key is held by one caller at a time, other keys are not affected,
+        and locks nobody uses any more are dropped.
+        """
+        locks = locking.KeyedLocks()
+        entered = []
+
+        def hold():
+            with locks.hold(['vol-1']):
+                entered.append('vol-1')
+
+        with locks.hold(['vol-2', 'vol-1']):
+            thread = threading.Thread(target=hold)
+            thread.start()
+            with locks.hold(['vol-3']):
+                pass
+            time.sleep(0.01)
+            self.assertEqual([], entered)
+        thread.join()
+        self.assertEqual((['vol-1'], 0), (entered, len(locks)))
+
+
+class SingleFlightTests(SynchronousTestCase):
+    """
+    Tests for ``SingleFlight``.
+    """
+    def test_shared_result(self):
+        """
+        A call arriving while one for the same key is in flight gets its
+        result without calling the function again.
+        """
+        flight = locking.SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work(value):
+            calls.append(value)
+            release.wait()
+            return value * 2
+
+        thread = threading.Thread(
+            target=lambda: results.append(flight.do('key', work, 1)))
+        thread.start()
+        wait_until(lambda: calls)
+        follower = threading.Thread(
+            target=lambda: results.append(flight.do('key', work, 1)))
+        follower.start()
+        wait_until(lambda: flight.shared)
+        release.set()
+        thread.join()
+        follower.join()
+        self.assertEqual(([1], [2, 2], 1), (calls, results, flight.shared))
+        self.assertEqual(2, flight.do('key', work, 1))
+
+    def test_shared_error(self):
+        """
+        Waiting callers get the exception of the call in flight.
+        """
+        flight = locking.SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def fail():
+            release.wait()
+            raise ValueError('nope')
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except ValueError as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        threads[0].start()
+        wait_until(lambda: flight._calls)
+        threads[1].start()
+        wait_until(lambda: flight.shared)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, len(errors))
+        self.assertIs(errors[0], errors[1])
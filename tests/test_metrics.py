@@ -0,0 +1,64 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+Tests for ``purestorage_flasharray_flocker_driver.metrics``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from purestorage_flasharray_flocker_driver import metrics
+
+
+class RegistryTests(SynchronousTestCase):
+    """
+    Tests for ``Registry``.
+    """
+    def test_histogram(self):
+        """
+        Histograms are rendered with cumulative buckets, sum and count.
+        """
+        registry = metrics.Registry()
+        histogram = registry.histogram('latency_seconds', 'Latency.',
+                                       buckets=(0.1, 1.0))
+        histogram.observe(0.05, method='list_volumes')
+        histogram.observe(0.5, method='list_volumes')
+        self.assertEqual(
+            '# HELP latency_seconds Latency.\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{method="list_volumes",le="0.1"} 1.0\n'
+            'latency_seconds_bucket{method="list_volumes",le="1.0"} 2.0\n'
+            'latency_seconds_bucket{method="list_volumes",le="+Inf"} 2.0\n'
+            'latency_seconds_sum{method="list_volumes"} 0.55\n'
+            'latency_seconds_count{method="list_volumes"} 2.0\n',
+            registry.render()
+        )
+
+    def test_counter_and_callback(self):
+        """
+        Counters and callback metrics are rendered by label.
+        """
+        registry = metrics.Registry()
+        registry.counter('errors_total', 'Errors.').inc(code=503)
+        registry.callback('hits_total', 'Hits.', 'counter',
+                          lambda: [({'cache': 'ports'}, 3)])
+        self.assertEqual(
+            '# HELP errors_total Errors.\n'
+            '# TYPE errors_total counter\n'
+            'errors_total{code="503"} 1.0\n'
+            '# HELP hits_total Hits.\n'
+            '# TYPE hits_total counter\n'
+            'hits_total{cache="ports"} 3.0\n',
+            registry.render()
+        )
+
+    def test_write_textfile(self):
+        """
+        ``write_textfile`` writes the rendered metrics to the file.
+        """
+        registry = metrics.Registry()
+        registry.counter('errors_total', 'Errors.').inc()
+        path = self.mktemp()
+        metrics.write_textfile(registry, path)
+        with open(path) as metrics_file:
+            self.assertEqual(registry.render(), metrics_file.read())
@@ -0,0 +1,489 @@
+# Copyright 2016 Pure Storage Inc.
+# See LICENSE file for details.
+
+"""
+An in-process stand-in for a FlashArray, for running
+``FlashArrayBlockDeviceAPI`` without an array, initiator or root.
+
+``SimulatedFlashArrayServer`` implements the Purity REST endpoints the
+driver uses (hosts, volumes, connections and ports) on in-memory state, with
+a configurable latency per request. ``SimulatedFlashArray`` is a
+``purestorage.FlashArray`` which sends its requests there instead of over
+HTTPS, so everything above the transport (the REST client, the client pool
+and the driver) runs unchanged. ``SimulatedTransport`` gets the requests of
+the real REST client there instead, for testing the client itself.
+``SimulatedConnector`` plays os-brick and creates the volumes' multipath
+devices in a fake sysfs tree.
+"""
+
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+import purestorage
+import requests
+
+from purestorage_flasharray_flocker_driver import devices
+from purestorage_flasharray_flocker_driver import purestorage_blockdevice
+
+REST_VERSION = '1.4'
+ARRAY_IQN = 'iqn.2010-06.com.purestorage:flasharray.simulated'
+INITIATOR_IQN = 'iqn.1993-08.org.debian:01:simulated'
+ISCSI_PORTALS = ('10.0.0.1:3260', '10.0.0.2:3260',
+                 '10.0.1.1:3260', '10.0.1.2:3260')
+DEFAULT_CAPACITY = 10 * 1024 ** 4  # bytes
+
+
+class SimulatedHTTPError(Exception):
+    def __init__(self, text, status_code=400):
+        Exception.__init__(self, text)
+        self.status_code = status_code
+        self.text = text
+
+
+class _Response(object):
+    """Just enough of ``requests.Response`` for ``PureHTTPError``."""
+    def __init__(self, error):
+        self.status_code = error.status_code
+        self.reason = 'BAD REQUEST'
+        self.headers = {'Content-Type': 'application/json'}
+        self.text = '[{{"msg": "{0}"}}]'.format(error.text)
+
+
+class SimulatedFlashArrayServer(object):
+    """In-memory FlashArray answering Purity REST requests.
+
+    :param latency: Seconds every request takes.
+    :param item_latency: Additional seconds per item a request returns, so
+        listing a large array costs more than a single lookup.
+    :param capacity: Usable bytes reported by the array, the volumes use
+        their full size of it.
+    """
+    def __init__(self, latency=0.0, item_latency=0.0, sleep=time.sleep,
+                 capacity=DEFAULT_CAPACITY):
+        self.latency = latency
+        self.item_latency = item_latency
+        self.capacity = capacity
+        # Reported by the array's performance monitor
+        self.usec_per_op = 0
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.volumes = {}
+        self.hosts = {}
+        # volume name -> {host name: lun}
+        self.connections = {}
+        self.ports = [{'name': 'CT{0}.ETH{1}'.format(index // 2, index % 2),
+                       'iqn': ARRAY_IQN, 'portal': portal, 'wwn': None}
+                      for index, portal in enumerate(ISCSI_PORTALS)]
+        self.requests = {}
+        self.request_seconds = 0.0
+        self.rest_versions = [REST_VERSION]
+        # endpoint -> HTTP status codes to fail its next requests with
+        self.failures = {}
+        # Purity sessions of SimulatedTransport clients
+        self.sessions = set()
+        self._routes = [
+            ('GET', r'api_version', self._api_version),
+            ('GET', r'array', self._get_array),
+            ('POST', r'auth/session', self._start_session),
+            ('GET', r'port', self._list_ports),
+            ('GET', r'host', self._list_hosts),
+            ('GET', r'host/([^/]+)', self._get_host),
+            ('POST', r'host/([^/]+)', self._create_host),
+            ('PUT', r'host/([^/]+)', self._set_host),
+            ('POST', r'host/([^/]+)/volume/([^/]+)', self._connect_host),
+            ('DELETE', r'host/([^/]+)/volume/([^/]+)', self._disconnect_host),
+            ('GET', r'volume', self._list_volumes),
+            ('GET', r'volume/([^/]+)', self._get_volume),
+            ('POST', r'volume/([^/]+)', self._create_volume),
+            ('PUT', r'volume/([^/]+)', self._set_volume),
+            ('DELETE', r'volume/([^/]+)', self._destroy_volume),
+            ('GET', r'volume/([^/]+)/host', self._list_volume_connections),
+        ]
+
+    def handle(self, method, path, data):
+        """Handle a request for ``path`` (relative to ``/api/<version>/``).
+
+        :raises SimulatedHTTPError: for requests Purity would refuse.
+        """
+        for route_method, pattern, handler in self._routes:
+            match = re.match(pattern + '$', path)
+            if route_method == method and match:
+                break
+        else:
+            raise SimulatedHTTPError('Unsupported request {0} {1}'
+                                     .format(method, path), 404)
+        endpoint = '{0} {1}'.format(method, pattern.replace('([^/]+)', ':name'))
+        result = None
+        try:
+            with self._lock:
+                self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+                if self.failures.get(endpoint):
+                    raise SimulatedHTTPError('Simulated failure.',
+                                             self.failures[endpoint].pop(0))
+                result = handler(*(match.groups() + (data or {},)))
+            return result
+        finally:
+            seconds = self.latency
+            if isinstance(result, list):
+                seconds += self.item_latency * len(result)
+            if seconds:
+                self._sleep(seconds)
+            with self._lock:
+                self.request_seconds += seconds
+
+    def fail(self, endpoint, *codes):
+        """Answer the next requests to ``endpoint``, e.g.
+        ``'GET volume/:name'``, with the HTTP status ``codes`` in turn."""
+        with self._lock:
+            self.failures.setdefault(endpoint, []).extend(codes)
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = {}
+            self.request_seconds = 0.0
+
+    def request_count(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def expire_sessions(self):
+        with self._lock:
+            self.sessions.clear()
+
+    def add_volume(self, name, size=purestorage_blockdevice.MiB):
+        with self._lock:
+            return self._create_volume(name, {'size': size})
+
+    # Handlers, called with the lock held
+
+    def _api_version(self, data):
+        return {'version': list(self.rest_versions)}
+
+    def _start_session(self, data):
+        session = uuid.uuid4().hex
+        self.sessions.add(session)
+        return {'username': 'pureuser', 'session': session}
+
+    def _get_array(self, data):
+        if data.get('space'):
+            return [{'hostname': 'simulated-array',
+                     'capacity': self.capacity,
+                     'total': sum(volume['size']
+                                  for volume in self.volumes.values())}]
+        if data.get('action') == 'monitor':
+            return [{'usec_per_read_op': self.usec_per_op,
+                     'usec_per_write_op': self.usec_per_op,
+                     'queue_depth': 0}]
+        return {'array_name': 'simulated-array', 'version': '4.7.0'}
+
+    def _list_ports(self, data):
+        return [dict(port) for port in self.ports]
+
+    def _list_hosts(self, data):
+        return [dict(host) for host in self.hosts.values()]
+
+    def _lookup_host(self, name):
+        if name not in self.hosts:
+            raise SimulatedHTTPError('Host does not exist.')
+        return self.hosts[name]
+
+    def _get_host(self, name, data):
+        return dict(self._lookup_host(name))
+
+    def _create_host(self, name, data):
+        if name in self.hosts:
+            raise SimulatedHTTPError('Host already exists.')
+        self.hosts[name] = {'name': name, 'hgroup': None,
+                            'iqn': list(data.get('iqnlist') or []),
+                            'wwn': list(data.get('wwnlist') or [])}
+        return dict(self.hosts[name])
+
+    def _set_host(self, name, data):
+        host = self._lookup_host(name)
+        host['iqn'].extend(data.get('addiqnlist') or [])
+        host['wwn'].extend(data.get('addwwnlist') or [])
+        return dict(host)
+
+    def _lookup_volume(self, name):
+        volume = self.volumes.get(name)
+        if volume is None:
+            raise SimulatedHTTPError('Volume does not exist.')
+        if volume['destroyed']:
+            raise SimulatedHTTPError('Volume has been destroyed.')
+        return volume
+
+    def _describe_volume(self, volume, qos=False):
+        if qos:
+            keys = ('name', 'bandwidth_limit', 'iops_limit')
+        else:
+            keys = ('name', 'size', 'serial', 'source', 'created')
+        return dict((key, volume[key]) for key in keys)
+
+    def _connect_host(self, host, name, data):
+        self._lookup_host(host)
+        volume = self._lookup_volume(name)
+        connected = self.connections.setdefault(name, {})
+        if host in connected:
+            raise SimulatedHTTPError('Connection already exists.')
+        used = set(lun for luns in self.connections.values()
+                   for connected_host, lun in luns.items()
+                   if connected_host == host)
+        lun = 1
+        while lun in used:
+            lun += 1
+        connected[host] = lun
+        return {'name': host, 'vol': volume['name'], 'lun': lun}
+
+    def _disconnect_host(self, host, name, data):
+        self._lookup_host(host)
+        self._lookup_volume(name)
+        if host not in self.connections.get(name, {}):
+            raise SimulatedHTTPError('Volume is not connected to host.')
+        del self.connections[name][host]
+        return {'name': host, 'vol': name}
+
+    def _list_volumes(self, data):
+        volumes = [volume for volume in self.volumes.values()
+                   if not volume['destroyed']]
+        if not data.get('connect'):
+            return [self._describe_volume(volume, data.get('qos'))
+                    for volume in volumes]
+        return [{'name': volume['name'], 'size': volume['size'],
+                 'host': host, 'lun': lun, 'hgroup': None}
+                for volume in volumes
+                for host, lun in self.connections.get(volume['name'],
+                                                      {}).items()]
+
+    def _get_volume(self, name, data):
+        return self._describe_volume(self._lookup_volume(name))
+
+    def _create_volume(self, name, data):
+        if name in self.volumes:
+            if self.volumes[name]['destroyed']:
+                raise SimulatedHTTPError('Volume has been destroyed.')
+            raise SimulatedHTTPError('Volume already exists.')
+        size = data.get('size')
+        if data.get('source'):
+            # copy_volume
+            size = self._lookup_volume(data['source'])['size']
+        self.volumes[name] = {
+            'name': name,
+            'size': size,
+            'serial': uuid.uuid4().hex[:24].upper(),
+            'source': data.get('source'),
+            'bandwidth_limit': data.get('bandwidth_limit'),
+            'iops_limit': data.get('iops_limit'),
+            'created': '2016-01-01T00:00:00Z',
+            'destroyed': False,
+        }
+        return self._describe_volume(self.volumes[name])
+
+    def _set_volume(self, name, data):
+        volume = self._lookup_volume(name)
+        if 'size' in data:
+            if data['size'] < volume['size'] and not data.get('truncate'):
+                raise SimulatedHTTPError('Implicit truncation not permitted.')
+            volume['size'] = data['size']
+        for limit in ('bandwidth_limit', 'iops_limit'):
+            if limit in data:
+                volume[limit] = data[limit]
+        if 'name' in data:
+            if data['name'] in self.volumes:
+                raise SimulatedHTTPError('Volume already exists.')
+            volume['name'] = data['name']
+            self.volumes[data['name']] = self.volumes.pop(name)
+            if name in self.connections:
+                self.connections[data['name']] = self.connections.pop(name)
+        return self._describe_volume(volume)
+
+    def _destroy_volume(self, name, data):
+        if data.get('eradicate'):
+            if name not in self.volumes:
+                raise SimulatedHTTPError('Volume does not exist.')
+            if not self.volumes[name]['destroyed']:
+                raise SimulatedHTTPError('Volume is not destroyed.')
+            del self.volumes[name]
+            return {'name': name}
+        volume = self._lookup_volume(name)
+        if self.connections.get(name):
+            raise SimulatedHTTPError('Volume has host connections.')
+        volume['destroyed'] = True
+        return {'name': name}
+
+    def _list_volume_connections(self, name, data):
+        volume = self._lookup_volume(name)
+        return [{'name': name, 'size': volume['size'], 'host': host,
+                 'lun': lun}
+                for host, lun in self.connections.get(name, {}).items()]
+
+
+class SimulatedFlashArray(purestorage.FlashArray):
+    """``purestorage.FlashArray`` talking to a ``SimulatedFlashArrayServer``."""
+    def __init__(self, server, target='simulated-array', **kwargs):
+        self._server = server
+        kwargs.setdefault('api_token', 'simulated-api-token')
+        super(SimulatedFlashArray, self).__init__(target, **kwargs)
+
+    def _request(self, method, path, data=None, reestablish_session=True):
+        if path.startswith('http'):
+            path = path.split('/api/', 1)[1]
+        try:
+            return self._server.handle(method, path, data)
+        except SimulatedHTTPError as err:
+            raise purestorage.PureHTTPError(self._target,
+                                            str(self._rest_version),
+                                            _Response(err))
+
+
+class SimulatedTransport(requests.adapters.BaseAdapter):
+    """``requests`` transport adapter answering from a
+    ``SimulatedFlashArrayServer``, like the array's HTTPS endpoint would.
+
+    Requests without the cookie of a current session are refused with 401,
+    and those for a REST version the array doesn't offer with 450. Every
+    other response carries the session cookie again.
+
+    :ivar sent: the keyword arguments ``requests`` sent each request with,
+        e.g. its ``timeout``.
+    """
+    def __init__(self, server):
+        super(SimulatedTransport, self).__init__()
+        self._server = server
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(kwargs)
+        path = request.path_url.split('/api/', 1)[1]
+        data = json.loads(request.body or 'null')
+        cookie = request.headers.get('Cookie', '')
+        session = None
+        for current in list(self._server.sessions):
+            if 'session=' + current in cookie:
+                session = current
+        error = None
+        result = None
+        if path != 'api_version':
+            version, path = path.split('/', 1)
+            if version not in self._server.rest_versions:
+                error = SimulatedHTTPError('Unsupported REST version.', 450)
+            elif path != 'auth/session' and session is None:
+                error = SimulatedHTTPError('Session expired.', 401)
+        if error is None:
+            try:
+                result = self._server.handle(request.method, path, data)
+            except SimulatedHTTPError as err:
+                error = err
+            if isinstance(result, dict) and 'session' in result:
+                session = result['session']
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.headers['Content-Type'] = 'application/json'
+        if error is None:
+            response.status_code = 200
+            response._content = json.dumps(result).encode('utf-8')
+            if session is not None:
+                response.cookies.set('session', session)
+        else:
+            response.status_code = error.status_code
+            response._content = _Response(error).text.encode('utf-8')
+        return response
+
+    def close(self):
+        pass
+
+
+class SimulatedConnector(object):
+    """Stand-in for the os-brick iSCSI connector.
+
+    Connecting a volume creates its multipath device in the fake sysfs tree
+    at ``sysfs_root``, disconnecting removes it again.
+    """
+    def __init__(self, server, sysfs_root, initiator=INITIATOR_IQN):
+        self._server = server
+        self._sysfs_root = sysfs_root
+        self._initiator = initiator
+        self._lock = threading.Lock()
+        self._next_dm = 0
+
+    def _find_volume(self, connection_properties):
+        lun = connection_properties['target_luns'][0]
+        with self._server._lock:
+            for name, luns in self._server.connections.items():
+                for host, host_lun in luns.items():
+                    if (host_lun == lun and self._initiator in
+                            self._server.hosts[host]['iqn']):
+                        return self._server.volumes[name]
+        raise RuntimeError('No volume at LUN {0}'.format(lun))
+
+    def _dm_dir(self, dm_name):
+        return os.path.join(self._sysfs_root, 'block', dm_name)
+
+    def add_device(self, serial):
+        """Create a multipath device for ``serial``, return its path."""
+        with self._lock:
+            dm_name = 'dm-{0}'.format(self._next_dm)
+            self._next_dm += 1
+        dm_dir = self._dm_dir(dm_name)
+        os.makedirs(os.path.join(dm_dir, 'dm'))
+        os.makedirs(os.path.join(dm_dir, 'slaves', 'sd' + dm_name[3:]))
+        os.makedirs(os.path.join(self._sysfs_root, 'block',
+                                 'sd' + dm_name[3:], 'device'))
+        with open(os.path.join(dm_dir, 'dm', 'uuid'), 'w') as uuid_file:
+            uuid_file.write(devices.MPATH_UUID_PREFIX +
+                            devices.pure_wwid(serial) + '\n')
+        with open(os.path.join(dm_dir, 'dm', 'name'), 'w') as name_file:
+            name_file.write(devices.pure_wwid(serial) + '\n')
+        return '/dev/' + dm_name
+
+    def connect_volume(self, connection_properties):
+        volume = self._find_volume(connection_properties)
+        return {'type': 'block',
+                'path': self.add_device(volume['serial'])}
+
+    def disconnect_volume(self, connection_properties, device_info):
+        serial = self._find_volume(connection_properties)['serial']
+        device = devices.list_multipath_devices(
+            self._sysfs_root).get(serial.lower())
+        if device is not None:
+            shutil.rmtree(self._dm_dir(os.path.basename(device)))
+
+
+def build_simulated_api(server, directory, cluster_id=None,
+                        metrics_registry=None, target='simulated-array',
+                        manage_purity_hosts=True, chap_host_user=None,
+                        chap_host_password=None, initiator_info=None,
+                        **kwargs):
+    """Return a ``FlashArrayBlockDeviceAPI`` using ``server`` as its array.
+
+    :param directory: Empty directory for the fake sysfs tree and the
+        driver's state.
+    :param target: The ``pure_ip`` of the array.
+    :param initiator_info: The ``wwpns``/``initiator`` of the node, by
+        default the iSCSI initiator the ``SimulatedConnector`` plays.
+    :param kwargs: Additional ``PureFlashArrayConfiguration`` parameters.
+    """
+    sysfs_root = os.path.join(directory, 'sys')
+    if not os.path.isdir(os.path.join(sysfs_root, 'block')):
+        os.makedirs(os.path.join(sysfs_root, 'block'))
+    kwargs.setdefault('state_dir', os.path.join(directory, 'state'))
+    configuration = purestorage_blockdevice.PureFlashArrayConfiguration(
+        target, 'simulated-api-token',
+        purestorage_blockdevice.ISCSI, manage_purity_hosts, chap_host_user,
+        chap_host_password, False, None, **kwargs)
+    return purestorage_blockdevice.FlashArrayBlockDeviceAPI(
+        configuration,
+        cluster_id or uuid.uuid4(),
+        array_factory=lambda: SimulatedFlashArray(server),
+        connector=SimulatedConnector(server, sysfs_root),
+        initiator_info=initiator_info or {'wwpns': [],
+                                          'initiator': [INITIATOR_IQN]},
+        sysfs_root=sysfs_root,
+        dev_root=os.path.join(directory, 'dev'),
+        metrics_registry=metrics_registry,
+    )
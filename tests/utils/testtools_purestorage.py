@@ -48,7 +48,19 @@ def pure_client_from_environment():
         dataset.get('pure_chap_host_user'),
         dataset.get('pure_chap_host_password'),
         dataset.get('pure_verify_https'),
-        dataset.get('pure_ssl_cert')
+        dataset.get('pure_ssl_cert'),
+        port_cache_ttl=dataset.get('pure_port_cache_ttl'),
+        state_dir=dataset.get('pure_state_dir'),
+        api_pool_size=dataset.get('pure_api_pool_size'),
+        api_max_retries=dataset.get('pure_api_max_retries'),
+        log_level=dataset.get('pure_log_level'),
+        metrics_textfile=dataset.get('pure_metrics_textfile'),
+        metrics_port=dataset.get('pure_metrics_port'),
+        profiles=dataset.get('pure_profiles'),
+        eradicate_after=dataset.get('pure_eradicate_after'),
+        iscsi_session_interval=dataset.get('pure_iscsi_session_interval'),
+        warm_pool_size=dataset.get('pure_warm_pool_size'),
+        volume_list_ttl=dataset.get('pure_volume_list_ttl')
     )
 
 